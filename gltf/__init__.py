@@ -2,7 +2,17 @@ import panda3d.core as p3d
 
 from .version import __version__
 from ._converter import GltfSettings
-from ._loader import load_model
+from ._loader import get_animation_cache, load_model
+from .animlibrary import AnimationCache, AnimationLibrary, load_animation_library
 from .exceptions import UnsupportedExtensionExeption
 
-__all__ = ["__version__", "GltfSettings", "load_model", "UnsupportedExtensionExeption"]
+__all__ = [
+    "__version__",
+    "GltfSettings",
+    "load_model",
+    "get_animation_cache",
+    "AnimationCache",
+    "AnimationLibrary",
+    "load_animation_library",
+    "UnsupportedExtensionExeption",
+]
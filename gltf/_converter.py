@@ -2,6 +2,9 @@ from __future__ import annotations
 
 import base64
 import collections
+import concurrent.futures
+import functools
+import hashlib
 import itertools
 import os
 import math
@@ -10,7 +13,8 @@ import urllib.parse
 import pprint  # pylint: disable=unused-import
 
 from dataclasses import dataclass
-from numpy import uint16
+
+import numpy
 
 from panda3d.core import (
     Filename,
@@ -45,7 +49,6 @@ from panda3d.core import (
     AnimChannelScalarTable,
     AnimGroup,
     Camera,
-    CPTAFloat,
     CharacterJoint,
     CharacterSlider,
     CharacterVertexSlider,
@@ -76,6 +79,7 @@ from panda3d.core import (
     Spotlight,
     Geom,
     GeomNode,
+    LODNode,
     GeomVertexReader,
     GeomVertexWriter,
     GeomVertexRewriter,
@@ -110,6 +114,9 @@ except ImportError:
     HAVE_BULLET = False
 from direct.stdpy.file import open  # pylint: disable=redefined-builtin
 
+from . import animlibrary
+from . import animutils
+from . import meshutils
 from .extensions import draco
 
 if LVector3 is LVector3f:
@@ -128,7 +135,20 @@ class GltfSettings:
     legacy_materials: bool = False
     skip_animations: bool = False
     flatten_nodes: bool = False
+    collapse_empty_nodes: bool = False
     animation_fps: int = 30
+    auto_animation_fps: bool = False
+    animation_workers: int = 0
+    lazy_animations: bool = False
+    share_animations: bool = False
+    dedupe_geometry: bool = False
+    compact_indices: bool = False
+    optimize_meshes: bool = False
+    lod_levels: int = 0
+    max_geom_triangles: int = 0
+    weld_vertices: bool = False
+    keep_quantized: bool = False
+    sparse_morph_targets: bool = False
 
 
 def get_extras(gltf_data):
@@ -139,50 +159,160 @@ def get_extras(gltf_data):
     return extras
 
 
-def vlerp(veca: p3d.LVector3, vecb: p3d.LVector3, factor: float) -> p3d.LVector3:
-    return veca * (1.0 - factor) + vecb * factor
+def make_anim_table(values):
+    """Convert resampled animation values to a table, storing a single value if they barely change"""
+    if numpy.ptp(values) < 0.00001:
+        values = values[:1]
+    return CPTA_stdfloat(PTA_stdfloat(values.tolist()))
+
+
+def sample_channel(frame_times, channel, path=None):
+    """Resample a (keyframe times, values, interpolation mode) channel at the given frame times"""
+    times, values, interpolation_mode = channel
+    if interpolation_mode == "STEP":
+        return animutils.sample_step(times, values, frame_times)
+    if interpolation_mode == "CUBICSPLINE":
+        # Rotations are normalized by quat_to_matrices
+        return animutils.sample_cubic_spline(times, values, frame_times)
+    if path == "rotation":
+        return animutils.sample_slerp(times, values, frame_times)
+    return animutils.sample_linear(times, values, frame_times)
+
+
+def bake_joint_animation(frame_times, cs_mat, channels, defaults):
+    """Resample the channels of a joint and return its translation, HPR and scale per frame
+
+    channels maps glTF paths to channels, defaults holds the rest pose of
+    the paths that are not animated.  cs_mat is the 3x3 coordinate system
+    conversion applied to the results.
+    """
+    def calculate_frame_values(path):
+        if path not in channels:
+            return numpy.tile(defaults[path], (len(frame_times), 1))
+        return sample_channel(frame_times, channels[path], path)
+
+    frame_translations = calculate_frame_values("translation")
+    frame_rotations = calculate_frame_values("rotation")
+    frame_scales = calculate_frame_values("scale")
+
+    # Compose scale and rotation and convert them to the Panda3D coordinate
+    # system, then split them again into scale and HPR
+    mats = animutils.quat_to_matrices(frame_rotations) * frame_scales[:, :, None]
+    mats = cs_mat.T @ mats @ cs_mat
+    frame_translations = frame_translations @ cs_mat
+    frame_scales = numpy.linalg.norm(mats, axis=2)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        frame_hprs = animutils.matrices_to_hpr(mats / frame_scales[:, :, None])
+
+    # Mirrored, degenerate and gimbal locked frames are left to decomposeMatrix
+    fallback_frames = numpy.flatnonzero(
+        (numpy.linalg.det(mats) <= 1e-12)
+        | (numpy.abs(mats[:, 1, 2]) >= 0.99999 * frame_scales[:, 1])
+    )
+    for i in fallback_frames:
+        mat = LMatrix4(LMatrix4.ident_mat())
+        for row in range(3):
+            mat.set_row(row, LVector3(*mats[i, row]))
+        frame_scale = LVector3()
+        frame_rotation = LVector3()
+        decomposeMatrix(mat, frame_scale, frame_rotation, LVector3())
+        frame_scales[i] = frame_scale
+        frame_hprs[i] = frame_rotation
+
+    return frame_translations, frame_hprs, frame_scales
+
+
+def bake_animation(frame_times, cs_mat, joint_channels, morph_channels):
+    """Resample an animation clip and return its joint and morph weight frame tables
+
+    joint_channels maps joint node ids to (channels, defaults) and
+    morph_channels maps mesh node ids to (weights channel, default weights).
+    Only NumPy arrays go in and out, so clips can be baked in worker processes.
+    """
+    joint_tables = {
+        nodeid: bake_joint_animation(frame_times, cs_mat, channels, defaults)
+        for nodeid, (channels, defaults) in joint_channels.items()
+    }
+    morph_tables = {
+        nodeid: sample_channel(frame_times, channel) if channel is not None else numpy.array([weights])
+        for nodeid, (channel, weights) in morph_channels.items()
+    }
+    return joint_tables, morph_tables
+
+
+def build_animation_skeleton(parent, layout, joint_tables):
+    """Add the joint tables of a (bone name, node id, child layouts) skeleton layout to parent"""
+    bone_name, boneid, child_layouts = layout
+    frame_translations, frame_hprs, frame_scales = joint_tables[boneid]
+
+    group = AnimChannelMatrixXfmTable(parent, bone_name)
+
+    # Write data to tables
+    group.set_table(b"x", make_anim_table(frame_translations[:, 0]))
+    group.set_table(b"y", make_anim_table(frame_translations[:, 1]))
+    group.set_table(b"z", make_anim_table(frame_translations[:, 2]))
+
+    group.set_table(b"h", make_anim_table(frame_hprs[:, 0]))
+    group.set_table(b"p", make_anim_table(frame_hprs[:, 1]))
+    group.set_table(b"r", make_anim_table(frame_hprs[:, 2]))
 
+    group.set_table(b"i", make_anim_table(frame_scales[:, 0]))
+    group.set_table(b"j", make_anim_table(frame_scales[:, 1]))
+    group.set_table(b"k", make_anim_table(frame_scales[:, 2]))
 
-def slerp(
-    quata: p3d.LQuaternion, quatb: p3d.LQuaternion, factor: float
-) -> p3d.LQuaternion:
-    dot_product = quata.dot(quatb)
+    for child_layout in child_layouts:
+        build_animation_skeleton(group, child_layout, joint_tables)
 
-    if dot_product < 0.0:
-        # take shorted path for negative dot product
-        quata = -quata
-        dot_product = -dot_product
 
-    if dot_product > 0.9995:
-        # close enough; just lerp
-        retval = quata * (1.0 - factor) + quatb * factor
-        retval.normalize()
-        return retval
+def build_animation_morph(parent, layouts, morph_tables):
+    """Add the weight tables of (group name, node id, target names) morph layouts to parent"""
+    for group_name, nodeid, target_names in layouts:
+        group = AnimGroup(parent, group_name) if group_name is not None else parent
 
-    # spherical linear interpolation
-    theta0 = math.acos(dot_product)
-    theta = factor * theta0
-    sin_theta = math.sin(theta)
-    sin_theta0 = math.sin(theta0)
+        # All targets are resampled together, one table per target
+        frame_weights = morph_tables[nodeid]
+        for i, target_name in enumerate(target_names):
+            channel = AnimChannelScalarTable(group, target_name)
+            channel.set_table(make_anim_table(frame_weights[:, i]))
 
-    scale_quata = math.cos(theta) - dot_product * sin_theta / sin_theta0
-    scale_quatb = sin_theta / sin_theta0
 
-    return quata * scale_quata + quatb * scale_quatb
+def make_anim_bundle(clip, joint_tables, morph_tables, skeleton_layouts, morph_layouts):
+    """Create the AnimBundle of a clip from its baked tables"""
+    anim_name, fps, frame_times, joint_channels, morph_channels = clip
+    bundle = AnimBundle(anim_name, fps, len(frame_times))
 
+    if joint_channels is not None:
+        skeleton = AnimGroup(bundle, "<skeleton>")
+        for layout in skeleton_layouts:
+            build_animation_skeleton(skeleton, layout, joint_tables)
 
-def get_next_time_index(currtime: float, time_buffer: list[float]) -> int:
-    nextidx = 1
-    nexttime = time_buffer[nextidx]
-    while currtime > nexttime and nextidx < len(time_buffer):
-        nextidx += 1
-        nexttime = time_buffer[nextidx]
+    if morph_channels is not None:
+        morph = AnimGroup(bundle, "morph")
+        build_animation_morph(morph, morph_layouts, morph_tables)
+    return bundle
 
-    return nextidx
 
+def bake_anim_bundle(clip, cs_mat, skeleton_layouts, morph_layouts, cache=None, key=None):
+    """Bake a clip gathered by Converter.get_animation_clip into an AnimBundle
 
-def get_lerp_factor(currtime: float, lasttime: float, nexttime: float) -> float:
-    return max((currtime - lasttime) / (nexttime - lasttime), 1)
+    This is what lazy animation libraries call, so it only uses its
+    arguments and keeps no converter or glTF data alive.  With a cache and
+    key, identical clips are baked only once.
+    """
+    if cache is not None:
+        bundle = cache.get(key)
+        if bundle is not None:
+            return bundle
+
+    _, _, frame_times, joint_channels, morph_channels = clip
+    joint_tables, morph_tables = bake_animation(
+        frame_times, cs_mat, joint_channels or {}, morph_channels or {}
+    )
+    bundle = make_anim_bundle(clip, joint_tables, morph_tables, skeleton_layouts, morph_layouts)
+
+    if cache is not None:
+        cache.put(key, bundle)
+    return bundle
 
 
 @dataclass
@@ -191,12 +321,121 @@ class CharInfo:
     nodepath: p3d.NodePath
     jvtmap: "dict[int, p3d.JointVertexTransform]"
     cvsmap: "dict[tuple[int, str], p3d.CharacterVertexSlider]"
+    joints: "dict[int, p3d.CharacterJoint]"
 
     def __init__(self, name: str):
         self.character = p3d.Character(name)
         self.nodepath = p3d.NodePath(self.character)
         self.jvtmap = {}
         self.cvsmap = {}
+        self.joints = {}
+
+
+@dataclass
+class VertexFormatInfo:
+    input_format: GeomVertexFormat
+    output_format: GeomVertexFormat
+    quantized_normal_type: "int | None"
+    quantized_tex_coords: bool
+    texcoord_types: "dict[str, int]"
+
+
+@dataclass
+class NodeHierarchy:
+    """Parent and subtree lookups for the nodes of a glTF document
+
+    Nodes are numbered in depth first order from the root nodes, so the
+    subtree of a node is the range of positions from subtree_starts to
+    subtree_ends.  Nodes that cannot be reached from a root, which only
+    happens with cyclic hierarchies, have no position.
+    """
+    parents: "list[int | None]"
+    depths: "list[int]"
+    subtree_starts: "list[int | None]"
+    subtree_ends: "list[int | None]"
+    skin_joints: "list[frozenset[int]]"
+    skin_joint_indices: "list[dict[int, int]]"
+    skin_root_joints: "list[list[int]]"
+    skinned_nodes: "list[list[int]]"
+
+    def __init__(self, gltf_data):
+        gltf_nodes = gltf_data.get("nodes", [])
+        num_nodes = len(gltf_nodes)
+        self.parents = [None] * num_nodes
+        for i, gltf_node in enumerate(gltf_nodes):
+            for child in gltf_node.get("children", ()):
+                self.parents[child] = i
+
+        self.depths = [0] * num_nodes
+        self.subtree_starts = [None] * num_nodes
+        self.subtree_ends = [None] * num_nodes
+        position = 0
+        stack = [
+            (nodeid, False) for nodeid in reversed(range(num_nodes))
+            if self.parents[nodeid] is None
+        ]
+        while stack:
+            nodeid, done = stack.pop()
+            if done:
+                self.subtree_ends[nodeid] = position
+                continue
+            self.subtree_starts[nodeid] = position
+            position += 1
+            stack.append((nodeid, True))
+            depth = self.depths[nodeid] + 1
+            for child in reversed(gltf_nodes[nodeid].get("children", [])):
+                if self.parents[child] == nodeid and self.subtree_starts[child] is None:
+                    self.depths[child] = depth
+                    stack.append((child, False))
+
+        self.skin_joints = []
+        self.skin_joint_indices = []
+        self.skin_root_joints = []
+        self.skinned_nodes = []
+        for gltf_skin in gltf_data.get("skins", []):
+            joint_indices = {}
+            for joint_index, joint_nodeid in enumerate(gltf_skin["joints"]):
+                joint_indices.setdefault(joint_nodeid, joint_index)
+            joints = frozenset(joint_indices)
+            self.skin_joints.append(joints)
+            self.skin_joint_indices.append(joint_indices)
+            self.skin_root_joints.append([
+                nodeid for nodeid in joint_indices
+                if self.parents[nodeid] not in joints
+            ])
+            self.skinned_nodes.append([])
+        for nodeid, gltf_node in enumerate(gltf_nodes):
+            if "skin" in gltf_node:
+                self.skinned_nodes[gltf_node["skin"]].append(nodeid)
+
+    def is_ancestor(self, ancestor, nodeid):
+        """Return whether ancestor is nodeid or one of its parents"""
+        start = self.subtree_starts[ancestor]
+        position = self.subtree_starts[nodeid]
+        if start is None or position is None:
+            return False
+        return start <= position < self.subtree_ends[ancestor]
+
+    def get_common_ancestor(self, nodeids):
+        """Return the deepest node that is one of nodeids or a parent of all of them
+
+        Nodes that are not under the same root node as the first one are
+        ignored.  Returns None if nodeids is empty.
+        """
+        nodeids = iter(nodeids)
+        common = next(nodeids, None)
+        if common is None:
+            return None
+        root = common
+        while self.parents[root] is not None and self.subtree_starts[root] is not None:
+            root = self.parents[root]
+        for nodeid in nodeids:
+            if not self.is_ancestor(root, nodeid):
+                continue
+            while not self.is_ancestor(common, nodeid):
+                common = self.parents[common]
+        return common
+
 
 class Converter:
     _COMPONENT_TYPE_MAP = {
@@ -235,6 +474,12 @@ class Converter:
         5125: 4,
         5126: 4,
     }
+    _QUANTIZATION_SCALE_MAP = {
+        GeomEnums.NT_int8: 127.0,
+        GeomEnums.NT_uint8: 255.0,
+        GeomEnums.NT_int16: 32767.0,
+        GeomEnums.NT_uint16: 65535.0,
+    }
     _COMPONENT_NUM_MAP = {
         "MAT4": 16,
         "VEC4": 4,
@@ -283,12 +528,21 @@ class Converter:
     }
 
     _MIN_SCALE_THRESHOLD = 0.0001 # Rescale vertices for nodes with a scale component smaller than this to avoid singularities
-
-    def __init__(self, filepath, settings=None):
+    # Distance in mesh radii at which the first simplified LOD level is shown
+    _LOD_SWITCH_DISTANCE = 8.0
+    # Highest frame rate picked by auto_animation_fps
+    _MAX_ANIMATION_FPS = 120
+    # Lowest frame rate picked by auto_animation_fps for clips with spline keyframes
+    _MIN_SPLINE_ANIMATION_FPS = 30
+
+    def __init__(self, filepath, settings=None, animation_cache=None):
         if not isinstance(filepath, Filename):
             filepath = Filename.from_os_specific(filepath)
         if settings is None:
             settings = GltfSettings()
+        if animation_cache is None:
+            animation_cache = animlibrary.AnimationCache()
+        self.animation_cache = animation_cache
         self.filepath = filepath
         self.filedir = Filename(filepath.get_dirname())
 
@@ -311,6 +565,18 @@ class Converter:
         self.compose_cs = CS_yup_right
 
         self._joint_nodes = set()
+        self._vertex_formats = {}
+        self._vertex_data_cache = {}
+        self._vertex_data_groups = {}
+        self._deduped_vertex_data = {}
+        self._deduped_geoms = {}
+        self._mesh_lods = {}
+        self._sparse_morph_rows = {}
+        self._animation_indices = {}
+        self._accessor_arrays = {}
+        self._hierarchy = None
+        self._material_texcoord_types = {}
+        self._node_rescales = {}
 
         # Scene props
         self.active_scene = NodePath(ModelRoot("default"))
@@ -358,347 +624,412 @@ class Converter:
             self.load_texture(texid, gltf_tex, gltf_data)
         self.load_fallback_texture()
 
+        self.index_material_usage(gltf_data)
         for matid, gltf_mat in enumerate(gltf_data.get("materials", [])):
-            self.load_material(matid, gltf_mat)
-
-        for skinid, gltf_skin in enumerate(gltf_data.get("skins", [])):
-            self.load_skin(skinid, gltf_skin, gltf_data)
-
+            # Skip materials that no primitive uses, unless they need to be
+            # reloaded onto meshes from an earlier update
+            if matid in self._material_texcoord_types or self.mat_mesh_map.get(matid):
+                self.load_material(matid, gltf_mat)
+
+        self._animation_indices = {}
+        self._accessor_arrays = {}
+        self._hierarchy = NodeHierarchy(gltf_data)
+        for skinid in range(len(gltf_data.get("skins", []))):
+            self.load_skin(skinid)
+
+        self.group_primitives_by_vertex_data(gltf_data)
+        self._deduped_vertex_data = {}
+        self._deduped_geoms = {}
+        self._mesh_lods = {}
         for meshid, gltf_mesh in enumerate(gltf_data.get("meshes", [])):
             self.load_mesh(meshid, gltf_mesh, gltf_data)
 
-        def get_node_transform(gltf_node):
-            if "matrix" in gltf_node:
-                gltf_mat = LMatrix4(*gltf_node.get("matrix"))
-            else:
-                gltf_mat = LMatrix4(LMatrix4.ident_mat())
-
-                # If (KHR) mesh quantization is used, the scale components may be too small for panda3d
-                # so we keep the scale at 1.0 here and scale the vertices later (see add_node)
-                if "scale" in gltf_node and not self.uses_mesh_quantization:
-                    scale = gltf_node["scale"]
-                    if "original_scale" not in gltf_node and scale[0] < self._MIN_SCALE_THRESHOLD or scale[1] < self._MIN_SCALE_THRESHOLD or scale[2] < self._MIN_SCALE_THRESHOLD:
-                        gltf_node["original_scale"] = [scale[0], scale[1], scale[2]]
-                        scale_mat = LVector3( 
-                            1 if scale[0] < self._MIN_SCALE_THRESHOLD else scale[0],
-                            1 if scale[1] < self._MIN_SCALE_THRESHOLD else scale[1],
-                            1 if scale[2] < self._MIN_SCALE_THRESHOLD else scale[2],
-                        )
-                    else:
-                        scale_mat = LVector3(*scale) 
-
-                    gltf_mat.setScaleMat(scale_mat)
-
-                if "rotation" in gltf_node:
-                    rot_mat = LMatrix4()
-                    rot = gltf_node["rotation"]
-                    quat = LQuaternion(rot[3], rot[0], rot[1], rot[2])
-                    quat.extract_to_matrix(rot_mat)
-                    gltf_mat *= rot_mat
-
-                if "translation" in gltf_node:
-                    gltf_mat *= LMatrix4.translate_mat(*gltf_node["translation"])
-
-            state = TransformState.make_mat(self.csxform_inv * gltf_mat * self.csxform)
-
-            return state
+        node_transforms = self.get_node_transforms(gltf_data)
 
         def build_characters(nodeid):
-            try:
-                gltf_node = gltf_data["nodes"][nodeid]
-            except IndexError:
-                print("Could not find node with index: {}".format(nodeid))
-                return
-            node_name = gltf_node.get("name", "node" + str(nodeid))
+            stack = [nodeid]
+            while stack:
+                nodeid = stack.pop()
+                try:
+                    gltf_node = gltf_data["nodes"][nodeid]
+                except IndexError:
+                    print("Could not find node with index: {}".format(nodeid))
+                    continue
+                node_name = gltf_node.get("name", "node" + str(nodeid))
 
-            if nodeid in self.skeletons:
-                skinid = self.skeletons[nodeid]
-                charinfo = CharInfo(node_name)
-                charinfo.character.set_transform(get_node_transform(gltf_node))
-                self.build_character(charinfo, nodeid, gltf_data, recurse=True)
-                self.characters[skinid] = charinfo
+                if nodeid in self.skeletons:
+                    skinid = self.skeletons[nodeid]
+                    charinfo = CharInfo(node_name)
+                    charinfo.character.set_transform(node_transforms[nodeid])
+                    self.build_character(charinfo, nodeid, gltf_data, recurse=True)
+                    self.characters[skinid] = charinfo
 
-            for child_nodeid in gltf_node.get("children", []):
-                build_characters(child_nodeid)
+                stack.extend(reversed(gltf_node.get("children", [])))
 
-        # Build scenegraphs
-        def add_node(root, gltf_scene, nodeid):
-            try:
-                gltf_node = gltf_data["nodes"][nodeid]
-            except IndexError:
-                print("Could not find node with index: {}".format(nodeid))
-                return
-            
-            skinid = self.skeletons.get(nodeid, None)
-            charinfo = self.characters.get(skinid, None)
-            scene_extras = get_extras(gltf_scene)
-            node_name = gltf_node.get("name", "node" + str(nodeid))
-            if nodeid in self._joint_nodes and not nodeid in self.skeletons:
-                # Handle non-joint children of joints, but don't add joints themselves
-                for child_nodeid in gltf_node.get("children", []):
-                    add_node(root, gltf_scene, child_nodeid)
-                return
+        def scale_mesh_geometry(geom, scale):
+            """ Scales each vertex in the geometry by the scale components
 
-            if charinfo:
-                # This node is the root of an animated character.
-                panda_node = charinfo.character
-                np = charinfo.nodepath
-                np.reparent_to(root)
-            else:
-                panda_node = PandaNode(node_name)
-                panda_node.set_transform(get_node_transform(gltf_node))
-                np = root.attach_new_node(panda_node)
+                When KHR_mesh_quantization is used, the scale of the node transform may cause singularities due to the scale being set to very small values
+                to transform integer components to float values in the range [-1.0, 1.0]. 
 
-            if "hidden_nodes" in scene_extras:
-                if nodeid in scene_extras["hidden_nodes"]:
-                    panda_node = panda_node.make_copy()
+                To prevent this, the node transform scale from the GLB is ignored in get_node_transforms (i.e. scale is set to (1,1,1)). 
+                The node transform scale is then applied to the vertices by scale_mesh_geometry instead (similar to "Apply Scale" in Blender).
 
-            def scale_mesh_geometry(geom, scale):
-                """ Scales each vertex in the geometry by the scale components
+                (see https://github.com/KhronosGroup/glTF/blob/main/extensions/2.0/Khronos/KHR_mesh_quantization/README.md)
+            """
+            original_vertex_data = geom.get_vertex_data()
+            new_vertex_data = original_vertex_data.replace_column(
+                InternalName.get_vertex(), 3, GeomEnums.NT_float32, GeomEnums.C_point
+            )
 
-                    When KHR_mesh_quantization is used, the scale of the node transform may cause singularities due to the scale being set to very small values
-                    to transform integer components to float values in the range [-1.0, 1.0]. 
-                    
-                    To prevent this, the node transform scale from the GLB is ignored in get_node_transform (i.e. scale is set to (1,1,1)). 
-                    The node transform scale is then applied to the vertices by scale_mesh_geometry instead (similar to "Apply Scale" in Blender).
-
-                    (see https://github.com/KhronosGroup/glTF/blob/main/extensions/2.0/Khronos/KHR_mesh_quantization/README.md)
-                """
-                original_vertex_data = geom.get_vertex_data()
-                new_vertex_data = original_vertex_data.replace_column(
-                    InternalName.get_vertex(), 3, GeomEnums.NT_float32, GeomEnums.C_point
-                )
-                
-                vertex_reader = GeomVertexReader(original_vertex_data, InternalName.get_vertex())
-                new_vertex_writer = GeomVertexWriter(new_vertex_data, InternalName.get_vertex())
-
-                read_vertex = vertex_reader.get_data3
-                write_vertex = new_vertex_writer.set_data3
-
-                while not vertex_reader.is_at_end():
-                    original_vertex = read_vertex()
-                    decoded_vertex = [
-                            original_vertex[0] * scale[0],
-                            original_vertex[1] * scale[1],
-                            original_vertex[2] * scale[2]
-                        ]
-                    write_vertex(*decoded_vertex)
+            vertex_reader = GeomVertexReader(original_vertex_data, InternalName.get_vertex())
+            new_vertex_writer = GeomVertexWriter(new_vertex_data, InternalName.get_vertex())
 
-                geom.set_vertex_data(new_vertex_data)
-    
-            if "mesh" in gltf_node:
-                meshid = gltf_node["mesh"]
+            read_vertex = vertex_reader.get_data3
+            write_vertex = new_vertex_writer.set_data3
 
-                gltf_mesh = gltf_data["meshes"][meshid]
-                mesh = self.meshes[meshid]
-
-                if self.uses_mesh_quantization and not "already_scaled" in gltf_mesh:
-                    # If KHR_mesh_quantization is used, the node scale components
-                    # are ignored in get_node_transform (defaulting the scale to (1,1,1)).
-                    # Here, we apply the scale to the mesh geometry instead which avoids causing a singularity with small
-                    # scale values when creating the node transfom in get_node_transform.
-                    scale = gltf_node["scale"]
-                    for geom_index in range( mesh.getNumGeoms() ):
-                        geom = mesh.modifyGeom(geom_index) 
-                        scale_mesh_geometry(geom, scale)
-
-                    # Set the flag in case the mesh geometry is shared with other meshes to not apply the scale _again_.
-                    gltf_mesh["already_scaled"] = True
-
-                elif "original_scale" in gltf_node and not "already_scaled" in gltf_mesh:
-                    # If we detect that at least one node scale component is below a minimum threshold, those components
-                    # are set to 1 in get_node_transform and (all) the original components are written to the "original_scale" 
-                    # attribute which is then used here to rescale the mesh geometry. 
-                    # Only the components below the threshold affect the mesh geometry (the assumption is that this should work for
-                    # non-uniform scales).
-                    # As with small scales due to KHR_mesh_quantization, this avoids causing a singularity when creating the node
-                    # transform in get_node_transform.
-                    scale = gltf_node["original_scale"]
-                    for geom_index in range( mesh.getNumGeoms() ):
-                        geom = mesh.modifyGeom(geom_index) 
-                        scale_mesh_geometry(geom, scale)
-
-                    # Set the flag in case the mesh geometry is shared with other meshes to not apply the scale _again_.
-                    gltf_mesh["already_scaled"] = True
-                    
-                charinfo = None
-                if "skin" in gltf_node:
-                    skinid = gltf_node["skin"]
-                    charinfo = self.characters[skinid]
-
-                # Does this mesh have weights, but are we not under a character?
-                # If so, create a character just for this mesh.
-                if gltf_mesh.get("weights") and not charinfo:
-                    mesh_name = gltf_mesh.get("name", "mesh" + str(meshid))
-                    charinfo = CharInfo(mesh_name)
-                    self.build_character(charinfo, nodeid, gltf_data, recurse=False)
-                    self.combine_mesh_morphs(mesh, meshid, charinfo)
-                    charinfo.nodepath.reparent_to(np)
-                    charinfo.nodepath.attach_new_node(mesh)
+            while not vertex_reader.is_at_end():
+                original_vertex = read_vertex()
+                decoded_vertex = [
+                        original_vertex[0] * scale[0],
+                        original_vertex[1] * scale[1],
+                        original_vertex[2] * scale[2]
+                    ]
+                write_vertex(*decoded_vertex)
+
+            geom.set_vertex_data(new_vertex_data)
+
+        def scale_mesh_geoms(mesh, scale):
+            # Geoms may share vertex data, only scale it once
+            scaled_vertex_data = {}
+            for geom_index in range( mesh.getNumGeoms() ):
+                geom = mesh.modifyGeom(geom_index)
+                vertex_data = geom.get_vertex_data()
+                if vertex_data in scaled_vertex_data:
+                    geom.set_vertex_data(scaled_vertex_data[vertex_data])
                 else:
-                    np.attach_new_node(mesh)
-                    if charinfo:
-                        self.combine_mesh_skin(mesh, charinfo)
-                        self.combine_mesh_morphs(mesh, meshid, charinfo)
+                    scale_mesh_geometry(geom, scale)
+                    scaled_vertex_data[vertex_data] = geom.get_vertex_data()
 
-            if "camera" in gltf_node:
-                camid = gltf_node["camera"]
-                cam = self.cameras[camid]
-                np.attach_new_node(cam)
-            if "extensions" in gltf_node:
-                light_ext = None
-                has_light_ext = False
-                if "KHR_lights_punctual" in gltf_node["extensions"]:
-                    light_ext = "KHR_lights_punctual"
-                    has_light_ext = True
-                elif "KHR_lights" in gltf_node["extensions"]:
-                    light_ext = "KHR_lights"
-                    has_light_ext = True
-                if has_light_ext:
-                    lightid = gltf_node["extensions"][light_ext]["light"]
-                    light = self.lights[lightid]
-                    lnp = np.attach_new_node(light)
-                    if self.compose_cs == CS_zup_right:
-                        lnp.set_p(lnp.get_p() - 90)
-                    lnp.set_r(lnp.get_r() - 90)
-                    if isinstance(light, Light):
-                        root.set_light(lnp)
+        def finish_node_contents(np, visible, reverse, scene_nodes):
+            """Show or hide the contents of a node and reverse culling under negative scales
 
-                has_physics = (
-                    "BLENDER_physics" in gltf_node["extensions"]
-                    or "PANDA3D_physics_collision_shapes" in gltf_node["extensions"]
-                )
-                if has_physics:
-                    gltf_collisions = gltf_node["extensions"].get(
-                        "PANDA3D_physics_collision_shapes",
-                        gltf_node["extensions"]["BLENDER_physics"],
-                    )
-                    gltf_rigidbody = gltf_node["extensions"].get(
-                        "BLENDER_physics", None
+            The traversal stops at nodes created for other glTF nodes, which
+            are finished on their own.  With reverse set, geometry gets
+            wrapped in a ReverseCulling node.
+            """
+            stack = [np]
+            while stack:
+                np = stack.pop()
+                if visible:
+                    np.show()
+                else:
+                    np.hide()
+
+                node = np.node()
+                for child in np.get_children():
+                    child_node = child.node()
+                    if child_node in scene_nodes:
+                        continue
+                    # Wrap whole LODNodes, since their children are matched to switches by index
+                    wrap = reverse and (
+                        child_node.is_of_type(LODNode.get_class_type())
+                        or child_node.is_of_type(GeomNode.get_class_type())
+                        and not node.is_of_type(LODNode.get_class_type())
                     )
-                    if "PANDA3D_physics_collision_shapes" in gltf_node["extensions"]:
-                        collision_shape = gltf_collisions["shapes"][0]
-                        shape_type = collision_shape["type"]
-                    else:
-                        collision_shape = gltf_collisions["collisionShapes"][0]
-                        shape_type = collision_shape["shapeType"]
-                    bounding_box = [
-                        max(0.00001, i) for i in collision_shape["boundingBox"]
-                    ]
-                    radius = max(bounding_box[0], bounding_box[1]) / 2.0
-                    height = bounding_box[2]
-                    geomnode = None
-                    intangible = gltf_collisions.get("intangible", False)
-                    if "mesh" in collision_shape:
-                        try:
-                            geomnode = self.meshes[collision_shape["mesh"]]
-                        except KeyError:
-                            print(
-                                "Could not find physics mesh ({}) for object ({})".format(
-                                    collision_shape["mesh"], nodeid
-                                )
-                            )
-                    if (
-                        "extensions" in gltf_data
-                        and "BP_physics_engine" in gltf_data["extensions"]
-                    ):
-                        use_bullet = (
-                            gltf_data["extensions"]["BP_physics_engine"]["engine"]
-                            == "bullet"
-                        )
-                    else:
-                        use_bullet = self.settings.collision_shapes == "bullet"
-                    if use_bullet and not HAVE_BULLET:
-                        print(
-                            "Warning: attempted to export for Bullet, which is unavailable, falling back to builtin"
-                        )
-                        use_bullet = False
-
-                    if use_bullet:
-                        phynode = self.load_physics_bullet(
-                            node_name,
-                            geomnode,
-                            shape_type,
-                            bounding_box,
-                            radius,
-                            height,
-                            intangible,
-                            gltf_rigidbody,
-                        )
+                    if wrap:
+                        tmp = np.attach_new_node(PandaNode("ReverseCulling"))
+                        tmp.set_attrib(CullFaceAttrib.make_reverse())
+                        child.reparent_to(tmp)
+                        if not visible:
+                            tmp.hide()
+                    stack.append(child)
+
+        collapsible_keys = {"children", "matrix", "rotation", "scale", "translation"}
+
+        def get_kept_nodes():
+            """Return the nodes that collapse_empty_nodes may not fold away or into"""
+            kept_nodes = set(self.skeletons)
+            kept_nodes.update(self._joint_nodes, self.joint_parents)
+            for charinfo in self.characters.values():
+                kept_nodes.update(charinfo.joints)
+            for animid, gltf_anim in enumerate(gltf_data.get("animations", [])):
+                kept_nodes.update(self.get_animation_index(animid, gltf_anim)[1])
+            return kept_nodes
+
+        def is_collapsible(nodeid, gltf_node, kept_nodes):
+            """Check if a node is an empty transform with a single child it can be folded into"""
+            children = gltf_node.get("children", [])
+            return (
+                len(children) == 1
+                and collapsible_keys.issuperset(gltf_node)
+                and nodeid not in kept_nodes
+                and children[0] not in kept_nodes
+            )
+
+        # Build scenegraphs
+        def add_node(root, nodeid, hidden_nodes, kept_nodes):
+            # Nodes are added depth first without recursion.  Each node is
+            # built detached and only attached to its parent once its subtree
+            # is complete, which keeps NodePath operations from walking up
+            # deep hierarchies.  The first node created on each path decides
+            # the visibility of everything below it, and geometry under an
+            # odd number of negatively scaled nodes gets its culling reversed.
+            # With kept_nodes set, the transforms of collapsible nodes are
+            # carried down and composed into their only child instead.
+            stack = [(root, nodeid, None, False, None)]
+            scene_nodes = set()
+            while stack:
+                item = stack.pop()
+                if len(item) > 5:
+                    # All children are done, finish the node and attach it
+                    root, np, node_name, nodeid, charinfo, visible, reverse, light_nps = item
+                    finish_node_contents(np, visible, reverse, scene_nodes)
+
+                    # Handle parenting to joints
+                    joint = self.joint_parents.get(nodeid)
+                    if joint:
+                        xformnp = NodePath(PandaNode("{}-parent".format(node_name)))
+                        np.reparent_to(xformnp)
+                        joint.add_net_transform(xformnp.node())
+                        xformnp.reparent_to(root)
+                    elif charinfo and not np.children:
+                        # if the NodePath children were moved under a Character and has no other children,
+                        # then we can safely delete the NodePath
+                        np.remove_node()
                     else:
-                        phynode = self.load_physics_builtin(
-                            node_name,
-                            geomnode,
-                            shape_type,
-                            bounding_box,
-                            radius,
-                            height,
-                            intangible,
-                        )
-                    if phynode is not None:
-                        phynp = np.attach_new_node(phynode)
-                        for geomnode in np.find_all_matches("+GeomNode"):
-                            geomnode.reparent_to(phynp)
+                        np.reparent_to(root)
 
-            for key, value in get_extras(gltf_node).items():
-                np.set_tag(key, str(value))
+                    for lnp in light_nps:
+                        root.set_light(lnp)
+                    continue
 
-            for child_nodeid in gltf_node.get("children", []):
-                add_node(np, gltf_scene, child_nodeid)
+                root, nodeid, visible, reverse, parent_xform = item
+                try:
+                    gltf_node = gltf_data["nodes"][nodeid]
+                except IndexError:
+                    print("Could not find node with index: {}".format(nodeid))
+                    continue
 
-            # Handle visibility after children are loaded
-            def visible_recursive(node, visible):
-                if visible:
-                    node.show()
-                else:
-                    node.hide()
-                for child in node.get_children():
-                    visible_recursive(child, visible)
+                xform = node_transforms[nodeid]
+                if parent_xform is not None:
+                    xform = parent_xform.compose(xform)
 
-            hidden_nodes = scene_extras.get("hidden_nodes", [])
-            if nodeid in hidden_nodes:
-                visible_recursive(np, False)
-            else:
-                visible_recursive(np, True)
-
-            # Check if we need to deal with negative scale values
-            scale = panda_node.get_transform().get_scale()
-            negscale = scale.x * scale.y * scale.z < 0
-            if negscale:
-                for geomnode in np.find_all_matches("**/+GeomNode"):
-                    tmp = geomnode.get_parent().attach_new_node(
-                        PandaNode("ReverseCulling")
-                    )
-                    tmp.set_attrib(CullFaceAttrib.make_reverse())
-                    geomnode.reparent_to(tmp)
+                if kept_nodes is not None and is_collapsible(nodeid, gltf_node, kept_nodes):
+                    if visible is None:
+                        visible = nodeid not in hidden_nodes
+                    stack.append((root, gltf_node["children"][0], visible, reverse, xform))
+                    continue
 
-            # Handle parenting to joints
-            joint = self.joint_parents.get(nodeid)
-            if joint:
-                xformnp = root.attach_new_node(PandaNode("{}-parent".format(node_name)))
-                np.reparent_to(xformnp)
-                joint.add_net_transform(xformnp.node())
+                skinid = self.skeletons.get(nodeid, None)
+                charinfo = self.characters.get(skinid, None)
+                node_name = gltf_node.get("name", "node" + str(nodeid))
+                if nodeid in self._joint_nodes and not nodeid in self.skeletons:
+                    # Handle non-joint children of joints, but don't add joints themselves
+                    stack.extend(
+                        (root, child_nodeid, visible, reverse, None)
+                        for child_nodeid in reversed(gltf_node.get("children", []))
+                    )
+                    continue
 
-            # if the NodePath children were moved under a Character and has no other children,
-            # then we can safely delete the NodePath
-            if charinfo and not np.children:
-                np.remove_node()
+                if charinfo:
+                    # This node is the root of an animated character.
+                    panda_node = charinfo.character
+                    np = charinfo.nodepath
+                else:
+                    panda_node = PandaNode(node_name)
+                    panda_node.set_transform(xform)
+                    np = NodePath(panda_node)
+                scene_nodes.add(panda_node)
+                light_nps = []
+
+                if visible is None:
+                    visible = nodeid not in hidden_nodes
+
+                # Check if we need to deal with negative scale values
+                scale = panda_node.get_transform().get_scale()
+                if scale.x * scale.y * scale.z < 0:
+                    reverse = not reverse
+
+                if "mesh" in gltf_node:
+                    meshid = gltf_node["mesh"]
+
+                    gltf_mesh = gltf_data["meshes"][meshid]
+                    mesh = self.meshes[meshid]
+
+                    if self.uses_mesh_quantization and not "already_scaled" in gltf_mesh:
+                        # If KHR_mesh_quantization is used, the node scale components
+                        # are ignored in get_node_transforms (defaulting the scale to (1,1,1)).
+                        # Here, we apply the scale to the mesh geometry instead which avoids causing a singularity with small
+                        # scale values when creating the node transfom in get_node_transforms.
+                        scale = gltf_node["scale"]
+                        scale_mesh_geoms(mesh, scale)
+
+                        # Set the flag in case the mesh geometry is shared with other meshes to not apply the scale _again_.
+                        gltf_mesh["already_scaled"] = True
+
+                    elif nodeid in self._node_rescales and not "already_scaled" in gltf_mesh:
+                        # If we detect that at least one node scale component is below a minimum threshold, those components
+                        # are set to 1 in get_node_transforms and (all) the original components are stored in _node_rescales,
+                        # which are then used here to rescale the mesh geometry.
+                        # Only the components below the threshold affect the mesh geometry (the assumption is that this should work for
+                        # non-uniform scales).
+                        # As with small scales due to KHR_mesh_quantization, this avoids causing a singularity when creating the node
+                        # transform in get_node_transforms.
+                        scale = self._node_rescales[nodeid]
+                        scale_mesh_geoms(mesh, scale)
+
+                        # Set the flag in case the mesh geometry is shared with other meshes to not apply the scale _again_.
+                        gltf_mesh["already_scaled"] = True
+                    
+                    charinfo = None
+                    if "skin" in gltf_node:
+                        skinid = gltf_node["skin"]
+                        charinfo = self.characters[skinid]
+
+                    # Does this mesh have weights, but are we not under a character?
+                    # If so, create a character just for this mesh.
+                    if gltf_mesh.get("weights") and not charinfo:
+                        mesh_name = gltf_mesh.get("name", "mesh" + str(meshid))
+                        charinfo = CharInfo(mesh_name)
+                        self.build_character(charinfo, nodeid, gltf_data, recurse=False)
+                        self.combine_mesh_morphs(mesh, meshid, charinfo)
+                        charinfo.nodepath.reparent_to(np)
+                        charinfo.nodepath.attach_new_node(mesh)
+                    elif charinfo:
+                        np.attach_new_node(mesh)
+                        self.combine_mesh_skin(mesh, charinfo)
+                        self.combine_mesh_morphs(mesh, meshid, charinfo)
+                    else:
+                        np.attach_new_node(self.get_mesh_lod(meshid))
+
+                if "camera" in gltf_node:
+                    camid = gltf_node["camera"]
+                    cam = self.cameras[camid]
+                    np.attach_new_node(cam)
+                if "extensions" in gltf_node:
+                    light_ext = None
+                    has_light_ext = False
+                    if "KHR_lights_punctual" in gltf_node["extensions"]:
+                        light_ext = "KHR_lights_punctual"
+                        has_light_ext = True
+                    elif "KHR_lights" in gltf_node["extensions"]:
+                        light_ext = "KHR_lights"
+                        has_light_ext = True
+                    if has_light_ext:
+                        lightid = gltf_node["extensions"][light_ext]["light"]
+                        light = self.lights[lightid]
+                        lnp = np.attach_new_node(light)
+                        if self.compose_cs == CS_zup_right:
+                            lnp.set_p(lnp.get_p() - 90)
+                        lnp.set_r(lnp.get_r() - 90)
+                        if isinstance(light, Light):
+                            light_nps.append(lnp)
+
+                    has_physics = (
+                        "BLENDER_physics" in gltf_node["extensions"]
+                        or "PANDA3D_physics_collision_shapes" in gltf_node["extensions"]
+                    )
+                    if has_physics:
+                        gltf_collisions = gltf_node["extensions"].get(
+                            "PANDA3D_physics_collision_shapes",
+                            gltf_node["extensions"]["BLENDER_physics"],
+                        )
+                        gltf_rigidbody = gltf_node["extensions"].get(
+                            "BLENDER_physics", None
+                        )
+                        if "PANDA3D_physics_collision_shapes" in gltf_node["extensions"]:
+                            collision_shape = gltf_collisions["shapes"][0]
+                            shape_type = collision_shape["type"]
+                        else:
+                            collision_shape = gltf_collisions["collisionShapes"][0]
+                            shape_type = collision_shape["shapeType"]
+                        bounding_box = [
+                            max(0.00001, i) for i in collision_shape["boundingBox"]
+                        ]
+                        radius = max(bounding_box[0], bounding_box[1]) / 2.0
+                        height = bounding_box[2]
+                        geomnode = None
+                        intangible = gltf_collisions.get("intangible", False)
+                        if "mesh" in collision_shape:
+                            try:
+                                geomnode = self.meshes[collision_shape["mesh"]]
+                            except KeyError:
+                                print(
+                                    "Could not find physics mesh ({}) for object ({})".format(
+                                        collision_shape["mesh"], nodeid
+                                    )
+                                )
+                        if (
+                            "extensions" in gltf_data
+                            and "BP_physics_engine" in gltf_data["extensions"]
+                        ):
+                            use_bullet = (
+                                gltf_data["extensions"]["BP_physics_engine"]["engine"]
+                                == "bullet"
+                            )
+                        else:
+                            use_bullet = self.settings.collision_shapes == "bullet"
+                        if use_bullet and not HAVE_BULLET:
+                            print(
+                                "Warning: attempted to export for Bullet, which is unavailable, falling back to builtin"
+                            )
+                            use_bullet = False
+
+                        if use_bullet:
+                            phynode = self.load_physics_bullet(
+                                node_name,
+                                geomnode,
+                                shape_type,
+                                bounding_box,
+                                radius,
+                                height,
+                                intangible,
+                                gltf_rigidbody,
+                            )
+                        else:
+                            phynode = self.load_physics_builtin(
+                                node_name,
+                                geomnode,
+                                shape_type,
+                                bounding_box,
+                                radius,
+                                height,
+                                intangible,
+                            )
+                        if phynode is not None:
+                            phynp = np.attach_new_node(phynode)
+                            for geomnode in np.find_all_matches("+GeomNode"):
+                                geomnode.reparent_to(phynp)
+                            for lodnode in np.find_all_matches("+LODNode"):
+                                lodnode.reparent_to(phynp)
+
+                for key, value in get_extras(gltf_node).items():
+                    np.set_tag(key, str(value))
+
+                stack.append((root, np, node_name, nodeid, charinfo, visible, reverse, light_nps))
+                stack.extend(
+                    (np, child_nodeid, visible, reverse, None)
+                    for child_nodeid in reversed(gltf_node.get("children", []))
+                )
 
         for sceneid, gltf_scene in enumerate(gltf_data.get("scenes", [])):
             scene_name = gltf_scene.get("name", "scene" + str(sceneid))
             scene_root = NodePath(ModelRoot(scene_name))
 
-            node_list = gltf_scene["nodes"]
             hidden_nodes = get_extras(gltf_scene).get("hidden_nodes", [])
-            node_list += hidden_nodes
+            node_list = gltf_scene["nodes"] + hidden_nodes
+            hidden_nodes = set(hidden_nodes)
 
             # Run through and pre-build Characters
             for nodeid in node_list:
                 build_characters(nodeid)
 
+            kept_nodes = get_kept_nodes() if self.settings.collapse_empty_nodes else None
+
             # Now iterate again to build the scene graph
             for nodeid in node_list:
-                add_node(scene_root, gltf_scene, nodeid)
+                add_node(scene_root, nodeid, hidden_nodes, kept_nodes)
 
             if self.settings.flatten_nodes:
                 scene_root.flatten_medium()
@@ -717,6 +1048,62 @@ class Converter:
             if "active_camera" in scene_extras:
                 self.active_camera = scene_extras["active_camera"]
 
+    def get_node_transforms(self, gltf_data):
+        """Return the TransformState of each node, converted to the Panda3D coordinate system
+
+        The matrices of all nodes are composed at once, and nodes with the
+        same matrix share a TransformState.  Nodes with scale components
+        below _MIN_SCALE_THRESHOLD get a scale of 1 in those components, and
+        their original scale is kept in _node_rescales to be applied to their
+        mesh instead.
+        """
+        self._node_rescales = {}
+        gltf_nodes = gltf_data.get("nodes", [])
+        if not gltf_nodes:
+            return []
+
+        scales = numpy.array(
+            [gltf_node.get("scale", (1, 1, 1)) for gltf_node in gltf_nodes], dtype=numpy.float64
+        )
+        rotations = numpy.array(
+            [gltf_node.get("rotation", (0, 0, 0, 1)) for gltf_node in gltf_nodes], dtype=numpy.float64
+        )
+        translations = numpy.array(
+            [gltf_node.get("translation", (0, 0, 0)) for gltf_node in gltf_nodes], dtype=numpy.float64
+        )
+
+        # If (KHR) mesh quantization is used, the scale components may be too small for panda3d
+        # so we keep the scale at 1.0 here and scale the vertices later (see add_node)
+        if self.uses_mesh_quantization:
+            scales[:] = 1
+        else:
+            small = scales < self._MIN_SCALE_THRESHOLD
+            for nodeid in numpy.flatnonzero(small.any(axis=1)):
+                if "matrix" not in gltf_nodes[nodeid]:
+                    self._node_rescales[int(nodeid)] = scales[nodeid].tolist()
+            scales[small] = 1
+
+        # Like LQuaternion, a zero quaternion means no rotation
+        rotations[~rotations.any(axis=1)] = (0, 0, 0, 1)
+
+        # Compose scale, rotation and translation as row-vector matrices
+        mats = numpy.zeros((len(gltf_nodes), 4, 4))
+        mats[:, :3, :3] = animutils.quat_to_matrices(rotations) * scales[:, :, None]
+        mats[:, 3, :3] = translations
+        mats[:, 3, 3] = 1
+        for nodeid, gltf_node in enumerate(gltf_nodes):
+            if "matrix" in gltf_node:
+                mats[nodeid] = numpy.reshape(gltf_node["matrix"], (4, 4))
+
+        csxform = numpy.array([list(row) for row in self.csxform])
+        csxform_inv = numpy.array([list(row) for row in self.csxform_inv])
+        dtype = numpy.float32 if LVector3 is LVector3f else numpy.float64
+        mats = (csxform_inv @ mats @ csxform).astype(dtype).reshape(-1, 16)
+
+        unique_mats, inverse = numpy.unique(mats, axis=0, return_inverse=True)
+        states = [TransformState.make_mat(LMatrix4(*mat)) for mat in unique_mats.tolist()]
+        return [states[i] for i in inverse.ravel()]
+
     def load_matrix(self, mat):
         lmat = LMatrix4()
 
@@ -758,18 +1145,74 @@ class Converter:
         stride = buffview.get("byteStride", 1)
         return memoryview(buff)[start:end:stride]
 
-    def get_buffer_from_accessor(self, gltf_data, accid):
+    def get_accessor_dtype(self, acc):
+        numeric_type = self._COMPONENT_TYPE_MAP[acc["componentType"]]
+        return numpy.dtype(meshutils.NUMPY_TYPE_MAP[numeric_type]).newbyteorder("<")
+
+    def get_sparse_accessor_data(self, gltf_data, acc):
+        """Return the (indices, values) arrays of a sparse accessor"""
+        sparse = acc["sparse"]
+        count = sparse["count"]
+
+        index_info = sparse["indices"]
+        index_view = gltf_data["bufferViews"][index_info["bufferView"]]
+        indices = numpy.frombuffer(
+            self.buffers[index_view["buffer"]],
+            dtype=self.get_accessor_dtype(index_info),
+            count=count,
+            offset=index_view.get("byteOffset", 0) + index_info.get("byteOffset", 0),
+        )
+
+        value_info = sparse["values"]
+        value_view = gltf_data["bufferViews"][value_info["bufferView"]]
+        num_components = self._COMPONENT_NUM_MAP[acc["type"]]
+        values = numpy.frombuffer(
+            self.buffers[value_view["buffer"]],
+            dtype=self.get_accessor_dtype(acc),
+            count=count * num_components,
+            offset=value_view.get("byteOffset", 0) + value_info.get("byteOffset", 0),
+        ).reshape(count, num_components)
+        return indices, values
+
+    def get_accessor_array(self, gltf_data, accid):
+        """Return the elements of an accessor as a read-only (count, components) NumPy array
+
+        Dense accessors are returned as a view of their buffer.  Sparse
+        accessors are materialized from their buffer view, or zeros if they
+        have none, with the sparse values scattered over it.  Arrays are
+        cached, so accessors shared by many users are only decoded once.
+        """
+        if accid in self._accessor_arrays:
+            return self._accessor_arrays[accid]
+
         acc = gltf_data["accessors"][accid]
-        viewid = acc["bufferView"]
-        buff_view = self.get_buffer_view(gltf_data, viewid)
-        if "byteOffset" in acc:
-            buff_view = buff_view[acc["byteOffset"] :]
+        dtype = self.get_accessor_dtype(acc)
+        num_components = self._COMPONENT_NUM_MAP[acc["type"]]
+        count = acc["count"]
+
+        if "bufferView" in acc:
+            buffview = gltf_data["bufferViews"][acc["bufferView"]]
+            array = numpy.ndarray(
+                (count, num_components),
+                dtype=dtype,
+                buffer=self.buffers[buffview["buffer"]],
+                offset=buffview.get("byteOffset", 0) + acc.get("byteOffset", 0),
+                strides=(buffview.get("byteStride", dtype.itemsize * num_components), dtype.itemsize),
+            )
+        else:
+            array = numpy.zeros((count, num_components), dtype=dtype)
 
-        formatstr = (
-            self._COMPONENT_FORMT_STR_MAP[acc["componentType"]]
-            * self._COMPONENT_NUM_MAP[acc["type"]]
-        )
+        if "sparse" in acc:
+            indices, values = self.get_sparse_accessor_data(gltf_data, acc)
+            array = numpy.array(array)
+            array[indices] = values
+
+        array.flags.writeable = False
+        self._accessor_arrays[accid] = array
+        return array
 
+    def get_buffer_from_accessor(self, gltf_data, accid):
+        acc = gltf_data["accessors"][accid]
         convertfn = lambda x: x
 
         acctype = acc["type"]
@@ -782,6 +1225,20 @@ class Converter:
         elif acctype == "VEC4":
             convertfn = lambda x: p3d.LVector4(*x)
 
+        if "sparse" in acc or "bufferView" not in acc:
+            rows = self.get_accessor_array(gltf_data, accid).tolist()
+            return list(map(convertfn, map(tuple, rows)))
+
+        viewid = acc["bufferView"]
+        buff_view = self.get_buffer_view(gltf_data, viewid)
+        if "byteOffset" in acc:
+            buff_view = buff_view[acc["byteOffset"] :]
+
+        formatstr = (
+            self._COMPONENT_FORMT_STR_MAP[acc["componentType"]]
+            * self._COMPONENT_NUM_MAP[acc["type"]]
+        )
+
         element_size = (
             self._COMPONENT_SIZE_MAP[acc["componentType"]]
             * self._COMPONENT_NUM_MAP[acc["type"]]
@@ -1095,35 +1552,16 @@ class Converter:
 
                 # If KHR_mesh_quantization is used, assume the texture coordinates are quantized
                 if self.uses_mesh_quantization:
-                    texcoord_numeric_type = None
-
-                    # This is kinda nasty, but the intent is to get the numeric type of the first texture coordinate array 
-                    # for a mesh that uses the current material. The numeric type is used to remove the dequantization transforms
-                    # scale component from the the texture transform since the texture coordinates are scaled instead.
+                    # Get the numeric type of the first texture coordinate array for a mesh that uses the current material.
+                    # The numeric type is used to remove the dequantization transforms scale component from the the texture
+                    # transform since the texture coordinates are scaled instead.
                     #
                     # It is assumed all texture coordinate arrays using the same material has the same numeric type.
-                    for mesh in self.gltf_data["meshes"]:
-                        if "primitives" not in mesh:
-                            continue
-
-                        for primitive in mesh["primitives"]:
-                            if "material" not in primitive:
-                                continue
-                            if primitive["material"] != matid:
-                                continue
-                            
-                            if "attributes" not in primitive:
-                                continue
-                            attribute_name = f"TEXCOORD_{texstage.get_texcoord_name().basename}"
-                            if attribute_name not in primitive["attributes"]:
-                                continue
-                            texcoord_index = primitive["attributes"][attribute_name]
-                            texcoord_accessor = self.gltf_data["accessors"][texcoord_index]
-                            texcoord_numeric_type = self._COMPONENT_TYPE_MAP[ texcoord_accessor["componentType"] ]
-                            break
-
-                    if texcoord_numeric_type == None:
+                    texcoord_types = self._material_texcoord_types.get(matid, {})
+                    component_type = texcoord_types.get(texstage.get_texcoord_name().basename)
+                    if component_type is None:
                         raise RuntimeError(f"Expected a texcoord accessor for {texstage.get_texcoord_name()}")
+                    texcoord_numeric_type = self._COMPONENT_TYPE_MAP[component_type]
 
                     multiplier = get_dequantization_scale_multiplier(texcoord_numeric_type)
                     scale = [ x * multiplier for x in scale ]
@@ -1186,99 +1624,57 @@ class Converter:
 
         self.mat_states[matid] = state
 
-    def load_skin(self, skinid, gltf_skin, gltf_data):
-        # Find a common root node.  First gather the parents of each node.
-        # Note that we ignore the "skeleton" property of the glTF file, since it
-        # is just a hint and not particularly necessary.
-        parents = [None] * len(gltf_data["nodes"])
-        for i, node in enumerate(gltf_data["nodes"]):
-            for child in node.get("children", ()):
-                parents[child] = i
-
-        # Now create a path for each joint node as well as each node that
-        # is skinned with this skeleton, so that both are under the Character.
-        paths = []
-        for i, gltf_node in enumerate(gltf_data["nodes"]):
-            if i in gltf_skin["joints"] or gltf_node.get("skin") == skinid:
-                path = [i]
-                while parents[i] is not None:
-                    i = parents[i]
-                    path.insert(0, i)
-                paths.append(tuple(path))
-
-        # Find the longest prefix that is shared by all paths.
-        common_path = paths[0]
-        for path in paths[1:]:
-            path = list(path[: len(common_path)])
-            while path:
-                if common_path[: len(path)] == tuple(path):
-                    common_path = tuple(path)
-                    break
-
-                path.pop()
-
-        root_nodeid = common_path[-1]
-
-        self.skeletons[root_nodeid] = skinid
-
-    def load_primitive(self, geom_node, gltf_primitive, gltf_mesh, gltf_data):
-        # If Draco mesh compression is used, the primitive has to be decoded first
-        # Compare with https://github.com/KhronosGroup/glTF-Blender-IO/blob/949429900a7899efa12323bea4a57ac92b5b68e6/addons/io_scene_gltf2/blender/imp/gltf2_blender_mesh.py#L169
-        if (
-            "extensions" in gltf_primitive
-            and draco.EXTENSION_NAME in gltf_primitive["extensions"]
-        ):
-            draco.decode_primitive(self, gltf_primitive, gltf_data)
-
-        # Build Vertex Format
-        vformat = GeomVertexFormat()
-        mesh_attribs = gltf_primitive["attributes"]
-
-        accessors = [
-            {**gltf_data["accessors"][acc_idx], "_attrib": attrib_name}
-            for attrib_name, acc_idx in mesh_attribs.items()
-        ]
-
-        # Check for morph target columns.
-        targets = gltf_primitive.get("targets")
-        if targets:
-            target_names = get_extras(gltf_mesh).get("targetNames", [])
+    def index_material_usage(self, gltf_data):
+        """Map each material used by a primitive to the component types of its texcoord sets
+
+        The first primitive using a material decides the component type of
+        each texcoord set.
+        """
+        self._material_texcoord_types = {}
+        accessors = gltf_data.get("accessors", [])
+        for gltf_mesh in gltf_data.get("meshes", []):
+            for gltf_primitive in gltf_mesh.get("primitives", []):
+                matid = gltf_primitive.get("material")
+                if matid is None:
+                    continue
+                texcoord_types = self._material_texcoord_types.setdefault(matid, {})
+                for attrib_name, accid in gltf_primitive.get("attributes", {}).items():
+                    if attrib_name.startswith("TEXCOORD_"):
+                        texcoord_types.setdefault(
+                            attrib_name[len("TEXCOORD_"):], accessors[accid]["componentType"]
+                        )
 
-            for i, target in enumerate(targets):
-                if i < len(target_names):
-                    target_name = target_names[i]
-                else:
-                    target_name = str(i)
+    def load_skin(self, skinid):
+        # Find a common root node of each joint node as well as each node
+        # that is skinned with this skeleton, so that both are under the
+        # Character.  Note that we ignore the "skeleton" property of the glTF
+        # file, since it is just a hint and not particularly necessary.
+        hierarchy = self._hierarchy
+        root_nodeid = hierarchy.get_common_ancestor(sorted(
+            hierarchy.skin_joints[skinid].union(hierarchy.skinned_nodes[skinid])
+        ))
+        if root_nodeid is None:
+            print("Could not find a common root node for skin: {}".format(skinid))
+            return
 
-                accessors += [
-                    {
-                        **gltf_data["accessors"][acc_idx],
-                        "_attrib": attrib_name,
-                        "_target": target_name,
-                    }
-                    for attrib_name, acc_idx in target.items()
-                ]
+        self.skeletons[root_nodeid] = skinid
 
-        accessors = sorted(accessors, key=lambda x: x["bufferView"])
-        data_copies = []
-        is_skinned = "JOINTS_0" in mesh_attribs
-        calc_normals = not "NORMAL" in mesh_attribs
-        calc_tangents = not "TANGENT" in mesh_attribs
-        normalize_weights = False
+    def get_vertex_formats(self, array_specs, is_skinned, has_targets):
+        """Return the registered input and output formats for an attribute layout
 
-        for buffview, accs in itertools.groupby(
-            accessors, key=lambda x: x["bufferView"]
-        ):
-            buffview = gltf_data["bufferViews"][buffview]
-            accs = sorted(accs, key=lambda x: x.get("byteOffset", 0))
-            is_interleaved = (
-                len(accs) > 1 and accs[1].get("byteOffset", 0) < buffview["byteStride"]
-            )
+        array_specs holds a tuple of (attribute, target, type, componentType)
+        columns for each vertex array.  Most primitives in a file share a few
+        layouts, so the formats are only built and registered once.
+        """
+        key = (array_specs, is_skinned, has_targets)
+        if key in self._vertex_formats:
+            return self._vertex_formats[key]
 
+        vformat = GeomVertexFormat()
+        for columns in array_specs:
             varray = GeomVertexArrayFormat()
-            for acc in accs:
-                # Gather column information
-                attrib_parts = acc["_attrib"].lower().split("_")
+            for attrib, target, acctype, component_type in columns:
+                attrib_parts = attrib.lower().split("_")
                 attrib_name = self._ATTRIB_NAME_MAP.get(
                     attrib_parts[0], attrib_parts[0]
                 )
@@ -1289,152 +1685,41 @@ class Converter:
                 else:
                     internal_name = InternalName.make(attrib_name)
 
-                num_components = self._COMPONENT_NUM_MAP[acc["type"]]
-                numeric_type = self._COMPONENT_TYPE_MAP[acc["componentType"]]
-                numeric_size = self._COMPONENT_SIZE_MAP[acc["componentType"]]
+                num_components = self._COMPONENT_NUM_MAP[acctype]
+                numeric_type = self._COMPONENT_TYPE_MAP[component_type]
                 content = self._ATTRIB_CONTENT_MAP.get(attrib_name, GeomEnums.C_other)
-                size = numeric_size * num_components
 
-                if "_target" in acc:
-                    internal_name = InternalName.get_morph(attrib_name, acc["_target"])
+                if target is not None:
+                    internal_name = InternalName.get_morph(attrib_name, target)
                     content = GeomEnums.C_morph_delta
 
-                # Add this accessor as a column to the current vertex array format
                 varray.add_column(internal_name, num_components, numeric_type, content)
+            vformat.add_array(varray)
 
-                # Check if the weights table is using float or integer component
-                # Weights normalization will only be performed on float weights.
-                if attrib_parts[0] == "weights":
-                    normalize_weights = numeric_type == GeomEnums.NT_float32
-                
-                if not is_interleaved:
-                    # Start a new vertex array format
-                    vformat.add_array(varray)
-                    varray = GeomVertexArrayFormat()
-                    data_copies.append(
-                        (
-                            buffview["buffer"],
-                            acc.get("byteOffset", 0) + buffview.get("byteOffset", 0),
-                            acc["count"],
-                            size,
-                            buffview.get("byteStride", size),
-                        )
-                    )
-
-            if is_interleaved:
-                vformat.add_array(varray)
-                stride = buffview.get("byteStride", varray.get_stride())
-                data_copies.append(
-                    (
-                        buffview["buffer"],
-                        buffview.get("byteOffset", 0),
-                        accs[0]["count"],
-                        stride,
-                        stride,
-                    )
-                )
+        input_format = GeomVertexFormat.register_format(vformat)
 
-        # Copy data from buffers
-        reg_format = GeomVertexFormat.register_format(vformat)
-        vdata = GeomVertexData(geom_node.name, reg_format, GeomEnums.UH_stream)
+        # Repack mesh data
+        vformat = GeomVertexFormat()
+        varray_vert = GeomVertexArrayFormat()
+        varray_skin = GeomVertexArrayFormat()
+        varray_morph = GeomVertexArrayFormat()
 
-        for array_idx, data_info in enumerate(data_copies):
-            buffid, start, count, size, stride = data_info
+        # https://discourse.panda3d.org/t/setting-vertex-data-with-memory-pointer/27026/3
+        skip_columns = (
+            InternalName.get_transform_index(),
+            InternalName.get_transform_weight(),
+            InternalName.get_transform_blend(),
+        )
 
-            # With KHR_mesh_quantization, vertex data may not align with 4-byte boundaries
-            # which has to be accounted for when copying the data to the destination
-            # using the stride of the vertex format.
-            dest_stride = reg_format.getArray(array_idx).getStride()
-
-            handle = vdata.modify_array(array_idx).modify_handle()
-            handle.unclean_set_num_rows(count)
-
-            buff = self.buffers[buffid]
-            end = start + count * stride
-            if stride == size:
-                handle.copy_data_from(buff[start:end])
-            else:
-                src = start
-                dest = 0
-                while src < end:
-                    handle.copySubdataFrom(dest, size, buff[src : src + size])
-                    dest += dest_stride
-                    src += stride
-            handle = None
-        
-        # Flip UVs
-        num_uvs = len(
-            {i for i in gltf_primitive["attributes"] if i.startswith("TEXCOORD")}
-        )
-        for i in range(num_uvs):
-            uv_data = GeomVertexRewriter(vdata, InternalName.get_texcoord_name(str(i)))
-
-            while not uv_data.is_at_end():
-                uvs = uv_data.get_data2f()
-                uv_data.set_data2f(uvs[0], 1 - uvs[1])
-
-        if self.compose_cs == CS_yup_right:
-            # Flip morph deltas from Y-up to Z-up.  This is apparently not done by
-            # transform_vertices(), below, so we do it ourselves.
-            for morph_i in range(reg_format.get_num_morphs()):
-                delta_data = GeomVertexRewriter(
-                    vdata, reg_format.get_morph_delta(morph_i)
-                )
-
-                while not delta_data.is_at_end():
-                    data = delta_data.get_data3f()
-                    delta_data.set_data3f(data[0], -data[2], data[1])
-            # Flip tangents from Y-up to Z-up.
-            if "TANGENT" in mesh_attribs:
-                tangent = GeomVertexRewriter(vdata, InternalName.make("tangent"))
-                while not tangent.is_at_end():
-                    data = tangent.get_data4f()
-                    tangent.set_data4f(data[0], -data[2], data[1], data[3])
-
-        if normalize_weights:
-            # The linear sum of all the joint weights must be as close as possible to 1, if the weights are
-            # stored as float.
-            # Some malformed assets do not respect this, hence we are normalizing them here.
-            weights_data = GeomVertexRewriter(
-                vdata, InternalName.get_transform_weight()
-            )
-            while not weights_data.is_at_end():
-                weights = weights_data.get_data4f()
-                max_weight = (
-                    abs(weights[0])
-                    + abs(weights[1])
-                    + abs(weights[2])
-                    + abs(weights[3])
-                )
-                if max_weight != 0.0:
-                    weights = weights / max_weight
-                weights_data.set_data4f(weights)
-    
-        # Repack mesh data
-        vformat = GeomVertexFormat()
-        varray_vert = GeomVertexArrayFormat()
-        varray_skin = GeomVertexArrayFormat()
-        varray_morph = GeomVertexArrayFormat()
-
-        # https://discourse.panda3d.org/t/setting-vertex-data-with-memory-pointer/27026/3
-        skip_columns = (
-            InternalName.get_transform_index(),
-            InternalName.get_transform_weight(),
-            InternalName.get_transform_blend(),
-        )
-        
-        quantized_normals = False
         quantized_normal_type = None
         quantized_tex_coords = False
         quantized_tex_coords_info = {}
-        for arr in reg_format.get_arrays():
+        for arr in input_format.get_arrays():
             for column in arr.get_columns():
                 column_name = column.get_name()
                 if column_name in skip_columns:
                     varray = varray_skin
                 # TODO: if parent is none, the column_name.parent.basename explodes
-                # elif not column_name.parent:
-                #   print( f"column {column_name} has no parent: {column}"
                 elif column_name.parent.basename == "morph":
                     varray = varray_morph
                 else:
@@ -1450,8 +1735,8 @@ class Converter:
                     )
                 elif( column_name == InternalName.get_normal()):
                     # Convert normals to float
-                    quantized_normals = column.get_numeric_type() != GeomEnums.NT_float32
-                    quantized_normal_type = column.get_numeric_type()
+                    if column.get_numeric_type() != GeomEnums.NT_float32:
+                        quantized_normal_type = column.get_numeric_type()
                     varray.add_column(
                         column_name,
                         column.get_num_components(),
@@ -1476,11 +1761,11 @@ class Converter:
                         column.get_numeric_type(),
                         column.get_contents(),
                     )
-        
+
         vformat.add_array(varray_vert)
 
         # TODO: dequantize morph target attributes (see https://github.com/KhronosGroup/glTF/blob/main/extensions/2.0/Khronos/KHR_mesh_quantization/README.md)
-        if is_skinned or targets:
+        if is_skinned or has_targets:
             aspec = GeomVertexAnimationSpec()
             aspec.set_panda()
             vformat.set_animation(aspec)
@@ -1497,45 +1782,123 @@ class Converter:
             vformat.add_array(varray_blends)
             vformat.add_array(varray_skin)
 
-        if targets:
+        if has_targets:
             vformat.add_array(varray_morph)
-                
-        reg_format = GeomVertexFormat.register_format(vformat)
-        vdata = vdata.convert_to(reg_format)
+
+        format_info = VertexFormatInfo(
+            input_format,
+            GeomVertexFormat.register_format(vformat),
+            quantized_normal_type,
+            quantized_tex_coords,
+            quantized_tex_coords_info,
+        )
+        self._vertex_formats[key] = format_info
+        return format_info
+
+    def get_vertex_data_key(self, gltf_primitive, gltf_mesh):
+        """Return a key identifying the vertex data of a primitive
+
+        Primitives with the same key reference the same attribute and morph
+        target accessors and can share a single GeomVertexData.  None is
+        returned for primitives whose vertex data cannot be shared.
+        """
+        if "NORMAL" not in gltf_primitive["attributes"]:
+            # Flat normals are generated on de-indexed, per-primitive vertices
+            return None
+        if draco.EXTENSION_NAME in gltf_primitive.get("extensions", {}):
+            # Draco primitives are decoded into their own buffers
+            return None
+
+        targets = gltf_primitive.get("targets", [])
+        target_names = get_extras(gltf_mesh).get("targetNames", []) if targets else []
+        return (
+            gltf_primitive.get("mode", 4),
+            tuple(sorted(gltf_primitive["attributes"].items())),
+            tuple(tuple(sorted(target.items())) for target in targets),
+            tuple(target_names[: len(targets)]),
+        )
+
+    def group_primitives_by_vertex_data(self, gltf_data):
+        self._vertex_data_cache = {}
+        self._vertex_data_groups = collections.defaultdict(list)
+
+        for gltf_mesh in gltf_data.get("meshes", []):
+            for gltf_primitive in gltf_mesh["primitives"]:
+                key = self.get_vertex_data_key(gltf_primitive, gltf_mesh)
+                if key is not None:
+                    self._vertex_data_groups[key].append(gltf_primitive)
+
+    def load_primitive(self, geom_node, gltf_primitive, gltf_mesh, gltf_data):
+        # If Draco mesh compression is used, the primitive has to be decoded first
+        # Compare with https://github.com/KhronosGroup/glTF-Blender-IO/blob/949429900a7899efa12323bea4a57ac92b5b68e6/addons/io_scene_gltf2/blender/imp/gltf2_blender_mesh.py#L169
+        if (
+            "extensions" in gltf_primitive
+            and draco.EXTENSION_NAME in gltf_primitive["extensions"]
+        ):
+            draco.decode_primitive(self, gltf_primitive, gltf_data)
 
         # Construct primitive
         primitiveid = geom_node.get_num_geoms()
-        primitivemode = gltf_primitive.get("mode", 4)
-        try:
-            prim = self._PRIMITIVE_MODE_MAP[primitivemode](GeomEnums.UH_static)
-        except KeyError:
+        prim = self.load_primitive_indices(gltf_primitive, gltf_data)
+        if prim is None:
             print(
                 "Warning: primitive {} on mesh {} has an unsupported mode: {}".format(
-                    primitiveid, geom_node.name, primitivemode
+                    primitiveid, geom_node.name, gltf_primitive.get("mode", 4)
                 )
             )
             return
 
-        if "indices" in gltf_primitive:
-            index_acc = gltf_data["accessors"][gltf_primitive["indices"]]
-            prim.set_index_type(self._COMPONENT_TYPE_MAP[index_acc["componentType"]])
+        # Reuse vertex data already built for another primitive referencing
+        # the same accessors
+        vertex_key = self.get_vertex_data_key(gltf_primitive, gltf_mesh)
+        if vertex_key in self._vertex_data_cache:
+            vdata, remap, morph_rows = self._vertex_data_cache[vertex_key]
+            if remap is not None:
+                self.remap_primitive_indices(prim, remap)
+            if self.settings.optimize_meshes:
+                self.optimize_primitive_triangles(prim, vdata)
+            geom = Geom(vdata)
+            geom.add_primitive(prim)
+        else:
+            # Tangents are generated from the triangles of every primitive
+            # sharing this vertex data
+            shared_prims = [
+                self.load_primitive_indices(shared_primitive, gltf_data)
+                for shared_primitive in self._vertex_data_groups.get(vertex_key, [])
+                if shared_primitive is not gltf_primitive
+            ]
+            geom = self.load_vertex_data(
+                geom_node.name, gltf_primitive, gltf_mesh, gltf_data, prim, shared_prims
+            )
 
-            handle = prim.modify_vertices(index_acc["count"]).modify_handle()
-            handle.unclean_set_num_rows(index_acc["count"])
+            remap = None
+            if self.settings.weld_vertices:
+                remap = self.weld_geom_vertices(geom)
+            if self.settings.compact_indices:
+                remap = self.compact_geom_vertices(geom, shared_prims, remap)
+            if self.settings.optimize_meshes:
+                remap = self.optimize_geom(geom, shared_prims, remap)
+
+            morph_rows = {}
+            if self.settings.sparse_morph_targets:
+                morph_rows = self.get_sparse_morph_rows(gltf_primitive, gltf_mesh, gltf_data)
+                if remap is not None:
+                    num_rows = geom.get_vertex_data().get_num_rows()
+                    morph_rows = {
+                        name: meshutils.remap_row_mask(mask, remap, num_rows)
+                        for name, mask in morph_rows.items()
+                    }
+            if vertex_key is not None:
+                self._vertex_data_cache[vertex_key] = (geom.get_vertex_data(), remap, morph_rows)
 
-            buffview = gltf_data["bufferViews"][index_acc["bufferView"]]
-            buff = self.buffers[buffview["buffer"]]
-            start = buffview.get("byteOffset", 0) + index_acc.get("byteOffset", 0)
-            end = (
-                start
-                + index_acc["count"] * buffview.get("byteStride", 1) * prim.index_stride
-            )
-            handle.copy_data_from(buff[start:end])
-            handle = None
-        else:
-            index_acc = gltf_data["accessors"][gltf_primitive["attributes"]["POSITION"]]
-            start = index_acc.get("byteOffset", 0)
-            prim.setNonindexedVertices(start, index_acc["count"])
+        # Split large static geometry so parts of it can be culled
+        geoms = [geom]
+        is_animated = "JOINTS_0" in gltf_primitive["attributes"] or "targets" in gltf_primitive
+        if self.settings.max_geom_triangles > 0 and not is_animated:
+            geoms = self.split_geom(geom, self.settings.max_geom_triangles)
+
+        if self.settings.dedupe_geometry:
+            geoms = [self.dedupe_geom(geom) for geom in geoms]
 
         # Assign a material
         matid = gltf_primitive.get("material", None)
@@ -1561,22 +1924,458 @@ class Converter:
             mat = RenderState.make(matattrib, texattrib)
         else:
             mat = self.mat_states[gltf_primitive["material"]]
-            self.mat_mesh_map[gltf_primitive["material"]].append(
-                (geom_node.name, primitiveid)
+            self.mat_mesh_map[gltf_primitive["material"]].extend(
+                (geom_node.name, primitiveid + geom_index)
+                for geom_index in range(len(geoms))
+            )
+
+        if self.settings.keep_quantized:
+            mat = self.add_texcoord_dequantization(mat, geoms[0].get_vertex_data())
+
+        for geom in geoms:
+            geom_node.add_geom(geom, mat)
+
+        if morph_rows:
+            geom_morph_rows = self._sparse_morph_rows.setdefault(geom_node, {})
+            for geom_index in range(len(geoms)):
+                geom_morph_rows[primitiveid + geom_index] = morph_rows
+
+    def get_sparse_morph_rows(self, gltf_primitive, gltf_mesh, gltf_data):
+        """Return masks of the vertex rows affected by morph targets stored as sparse accessors
+
+        Only targets whose accessors are all sparse without a base buffer view
+        are included; the rows of other targets are found by scanning their
+        deltas in combine_mesh_morphs.
+        """
+        targets = gltf_primitive.get("targets")
+        if not targets or "NORMAL" not in gltf_primitive["attributes"]:
+            # Generating flat normals de-indexes the vertices
+            return {}
+
+        target_names = get_extras(gltf_mesh).get("targetNames", [])
+        num_rows = gltf_data["accessors"][gltf_primitive["attributes"]["POSITION"]]["count"]
+        morph_rows = {}
+        dense_targets = set()
+        for i, target in enumerate(targets):
+            target_name = target_names[i] if i < len(target_names) else str(i)
+            target_accs = [gltf_data["accessors"][acc_idx] for acc_idx in target.values()]
+            if not all("sparse" in acc and "bufferView" not in acc for acc in target_accs):
+                dense_targets.add(target_name)
+                continue
+
+            mask = morph_rows.setdefault(target_name, numpy.zeros(num_rows, dtype=bool))
+            for acc in target_accs:
+                indices, _ = self.get_sparse_accessor_data(gltf_data, acc)
+                mask[indices] = True
+
+        return {
+            name: mask for name, mask in morph_rows.items() if name not in dense_targets
+        }
+
+    def split_geom(self, geom, max_triangles):
+        """Split the triangles of geom into spatially coherent geoms of at most max_triangles
+
+        The parts share the vertex data of geom and get tight bounds, so they
+        can be frustum culled individually.  Returns a list holding only geom
+        if it does not need to be split.
+        """
+        prim = geom.get_primitive(0)
+        positions = meshutils.column_array(geom.get_vertex_data(), InternalName.get_vertex())
+        if positions is None or prim.get_primitive_type() != GeomEnums.PT_polygons:
+            return [geom]
+
+        prim = prim.decompose()
+        indices = meshutils.index_array(prim)
+        if len(indices) // 3 <= max_triangles:
+            return [geom]
+
+        if prim.is_indexed():
+            index_type = prim.get_index_type()
+        else:
+            index_type = meshutils.narrowed_index_type(indices, GeomEnums.NT_uint32)
+
+        parts = []
+        for part_indices in meshutils.split_triangles(indices, positions, max_triangles):
+            part_prim = GeomTriangles(prim.get_usage_hint())
+            meshutils.set_index_array(part_prim, part_indices, index_type)
+            part = Geom(geom.get_vertex_data())
+            part.add_primitive(part_prim)
+            parts.append(part)
+        return parts
+
+    def dedupe_geom(self, geom):
+        """Return a previously loaded Geom with the same content as geom
+
+        If only the vertex data matches, geom is changed to share it.
+        """
+        vdata = geom.get_vertex_data()
+        vdata_key = self._deduped_vertex_data.get(vdata)
+        if vdata_key is None:
+            vdata_key = meshutils.vertex_data_key(vdata)
+            self._deduped_vertex_data[vdata] = vdata_key
+            # Also remember the first vertex data seen with this content
+            self._deduped_vertex_data.setdefault(vdata_key, vdata)
+
+        shared_vdata = self._deduped_vertex_data[vdata_key]
+        geom_key = (vdata_key, meshutils.primitive_key(geom.get_primitive(0)))
+        if geom_key in self._deduped_geoms:
+            return self._deduped_geoms[geom_key]
+
+        if shared_vdata != vdata:
+            geom.set_vertex_data(shared_vdata)
+        self._deduped_geoms[geom_key] = geom
+        return geom
+
+    def load_primitive_indices(self, gltf_primitive, gltf_data):
+        primitivemode = gltf_primitive.get("mode", 4)
+        if primitivemode not in self._PRIMITIVE_MODE_MAP:
+            return None
+        prim = self._PRIMITIVE_MODE_MAP[primitivemode](GeomEnums.UH_static)
+
+        if "indices" in gltf_primitive and self.settings.compact_indices:
+            index_acc = gltf_data["accessors"][gltf_primitive["indices"]]
+            index_type = self._COMPONENT_TYPE_MAP[index_acc["componentType"]]
+
+            indices = self.get_accessor_array(gltf_data, gltf_primitive["indices"]).ravel()
+            index_type = meshutils.narrowed_index_type(indices, index_type)
+            meshutils.set_index_array(prim, indices, index_type)
+        elif "indices" in gltf_primitive:
+            index_acc = gltf_data["accessors"][gltf_primitive["indices"]]
+            if "sparse" in index_acc or "bufferView" not in index_acc:
+                indices = self.get_accessor_array(gltf_data, gltf_primitive["indices"]).ravel()
+                index_type = self._COMPONENT_TYPE_MAP[index_acc["componentType"]]
+                meshutils.set_index_array(prim, indices, index_type)
+                return prim
+
+            prim.set_index_type(self._COMPONENT_TYPE_MAP[index_acc["componentType"]])
+
+            handle = prim.modify_vertices(index_acc["count"]).modify_handle()
+            handle.unclean_set_num_rows(index_acc["count"])
+
+            buffview = gltf_data["bufferViews"][index_acc["bufferView"]]
+            buff = self.buffers[buffview["buffer"]]
+            start = buffview.get("byteOffset", 0) + index_acc.get("byteOffset", 0)
+            end = (
+                start
+                + index_acc["count"] * buffview.get("byteStride", 1) * prim.index_stride
+            )
+            handle.copy_data_from(buff[start:end])
+            handle = None
+        else:
+            index_acc = gltf_data["accessors"][gltf_primitive["attributes"]["POSITION"]]
+            start = index_acc.get("byteOffset", 0)
+            prim.setNonindexedVertices(start, index_acc["count"])
+
+        return prim
+
+    def remap_primitive_indices(self, prim, remap):
+        indices = remap[meshutils.index_array(prim)]
+        index_type = prim.get_index_type() if prim.is_indexed() else GeomEnums.NT_uint32
+        index_type = meshutils.narrowed_index_type(indices, index_type)
+        meshutils.set_index_array(prim, indices, index_type)
+
+    def weld_geom_vertices(self, geom):
+        """Merge vertices of geom with identical contents, indexing its primitives
+
+        Returns the remap table that still has to be applied to primitives
+        sharing the vertex data of geom.
+        """
+        vdata, remap = meshutils.weld_vertex_data(geom.get_vertex_data())
+        if remap is None:
+            return None
+
+        # Remapped indices only get smaller, so they stay valid for the old data
+        for prim_index in range(geom.get_num_primitives()):
+            prim = geom.modify_primitive(prim_index)
+            self.remap_primitive_indices(prim, remap)
+        geom.set_vertex_data(vdata)
+        return remap
+
+    def compact_geom_vertices(self, geom, shared_prims, remap):
+        """Remove vertices of geom that are not used by its or the shared primitives
+
+        Returns remap combined with the compaction, which still has to be
+        applied to shared_prims.
+        """
+        prims = list(geom.get_primitives()) + list(shared_prims)
+        if remap is None and not all(prim.is_indexed() for prim in prims):
+            return None
+
+        index_arrays = [meshutils.index_array(prim) for prim in geom.get_primitives()]
+        for prim in shared_prims:
+            indices = meshutils.index_array(prim)
+            index_arrays.append(indices if remap is None else remap[indices])
+        vdata, compact_remap = meshutils.compact_vertex_data(geom.get_vertex_data(), index_arrays)
+        if compact_remap is None:
+            return remap
+
+        # Remapped indices only get smaller, so they stay valid for the old data
+        for prim_index in range(geom.get_num_primitives()):
+            prim = geom.modify_primitive(prim_index)
+            self.remap_primitive_indices(prim, compact_remap)
+        geom.set_vertex_data(vdata)
+
+        if remap is None:
+            return compact_remap
+        return compact_remap[remap]
+
+    def optimize_primitive_triangles(self, prim, vdata):
+        if prim.get_type() != GeomTriangles.get_class_type() or not prim.is_indexed():
+            return
+
+        indices = meshutils.optimize_vertex_cache(
+            meshutils.index_array(prim),
+            vdata.get_num_rows(),
+            positions=meshutils.column_array(vdata, InternalName.get_vertex()),
+        )
+        meshutils.set_index_array(prim, indices, prim.get_index_type())
+
+    def optimize_geom(self, geom, shared_prims, remap):
+        """Reorder the triangles of geom for vertex cache reuse and its vertices for fetch locality
+
+        Returns remap combined with the vertex reordering, which still has to
+        be applied to shared_prims.
+        """
+        prims = list(geom.get_primitives()) + list(shared_prims)
+        if remap is None and not all(prim.is_indexed() for prim in prims):
+            return remap
+
+        vdata = geom.get_vertex_data()
+        for prim_index in range(geom.get_num_primitives()):
+            self.optimize_primitive_triangles(geom.modify_primitive(prim_index), vdata)
+
+        index_arrays = [meshutils.index_array(prim) for prim in geom.get_primitives()]
+        for prim in shared_prims:
+            indices = meshutils.index_array(prim)
+            index_arrays.append(indices if remap is None else remap[indices])
+        vdata, vertex_remap = meshutils.reorder_vertex_data(vdata, index_arrays)
+
+        for prim_index in range(geom.get_num_primitives()):
+            prim = geom.modify_primitive(prim_index)
+            indices = vertex_remap[meshutils.index_array(prim)]
+            meshutils.set_index_array(prim, indices, prim.get_index_type())
+        geom.set_vertex_data(vdata)
+
+        if remap is None:
+            return vertex_remap
+        return vertex_remap[remap]
+
+    def load_vertex_data(self, name, gltf_primitive, gltf_mesh, gltf_data, prim, shared_prims=()):
+        """Build the vertex data for a primitive and return a Geom holding prim
+
+        shared_prims are other primitives that will reference the same vertex
+        data, and are only used when generating tangents.
+        """
+        # Build Vertex Format
+        mesh_attribs = gltf_primitive["attributes"]
+
+        accessors = [
+            {**gltf_data["accessors"][acc_idx], "_attrib": attrib_name, "_accid": acc_idx}
+            for attrib_name, acc_idx in mesh_attribs.items()
+        ]
+
+        # Check for morph target columns.
+        targets = gltf_primitive.get("targets")
+        if targets:
+            target_names = get_extras(gltf_mesh).get("targetNames", [])
+
+            for i, target in enumerate(targets):
+                if i < len(target_names):
+                    target_name = target_names[i]
+                else:
+                    target_name = str(i)
+
+                accessors += [
+                    {
+                        **gltf_data["accessors"][acc_idx],
+                        "_attrib": attrib_name,
+                        "_target": target_name,
+                        "_accid": acc_idx,
+                    }
+                    for attrib_name, acc_idx in target.items()
+                ]
+
+        # Sparse accessors and accessors without a buffer view get their own
+        # arrays, copied from materialized data
+        sparse_accessors = [
+            acc for acc in accessors if "sparse" in acc or "bufferView" not in acc
+        ]
+        accessors = sorted(
+            [acc for acc in accessors if "sparse" not in acc and "bufferView" in acc],
+            key=lambda x: x["bufferView"],
+        )
+        array_specs = []
+        data_copies = []
+        is_skinned = "JOINTS_0" in mesh_attribs
+        calc_normals = not "NORMAL" in mesh_attribs
+        calc_tangents = not "TANGENT" in mesh_attribs
+        normalize_weights = False
+
+        for acc in sparse_accessors:
+            if acc["_attrib"].lower().split("_")[0] == "weights":
+                numeric_type = self._COMPONENT_TYPE_MAP[acc["componentType"]]
+                normalize_weights = numeric_type == GeomEnums.NT_float32
+
+            array_specs.append(
+                ((acc["_attrib"], acc.get("_target"), acc["type"], acc["componentType"]),)
+            )
+            data = self.get_accessor_array(gltf_data, acc["_accid"])
+            size = data.dtype.itemsize * data.shape[1]
+            data = memoryview(numpy.ascontiguousarray(data)).cast("B")
+            data_copies.append((data, 0, acc["count"], size, size))
+
+        for buffview, accs in itertools.groupby(
+            accessors, key=lambda x: x["bufferView"]
+        ):
+            buffview = gltf_data["bufferViews"][buffview]
+            accs = sorted(accs, key=lambda x: x.get("byteOffset", 0))
+            # Without a stride, the accessors of a buffer view are tightly
+            # packed one after the other
+            is_interleaved = (
+                len(accs) > 1
+                and "byteStride" in buffview
+                and accs[1].get("byteOffset", 0) < buffview["byteStride"]
+            )
+
+            columns = []
+            for acc in accs:
+                # Gather column information
+                num_components = self._COMPONENT_NUM_MAP[acc["type"]]
+                numeric_size = self._COMPONENT_SIZE_MAP[acc["componentType"]]
+                size = numeric_size * num_components
+
+                columns.append(
+                    (acc["_attrib"], acc.get("_target"), acc["type"], acc["componentType"])
+                )
+
+                # Check if the weights table is using float or integer component
+                # Weights normalization will only be performed on float weights.
+                if acc["_attrib"].lower().split("_")[0] == "weights":
+                    numeric_type = self._COMPONENT_TYPE_MAP[acc["componentType"]]
+                    normalize_weights = numeric_type == GeomEnums.NT_float32
+
+                if not is_interleaved:
+                    # Start a new vertex array format
+                    array_specs.append(tuple(columns))
+                    columns = []
+                    data_copies.append(
+                        (
+                            self.buffers[buffview["buffer"]],
+                            acc.get("byteOffset", 0) + buffview.get("byteOffset", 0),
+                            acc["count"],
+                            size,
+                            buffview.get("byteStride", size),
+                        )
+                    )
+
+            if is_interleaved:
+                array_specs.append(tuple(columns))
+                stride = buffview["byteStride"]
+                data_copies.append(
+                    (
+                        self.buffers[buffview["buffer"]],
+                        buffview.get("byteOffset", 0),
+                        accs[0]["count"],
+                        stride,
+                        stride,
+                    )
+                )
+
+        format_info = self.get_vertex_formats(tuple(array_specs), is_skinned, bool(targets))
+
+        # Copy data from buffers
+        reg_format = format_info.input_format
+        vdata = GeomVertexData(name, reg_format, GeomEnums.UH_stream)
+
+        for array_idx, data_info in enumerate(data_copies):
+            buff, start, count, size, stride = data_info
+
+            # With KHR_mesh_quantization, vertex data may not align with 4-byte boundaries
+            # which has to be accounted for when copying the data to the destination
+            # using the stride of the vertex format.
+            dest_stride = reg_format.getArray(array_idx).getStride()
+
+            handle = vdata.modify_array(array_idx).modify_handle()
+            handle.unclean_set_num_rows(count)
+
+            end = start + count * stride
+            if stride == size == dest_stride:
+                handle.copy_data_from(buff[start:end])
+            else:
+                src = start
+                dest = 0
+                while src < end:
+                    handle.copySubdataFrom(dest, size, buff[src : src + size])
+                    dest += dest_stride
+                    src += stride
+            handle = None
+
+        # Flip UVs
+        num_uvs = len(
+            {i for i in gltf_primitive["attributes"] if i.startswith("TEXCOORD")}
+        )
+        for i in range(num_uvs):
+            uv_data = GeomVertexRewriter(vdata, InternalName.get_texcoord_name(str(i)))
+
+            while not uv_data.is_at_end():
+                uvs = uv_data.get_data2f()
+                uv_data.set_data2f(uvs[0], 1 - uvs[1])
+
+        if self.compose_cs == CS_yup_right:
+            # Flip morph deltas from Y-up to Z-up.  This is apparently not done by
+            # transform_vertices(), below, so we do it ourselves.
+            for morph_i in range(reg_format.get_num_morphs()):
+                delta_data = GeomVertexRewriter(
+                    vdata, reg_format.get_morph_delta(morph_i)
+                )
+
+                while not delta_data.is_at_end():
+                    data = delta_data.get_data3f()
+                    delta_data.set_data3f(data[0], -data[2], data[1])
+            # Flip tangents from Y-up to Z-up.
+            if "TANGENT" in mesh_attribs:
+                tangent = GeomVertexRewriter(vdata, InternalName.make("tangent"))
+                while not tangent.is_at_end():
+                    data = tangent.get_data4f()
+                    tangent.set_data4f(data[0], -data[2], data[1], data[3])
+
+        if normalize_weights:
+            # The linear sum of all the joint weights must be as close as possible to 1, if the weights are
+            # stored as float.
+            # Some malformed assets do not respect this, hence we are normalizing them here.
+            weights_data = GeomVertexRewriter(
+                vdata, InternalName.get_transform_weight()
             )
+            while not weights_data.is_at_end():
+                weights = weights_data.get_data4f()
+                max_weight = (
+                    abs(weights[0])
+                    + abs(weights[1])
+                    + abs(weights[2])
+                    + abs(weights[3])
+                )
+                if max_weight != 0.0:
+                    weights = weights / max_weight
+                weights_data.set_data4f(weights)
+
+        # Repack mesh data
+        quantized_normals = format_info.quantized_normal_type is not None
+        quantized_normal_type = format_info.quantized_normal_type
+        quantized_tex_coords = format_info.quantized_tex_coords
+        quantized_tex_coords_info = format_info.texcoord_types
+        vdata = vdata.convert_to(format_info.output_format)
 
         geom = Geom(vdata)
         geom.add_primitive(prim)
 
-
         if calc_normals:
             self.calculate_normals(geom)
         elif quantized_normals:
             self.dequantize_normals(geom, quantized_normal_type)
 
         if calc_tangents:
-            self.calculate_tangents(geom)
-            
+            self.calculate_tangents(geom, list(geom.get_primitives()) + list(shared_prims))
+
         # TODO: dequantize tangents (see https://github.com/KhronosGroup/glTF/blob/main/extensions/2.0/Khronos/KHR_mesh_quantization/README.md)
 
         if quantized_tex_coords:
@@ -1584,7 +2383,71 @@ class Converter:
                 self.dequantize_texcoords(geom, column_name, numeric_type)
 
         geom.transform_vertices(self.csxform)
-        geom_node.add_geom(geom, mat)
+
+        if self.settings.keep_quantized:
+            self.pack_vertex_data(geom, format_info)
+        return geom
+
+    def pack_vertex_data(self, geom, format_info):
+        """Store quantized texcoords in their source types again and colors as 8-bit
+
+        The packed texcoords hold unnormalized integers, like the source data,
+        and get dequantized by the texture matrices from
+        add_texcoord_dequantization.  Positions and normals stay float, since
+        Panda3D transforms integer columns without normalizing them when
+        flattening or converting the coordinate system.
+        """
+        packed_columns = []
+        for column_name, numeric_type in format_info.texcoord_types.items():
+            if numeric_type in self._QUANTIZATION_SCALE_MAP:
+                packed_columns.append((InternalName.make(column_name), numeric_type, GeomEnums.C_texcoord))
+        packed_columns.append((InternalName.get_color(), GeomEnums.NT_uint8, GeomEnums.C_color))
+
+        vdata = geom.get_vertex_data()
+        for column_name, numeric_type, contents in packed_columns:
+            column = vdata.get_format().get_column(column_name)
+            values = meshutils.column_array(vdata, column_name)
+            if values is None or column.get_numeric_type() == numeric_type:
+                continue
+
+            # Tangents are already generated, so everything can be packed last
+            values = values.astype(numpy.float64)
+            if column.get_numeric_type() in self._QUANTIZATION_SCALE_MAP:
+                values /= self._QUANTIZATION_SCALE_MAP[column.get_numeric_type()]
+            dtype = meshutils.NUMPY_TYPE_MAP[numeric_type]
+            values = numpy.clip(
+                numpy.round(values * self._QUANTIZATION_SCALE_MAP[numeric_type]),
+                numpy.iinfo(dtype).min,
+                numpy.iinfo(dtype).max,
+            )
+
+            vdata = vdata.replace_column(column_name, column.get_num_components(), numeric_type, contents)
+            meshutils.set_column_array(vdata, column_name, values)
+        geom.set_vertex_data(vdata)
+
+    def add_texcoord_dequantization(self, state, vdata):
+        """Return state with texture matrices dequantizing the integer texcoords of vdata"""
+        scales = {}
+        for column in vdata.get_format().get_columns():
+            if column.get_contents() == GeomEnums.C_texcoord:
+                scale = self._QUANTIZATION_SCALE_MAP.get(column.get_numeric_type())
+                if scale is not None:
+                    scales[column.get_name()] = scale
+
+        tex_attrib = state.get_attrib(TextureAttrib.get_class_type())
+        if not scales or tex_attrib is None:
+            return state
+
+        tex_mat_attrib = state.get_attrib(TexMatrixAttrib.get_class_type()) or TexMatrixAttrib.make()
+        for texstage in tex_attrib.get_on_stages():
+            scale = scales.get(texstage.get_texcoord_name())
+            if scale is not None:
+                # Dequantize before any KHR_texture_transform of the material
+                transform = tex_mat_attrib.get_transform(texstage).compose(
+                    TransformState.make_scale2d(1.0 / scale)
+                )
+                tex_mat_attrib = tex_mat_attrib.add_stage(texstage, transform)
+        return state.set_attrib(tex_mat_attrib)
 
     def calculate_normals(self, geom):
         # Generate flat normals, as required by the glTF spec.
@@ -1661,16 +2524,17 @@ class Converter:
 
         geom.set_vertex_data(new_vertex_data)
 
-    def calculate_tangents(self, geom):
+    def calculate_tangents(self, geom, prims=None):
         # Adapted from https://www.marti.works/calculating-tangents-for-your-mesh/
-        prim = geom.get_primitive(0)
+        if prims is None:
+            prims = geom.get_primitives()
         gvd = geom.get_vertex_data()
         gvd = gvd.replace_column(
             InternalName.get_tangent(), 4, GeomEnums.NT_float32, GeomEnums.C_other
         )
         tangent_writer = GeomVertexWriter(gvd, InternalName.get_tangent())
 
-        primverts = prim.get_vertex_list()
+        primverts = [vert for prim in prims for vert in prim.get_vertex_list()]
         tris = [primverts[i : i + 3] for i in range(0, len(primverts), 3)]
         posdata = self.read_vert_data(gvd, InternalName.get_vertex())
         normaldata = [
@@ -1775,6 +2639,7 @@ class Converter:
         node = self.meshes.get(meshid, GeomNode(mesh_name))
         # Clear any existing mesh data
         node.remove_all_geoms()
+        self._sparse_morph_rows.pop(node, None)
 
         # Load primitives
         for gltf_primitive in gltf_mesh["primitives"]:
@@ -1783,6 +2648,84 @@ class Converter:
         # Save mesh
         self.meshes[meshid] = node
 
+    def get_mesh_lod(self, meshid):
+        """Return a LODNode switching between a mesh and simplified versions of it
+
+        Each level has about half the triangles of the previous one and is
+        shown from twice the distance.  Returns the mesh itself if no LOD
+        levels were requested or it could not be simplified.
+        """
+        mesh = self.meshes[meshid]
+        if self.settings.lod_levels <= 0:
+            return mesh
+        if meshid in self._mesh_lods:
+            return self._mesh_lods[meshid]
+
+        levels = [mesh]
+        while len(levels) <= self.settings.lod_levels:
+            level = self.simplify_mesh(levels[-1], "{}-lod{}".format(mesh.name, len(levels)))
+            if level is None:
+                break
+            levels.append(level)
+
+        lod = mesh
+        if len(levels) > 1:
+            bounds = NodePath(mesh).get_tight_bounds()
+            lod = LODNode("{}-lod".format(mesh.name))
+            lod.set_center((bounds[0] + bounds[1]) / 2)
+            distance = (bounds[1] - bounds[0]).length() / 2 * self._LOD_SWITCH_DISTANCE
+            near = 0.0
+            for level_index, level in enumerate(levels):
+                far = distance * 2 ** level_index if level_index < len(levels) - 1 else float("inf")
+                lod.add_switch(far, near)
+                lod.add_child(level)
+                near = far
+
+        self._mesh_lods[meshid] = lod
+        return lod
+
+    def simplify_mesh(self, mesh, name):
+        """Return a copy of a GeomNode with about half of its triangles
+
+        The simplified geoms share the vertex data of the original ones.
+        Returns None if the triangle count could not be reduced by at least
+        a quarter.
+        """
+        simplified = GeomNode(name)
+        num_triangles = 0
+        num_simplified = 0
+        for geom_index in range(mesh.get_num_geoms()):
+            geom = mesh.get_geom(geom_index).make_copy()
+            vdata = geom.get_vertex_data()
+            positions = meshutils.column_array(vdata, InternalName.get_vertex())
+            canonical_rows = meshutils.duplicate_row_map(vdata)
+            for prim_index in range(geom.get_num_primitives()):
+                prim = geom.get_primitive(prim_index)
+                if positions is None or prim.get_primitive_type() != GeomEnums.PT_polygons:
+                    continue
+                prim = prim.decompose()
+                # Rows with identical contents are interchangeable, so only
+                # actual seams keep the simplifier from collapsing vertices
+                indices = canonical_rows[meshutils.index_array(prim)]
+                num_triangles += len(indices) // 3
+                indices = meshutils.simplify_triangles(indices, positions, len(indices) // 6)
+                num_simplified += len(indices) // 3
+                if self.settings.optimize_meshes:
+                    indices = meshutils.optimize_vertex_cache(indices, vdata.get_num_rows(), positions)
+
+                new_prim = GeomTriangles(prim.get_usage_hint())
+                if prim.is_indexed():
+                    index_type = prim.get_index_type()
+                else:
+                    index_type = meshutils.narrowed_index_type(indices, GeomEnums.NT_uint32)
+                meshutils.set_index_array(new_prim, indices, index_type)
+                geom.set_primitive(prim_index, new_prim)
+            simplified.add_geom(geom, mesh.get_geom_state(geom_index))
+
+        if num_triangles == 0 or num_simplified > num_triangles * 3 // 4:
+            return None
+        return simplified
+
     def read_vert_data(self, gvd, column_name):
         gvr = GeomVertexReader(gvd, column_name)
         data = []
@@ -1799,6 +2742,7 @@ class Converter:
         for bundle in char.bundles:
             bundle.frame_blend_flag = True
 
+        root_nodeids = []
         if nodeid in self.skeletons:
             skinid = self.skeletons[nodeid]
             gltf_skin = gltf_data["skins"][skinid]
@@ -1806,18 +2750,11 @@ class Converter:
             if "skeleton" in gltf_skin:
                 root_nodeids = [gltf_skin["skeleton"]]
             else:
-                # find a common root node
-                joint_nodes = [gltf_data["nodes"][i] for i in gltf_skin["joints"]]
-                child_set = list(
-                    itertools.chain(*[node.get("children", []) for node in joint_nodes])
-                )
-                root_nodeids = [
-                    nodeid for nodeid in gltf_skin["joints"] if nodeid not in child_set
-                ]
+                root_nodeids = self._hierarchy.skin_root_joints[skinid]
 
             jvtmap.update(
                 self.build_character_joints(
-                    char, root_nodeids, affected_nodeids, skinid, gltf_data
+                    char, root_nodeids, affected_nodeids, skinid, gltf_data, charinfo.joints
                 )
             )
 
@@ -1832,46 +2769,200 @@ class Converter:
             anims = [
                 (animid, anim)
                 for animid, anim in enumerate(gltf_data.get("animations", []))
-                if affected_nodeids
-                & {chan["target"]["node"] for chan in anim["channels"]}
+                if not affected_nodeids.isdisjoint(
+                    self.get_animation_index(animid, anim)[1]
+                )
             ]
         else:
             anims = []
 
-        for animid, gltf_anim in anims:
-            anim_name = gltf_anim.get("name", "anim" + str(animid))
+        if not anims:
+            return
 
-            samplers = gltf_anim["samplers"]
-            channels = gltf_anim["channels"]
+        # The layouts and clips only hold names and copied NumPy arrays, so
+        # lazily baked clips do not keep the converter or its buffers alive
+        skeleton_layouts = [
+            self.get_skeleton_layout(root_nodeid, gltf_data) for root_nodeid in root_nodeids
+        ]
+        morph_layouts = self.get_morph_layouts(nodeid, gltf_data, recurse=recurse)
+        cs_mat = numpy.array([list(row) for row in self.csxform.get_upper_3()])
+        clips = [
+            self.get_animation_clip(
+                charinfo, nodeid, root_nodeids, animid, gltf_anim, gltf_data, recurse
+            )
+            for animid, gltf_anim in anims
+        ]
 
-            time_acc_ids = list({i["input"] for i in samplers})
-            time_data = [
-                list(self.get_buffer_from_accessor(gltf_data, accid))
-                for accid in time_acc_ids
+        # Identical clips on identical rigs are only baked once
+        if self.settings.share_animations:
+            keys = [
+                self.get_animation_clip_key(clip, cs_mat, gltf_data, recurse)
+                for clip in clips
             ]
-            max_time = max([max(i) for i in time_data])
-            fps = self.settings.animation_fps
-            num_frames = max(math.ceil(max_time * fps), 1)
-
-            bundle_name = anim_name
-            bundle = AnimBundle(bundle_name, fps, num_frames)
-
-            if nodeid in self.skeletons and any(
-                chan["target"]["path"] != "weights" for chan in channels
-            ):
-                skeleton = AnimGroup(bundle, "<skeleton>")
-                for root_nodeid in root_nodeids:
-                    self.build_animation_skeleton(
-                        char, skeleton, root_nodeid, num_frames, gltf_anim, gltf_data
-                    )
+        else:
+            keys = [None] * len(clips)
+
+        if self.settings.lazy_animations:
+            # Clips are baked when first used through the library
+            clip_bakers = {}
+            for clip, key in zip(clips, keys):
+                cache = self.animation_cache if key is not None else None
+                clip_bakers.setdefault(
+                    clip[0],
+                    functools.partial(
+                        bake_anim_bundle, clip, cs_mat, skeleton_layouts, morph_layouts, cache, key
+                    ),
+                )
+            char.set_python_tag(animlibrary.TAG, animlibrary.AnimationLibrary(clip_bakers))
+            return
+
+        bundles = {}
+        for i, key in enumerate(keys):
+            if key is not None:
+                bundle = self.animation_cache.get(key)
+                if bundle is not None:
+                    bundles[i] = bundle
+        unbaked = [i for i in range(len(clips)) if i not in bundles]
+
+        # Resampling is independent per clip, so it can be spread over worker
+        # processes; the Panda3D objects are only created in this process
+        clip_args = [
+            (frame_times, cs_mat, joint_channels or {}, morph_channels or {})
+            for _, _, frame_times, joint_channels, morph_channels in (clips[i] for i in unbaked)
+        ]
+        num_workers = min(self.settings.animation_workers, len(unbaked))
+        if num_workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+                baked_clips = list(executor.map(bake_animation, *zip(*clip_args)))
+        else:
+            baked_clips = [bake_animation(*args) for args in clip_args]
 
-            if cvsmap and any(chan["target"]["path"] == "weights" for chan in channels):
-                morph = AnimGroup(bundle, "morph")
-                self.build_animation_morph(
-                    morph, nodeid, num_frames, gltf_anim, gltf_data, recurse=recurse
+        for i, (joint_tables, morph_tables) in zip(unbaked, baked_clips):
+            bundles[i] = make_anim_bundle(
+                clips[i], joint_tables, morph_tables, skeleton_layouts, morph_layouts
+            )
+            if keys[i] is not None:
+                self.animation_cache.put(keys[i], bundles[i])
+
+        for i in range(len(clips)):
+            char.add_child(AnimBundleNode(char.name, bundles[i]))
+
+    def get_animation_clip(
+        self, charinfo, nodeid, root_nodeids, animid, gltf_anim, gltf_data, recurse=True
+    ):
+        """Gather what is needed to bake an animation for a character
+
+        Returns the clip name, frame rate, frame times and the channels of
+        its joints and morph targets, which are None if the clip does not
+        animate them.
+        """
+        anim_name = gltf_anim.get("name", "anim" + str(animid))
+
+        samplers = gltf_anim["samplers"]
+        anim_samplers, _ = self.get_animation_index(animid, gltf_anim)
+        paths = {path for _, path in anim_samplers}
+
+        time_data = [
+            self.get_accessor_array(gltf_data, accid).ravel()
+            for accid in {i["input"] for i in samplers}
+        ]
+        max_time = max(times.max() for times in time_data)
+        fps = self.get_animation_fps(
+            time_data,
+            any(i.get("interpolation") == "CUBICSPLINE" for i in samplers),
+        )
+        num_frames = max(math.ceil(max_time * fps), 1)
+        frame_times = numpy.arange(num_frames) / fps
+
+        joint_channels = None
+        if nodeid in self.skeletons and paths - {"weights"}:
+            joint_channels = {}
+            for root_nodeid in root_nodeids:
+                self.get_skeleton_channels(
+                    charinfo.joints, root_nodeid, anim_samplers, gltf_data, joint_channels
                 )
 
-            char.add_child(AnimBundleNode(char.name, bundle))
+        morph_channels = None
+        if charinfo.cvsmap and "weights" in paths:
+            morph_channels = {}
+            self.get_morph_channels(
+                nodeid, anim_samplers, gltf_data, morph_channels, recurse=recurse
+            )
+
+        return anim_name, fps, frame_times, joint_channels, morph_channels
+
+    def get_animation_clip_key(self, clip, cs_mat, gltf_data, recurse=True):
+        """Return a digest of everything that goes into the AnimBundle of a clip
+
+        This covers the names, nesting and rest poses of the joints, the
+        morph targets and the contents of the animation channels, so the same
+        clip on the same rig gets the same key in any character or file.
+        """
+        anim_name, fps, frame_times, joint_channels, morph_channels = clip
+        digest = hashlib.blake2b()
+
+        def add(*values):
+            for value in values:
+                if isinstance(value, numpy.ndarray):
+                    digest.update(f"{value.dtype.str}{value.shape}".encode())
+                    digest.update(numpy.ascontiguousarray(value).tobytes())
+                else:
+                    digest.update(repr(value).encode())
+
+        add(anim_name, fps, len(frame_times), cs_mat, recurse)
+        add(joint_channels is None, morph_channels is None)
+
+        # Joints are in depth first order, so their names and the names of
+        # their children describe the hierarchy
+        for boneid, (channels, defaults) in (joint_channels or {}).items():
+            bone = gltf_data["nodes"][boneid]
+            child_names = [
+                gltf_data["nodes"][childid].get("name", "bone" + str(childid))
+                for childid in bone.get("children", [])
+                if "mesh" not in gltf_data["nodes"][childid]
+            ]
+            add(bone.get("name", "bone" + str(boneid)), child_names, defaults)
+            for path, channel in sorted(channels.items()):
+                add(path, *channel)
+
+        for meshnodeid, (channel, weights) in (morph_channels or {}).items():
+            meshid = gltf_data["nodes"][meshnodeid]["mesh"]
+            target_names = get_extras(gltf_data["meshes"][meshid]).get("targetNames", [])
+            add(meshid, target_names, weights)
+            if channel is not None:
+                add(*channel)
+
+        return digest.digest()
+
+    def get_animation_fps(self, time_data, has_splines=False):
+        """Return the frame rate to resample an animation with the given keyframe times at
+
+        The spacing of spline keyframes says little about the shape of the
+        curve between them, so clips with splines are sampled more densely.
+        """
+        if self.settings.auto_animation_fps:
+            fps = animutils.keyframe_rate(time_data, self._MAX_ANIMATION_FPS)
+            if has_splines:
+                fps = max(fps, self._MIN_SPLINE_ANIMATION_FPS)
+            return fps
+        return self.settings.animation_fps
+
+    def get_animation_index(self, animid, gltf_anim):
+        """Return the samplers of an animation by (node, path) and its set of target nodes
+
+        Like the glTF spec, only the first channel for each target is used.
+        """
+        if animid not in self._animation_indices:
+            anim_samplers = {}
+            for chan in gltf_anim["channels"]:
+                target = chan["target"]
+                if "node" in target:
+                    anim_samplers.setdefault(
+                        (target["node"], target["path"]), gltf_anim["samplers"][chan["sampler"]]
+                    )
+            target_nodes = {nodeid for nodeid, _ in anim_samplers}
+            self._animation_indices[animid] = (anim_samplers, target_nodes)
+        return self._animation_indices[animid]
 
     def combine_mesh_skin(self, geom_node, charinfo):
         jvtmap = charinfo.jvtmap
@@ -1879,8 +2970,15 @@ class Converter:
             return
         jvtmap = collections.OrderedDict(sorted(jvtmap.items()))
 
+        # Geoms may share vertex data, only combine it once
+        combined_vertex_data = {}
         for geom in geom_node.modify_geoms():
+            vertex_data = geom.get_vertex_data()
+            if vertex_data in combined_vertex_data:
+                geom.set_vertex_data(combined_vertex_data[vertex_data])
+                continue
             gvd = geom.modify_vertex_data()
+            combined_vertex_data[vertex_data] = gvd
             tbtable = TransformBlendTable()
             tdata = GeomVertexWriter(gvd, InternalName.get_transform_blend())
 
@@ -1921,32 +3019,44 @@ class Converter:
         cvsmap = charinfo.cvsmap
         if not cvsmap:
             return
-        zero = LVecBase4.zero()
 
-        for geom in geom_node.modify_geoms():
+        # Geoms may share vertex data, only combine it once
+        combined_vertex_data = {}
+        geom_morph_rows = self._sparse_morph_rows.get(geom_node, {})
+        for geom_index, geom in enumerate(geom_node.modify_geoms()):
+            vertex_data = geom.get_vertex_data()
+            if vertex_data in combined_vertex_data:
+                geom.set_vertex_data(combined_vertex_data[vertex_data])
+                continue
             gvd = geom.modify_vertex_data()
+            combined_vertex_data[vertex_data] = gvd
             vformat = gvd.get_format()
 
+            # Scan all morph columns once to figure out which rows are affected
+            # by which slider.  Rows of sparse morph targets are already known.
+            slider_masks = dict(geom_morph_rows.get(geom_index, {}))
+            sparse_names = set(slider_masks)
+            for morph_i in range(vformat.get_num_morphs()):
+                column_name = vformat.get_morph_delta(morph_i)
+                if column_name.basename in sparse_names:
+                    continue
+                deltas = meshutils.column_array(gvd, column_name)
+                if deltas is None:
+                    continue
+                mask = numpy.any(deltas != 0, axis=1)
+                name = column_name.basename
+                if name in slider_masks:
+                    slider_masks[name] |= mask
+                else:
+                    slider_masks[name] = mask
+
             stable = SliderTable()
 
             for (slider_meshid, name), slider in cvsmap.items():
-                if slider_meshid != meshid:
+                if slider_meshid != meshid or name not in slider_masks:
                     continue
 
-                # Iterate through the morph columns to figure out which rows are
-                # affected by which slider.
-                rows = SparseArray()
-
-                for morph_i in range(vformat.get_num_morphs()):
-                    column_name = vformat.get_morph_delta(morph_i)
-                    if column_name.basename == name:
-                        gvr = GeomVertexReader(gvd, vformat.get_morph_delta(morph_i))
-                        row = 0
-                        while not gvr.is_at_end():
-                            if gvr.get_data4() != zero:
-                                rows.set_bit(row)
-                            row += 1
-
+                rows = meshutils.mask_to_sparse_array(slider_masks[name])
                 if not rows.is_zero():
                     stable.add_slider(slider, rows)
 
@@ -1954,9 +3064,14 @@ class Converter:
                 gvd.set_slider_table(SliderTable.register_table(stable))
 
     def build_character_joints(
-        self, char, root_nodeids, affected_nodeids, skinid, gltf_data
+        self, char, root_nodeids, affected_nodeids, skinid, gltf_data, joints
     ):
+        """Create the joints of a skin, returning a map of joint indices to vertex transforms
+
+        The created joints are added to joints by node id.
+        """
         gltf_skin = gltf_data["skins"][skinid]
+        joint_indices = self._hierarchy.skin_joint_indices[skinid]
 
         bundle = char.get_bundle(0)
         skeleton = PartGroup(bundle, "<skeleton>")
@@ -1965,10 +3080,15 @@ class Converter:
         bind_mats = {}
         if "inverseBindMatrices" in gltf_skin:
             ibmacc = gltf_data["accessors"][gltf_skin["inverseBindMatrices"]]
-            ibmbv = gltf_data["bufferViews"][ibmacc["bufferView"]]
-            start = ibmacc.get("byteOffset", 0) + ibmbv.get("byteOffset", 0)
-            end = start + ibmacc["count"] * 16 * 4
-            ibmdata = self.buffers[ibmbv["buffer"]][start:end]
+            if "sparse" in ibmacc or "bufferView" not in ibmacc:
+                ibmdata = self.get_accessor_array(
+                    gltf_data, gltf_skin["inverseBindMatrices"]
+                ).tobytes()
+            else:
+                ibmbv = gltf_data["bufferViews"][ibmacc["bufferView"]]
+                start = ibmacc.get("byteOffset", 0) + ibmbv.get("byteOffset", 0)
+                end = start + ibmacc["count"] * 16 * 4
+                ibmdata = self.buffers[ibmbv["buffer"]][start:end]
 
             for i in range(ibmacc["count"]):
                 mat = struct.unpack_from("<{}".format("f" * 16), ibmdata, i * 16 * 4)
@@ -1987,10 +3107,9 @@ class Converter:
 
             inv_transform = LMatrix4(transform)
             inv_transform.invert_in_place()
-            joint_index = None
+            joint_index = joint_indices.get(nodeid)
             joint_mat = LMatrix4.ident_mat()
-            if nodeid in gltf_skin["joints"]:
-                joint_index = gltf_skin["joints"].index(nodeid)
+            if joint_index is not None:
                 joint_mat = bind_mats.get(joint_index, LMatrix4.ident_mat())
                 self._joint_nodes.add(nodeid)
 
@@ -2003,6 +3122,7 @@ class Converter:
                 node_name,
                 self.csxform_inv * bind_pose * self.csxform,
             )
+            joints[nodeid] = joint
 
             # Non-deforming bones are not in the skin's jointNames, don't add them to the jvtmap
             if joint_index is not None:
@@ -2082,47 +3202,37 @@ class Converter:
         create_slider(root_nodeid)
         return cvsmap
 
-    def build_animation_skeleton(
-        self, character, parent, boneid, num_frames, gltf_anim, gltf_data
-    ):
+    def get_animation_channel(self, sampler, gltf_data, name):
+        """Return the (keyframe times, values, interpolation mode) of an animation sampler"""
+        # Copy the keyframe times, the cached arrays are views of the buffers
+        times = numpy.array(self.get_accessor_array(gltf_data, sampler["input"]).ravel())
+        values = self.get_accessor_array(gltf_data, sampler["output"])
+        values = values.astype(numpy.float64)
+
+        interpolation_mode = sampler.get("interpolation", "LINEAR")
+        if interpolation_mode == "CUBICSPLINE":
+            # Each keyframe holds an in-tangent, a value and an out-tangent
+            values = values.reshape(len(times), 3, -1)
+        elif interpolation_mode in ("STEP", "LINEAR"):
+            values = values.reshape(len(times), -1)
+        else:
+            raise RuntimeError(
+                f"Unrecognized interpolation mode ({interpolation_mode}) found on {name}"
+            )
+        return times, values, interpolation_mode
+
+    def get_skeleton_channels(self, joints, boneid, anim_samplers, gltf_data, joint_channels):
         bone = gltf_data["nodes"][boneid]
         bone_name = bone.get("name", "bone" + str(boneid))
-        channels = [
-            chan for chan in gltf_anim["channels"] if chan["target"]["node"] == boneid
-        ]
-        joint_mat = character.find_joint(bone_name).get_transform()
-
-        group = AnimChannelMatrixXfmTable(parent, bone_name)
-
-        def extract_chan_data(path):
-            samplers = [
-                gltf_anim["samplers"][chan["sampler"]]
-                for chan in channels
-                if chan["target"]["path"] == path
-            ]
-            if not samplers:
-                return None
-            sampler = samplers[0]
-
-            accid = sampler["output"]
-            output_buff = list(self.get_buffer_from_accessor(gltf_data, accid))
-
-            if path == "rotation":
-                output_buff = [
-                    p3d.LQuaternion(x[3], x[0], x[1], x[2]) for x in output_buff
-                ]
-
-            accid = sampler["input"]
-            input_buff = self.get_buffer_from_accessor(gltf_data, accid)
-
-            interpolation_mode = sampler.get("interpolation", "LINEAR")
-            if interpolation_mode == "CUBICSPLINE":
-                print(
-                    f"Warning: CUBICSPLINE interpolation mode for {bone_name}:{path} is not supported, "
-                    "falling back to LINEAR"
+        joint_mat = joints[boneid].get_transform()
+
+        channels = {}
+        for path in ("translation", "rotation", "scale"):
+            sampler = anim_samplers.get((boneid, path))
+            if sampler is not None:
+                channels[path] = self.get_animation_channel(
+                    sampler, gltf_data, f"{bone_name}:{path}"
                 )
-                interpolation_mode = "LINEAR"
-            return list(input_buff), list(output_buff), interpolation_mode
 
         # Create default animaton data
         translation = LVector3()
@@ -2138,174 +3248,59 @@ class Converter:
         rotation = LQuaternion()
         rotation.set_hpr(rotation_vec, CS_yup_right)
 
-        # Override defaults with any found animation data
-        default_anim_data = {
-            "translation": translation,
-            "rotation": rotation,
-            "scale": scale,
-        }
-        anim_data = {
-            path: extract_chan_data(path)
-            for path in ["translation", "rotation", "scale"]
+        # Animation data overrides these defaults
+        defaults = {
+            "translation": tuple(translation),
+            "rotation": (rotation[1], rotation[2], rotation[3], rotation[0]),
+            "scale": tuple(scale),
         }
-
-        loc_vals = [[], [], []]
-        rot_vals = [[], [], []]
-        scale_vals = [[], [], []]
-
-        def calculate_frame_value(frame, path):
-            currtime = frame / self.settings.animation_fps
-            if not anim_data[path]:
-                return default_anim_data[path]
-
-            input_buff, output_buff, interpolation_mode = anim_data[path]
-
-            if len(input_buff) == 1:
-                # no need to interpolate, just return the value
-                return output_buff[0]
-
-            nextidx = get_next_time_index(currtime, input_buff)
-            lastidx = nextidx - 1
-
-            if interpolation_mode == "STEP":
-                return output_buff[lastidx]
-            elif interpolation_mode == "LINEAR":
-                nexttime = input_buff[nextidx]
-                lasttime = input_buff[lastidx]
-                lerpfactor = get_lerp_factor(currtime, lasttime, nexttime)
-
-                if path == "rotation":
-                    return slerp(output_buff[lastidx], output_buff[nextidx], lerpfactor)
-                return vlerp(output_buff[lastidx], output_buff[nextidx], lerpfactor)
-            else:
-                return RuntimeError(
-                    f"Unrecognized interpolation mode ({interpolation_mode}) found on {bone_name}:{path}"
-                )
-
-        for i in range(num_frames):
-            frame_translation = calculate_frame_value(i, "translation")
-            frame_rotation = calculate_frame_value(i, "rotation")
-            frame_scale = calculate_frame_value(i, "scale")
-
-            mat = LMatrix4(LMatrix4.ident_mat())
-            mat *= LMatrix4.scale_mat(frame_scale)
-            mat = frame_rotation * mat
-            mat *= LMatrix4.translate_mat(frame_translation)
-            mat = self.csxform_inv * mat * self.csxform
-
-            frame_translation = LVector3()
-            frame_scale = LVector3()
-            frame_rotation = LVector3()
-            decomposeMatrix(mat, frame_scale, frame_rotation, frame_translation)
-
-            loc_vals[0].append(frame_translation[0])
-            loc_vals[1].append(frame_translation[1])
-            loc_vals[2].append(frame_translation[2])
-            rot_vals[0].append(frame_rotation[0])
-            rot_vals[1].append(frame_rotation[1])
-            rot_vals[2].append(frame_rotation[2])
-            scale_vals[0].append(frame_scale[0])
-            scale_vals[1].append(frame_scale[1])
-            scale_vals[2].append(frame_scale[2])
-
-        # if all values for a given channel are close enough, we can use the first value for
-        # all frames and save some space
-        def almost_equal(val1, val2):
-            return abs(val2 - val1) < 0.00001
-
-        for val_arrays in [loc_vals, rot_vals, scale_vals]:
-            for val_array in val_arrays:
-                if almost_equal(min(val_array), max(val_array)):
-                    val_array[:] = val_array[:1]
-
-        # Write data to tables
-        group.set_table(b"x", CPTA_stdfloat(PTA_stdfloat(loc_vals[0])))
-        group.set_table(b"y", CPTA_stdfloat(PTA_stdfloat(loc_vals[1])))
-        group.set_table(b"z", CPTA_stdfloat(PTA_stdfloat(loc_vals[2])))
-
-        group.set_table(b"h", CPTA_stdfloat(PTA_stdfloat(rot_vals[0])))
-        group.set_table(b"p", CPTA_stdfloat(PTA_stdfloat(rot_vals[1])))
-        group.set_table(b"r", CPTA_stdfloat(PTA_stdfloat(rot_vals[2])))
-
-        group.set_table(b"i", CPTA_stdfloat(PTA_stdfloat(scale_vals[0])))
-        group.set_table(b"j", CPTA_stdfloat(PTA_stdfloat(scale_vals[1])))
-        group.set_table(b"k", CPTA_stdfloat(PTA_stdfloat(scale_vals[2])))
+        joint_channels[boneid] = (channels, defaults)
 
         for childid in bone.get("children", []):
             gltf_node = gltf_data["nodes"][childid]
             if "mesh" in gltf_node:
                 continue
-            self.build_animation_skeleton(
-                character, group, childid, num_frames, gltf_anim, gltf_data
-            )
+            self.get_skeleton_channels(joints, childid, anim_samplers, gltf_data, joint_channels)
 
-    def build_animation_morph(
-        self, parent, nodeid, num_frames, gltf_anim, gltf_data, recurse=True
-    ):
-        def create_channels(parent, nodeid, target_names, default_weights):
-            channels = [
-                chan
-                for chan in gltf_anim["channels"]
-                if chan["target"]["node"] == nodeid
-                and chan["target"]["path"] == "weights"
-            ]
+    def get_skeleton_layout(self, boneid, gltf_data):
+        """Return the (bone name, node id, child layouts) of a bone and the bones below it"""
+        bone = gltf_data["nodes"][boneid]
+        bone_name = bone.get("name", "bone" + str(boneid))
+        child_layouts = [
+            self.get_skeleton_layout(childid, gltf_data)
+            for childid in bone.get("children", [])
+            if "mesh" not in gltf_data["nodes"][childid]
+        ]
+        return bone_name, boneid, child_layouts
 
-            samplers = [
-                gltf_anim["samplers"][chan["sampler"]]
-                for chan in channels
-                if chan["target"]["path"] == "weights"
-            ]
+    def get_morph_channels(self, nodeid, anim_samplers, gltf_data, morph_channels, recurse=True):
+        gltf_node = gltf_data["nodes"][nodeid]
 
-            if samplers:
-                sampler = samplers[0]
-                buff_data = self.get_buffer_from_accessor(gltf_data, sampler["output"])
-                weights = list(CPTAFloat(buff_data))
-                time_data = self.get_buffer_from_accessor(gltf_data, sampler["input"])
-                interpolation_mode = sampler.get("interpolation", "LINEAR")
-                if interpolation_mode == "CUBICSPLINE":
-                    print(
-                        "Warning: CUBICSPLINE interpolation mode for morph targets is not supported, "
-                        "falling back to LINEAR"
+        if "mesh" in gltf_node:
+            weights = gltf_data["meshes"][gltf_node["mesh"]].get("weights")
+            if weights:
+                channel = None
+                sampler = anim_samplers.get((nodeid, "weights"))
+                if sampler is not None:
+                    channel = self.get_animation_channel(
+                        sampler, gltf_data, f"node {nodeid}:weights"
                     )
-                    interpolation_mode = "LINEAR"
-            else:
-                weights = default_weights
-                time_data = [0]
-                interpolation_mode = "STEP"
+                    # Keyframes hold (or, for splines, end with) one weight per target
+                    times, values, interpolation_mode = channel
+                    values = values.reshape(len(times), -1, len(weights))
+                    if interpolation_mode != "CUBICSPLINE":
+                        values = values[:, 0]
+                    channel = (times, values, interpolation_mode)
+                morph_channels[nodeid] = (channel, list(weights))
 
-            num_targets = len(default_weights)
-
-            for i, target_name in enumerate(target_names):
-                group = AnimChannelScalarTable(parent, target_name)
-
-                target_weights = weights[i::num_targets]
-                interpolated_weights = []
-
-                if len(time_data) == 1 or min(target_weights) == max(target_weights):
-                    # If all frames are the same, we only need to store one frame.
-                    interpolated_weights = target_weights[:1]
-                else:
-                    for frame in range(num_frames):
-                        currtime = frame / self.settings.animation_fps
-                        nextidx = get_next_time_index(currtime, time_data)
-                        lastidx = nextidx - 1
-                        if interpolation_mode == "STEP":
-                            interpolated_weights.append(target_weights[lastidx])
-                        elif interpolation_mode == "LINEAR":
-                            lasttime = time_data[lastidx]
-                            nexttime = time_data[nextidx]
-                            lerpfactor = get_lerp_factor(currtime, lasttime, nexttime)
-                            interpolated_weights.append(
-                                target_weights[lastidx] * (1 - lerpfactor)
-                                + target_weights[nextidx] * lerpfactor
-                            )
-                        else:
-                            return RuntimeError(
-                                f"Unrecognized interpolation mode ({interpolation_mode}) found on {target_name}"
-                            )
-
-                group.set_table(CPTA_stdfloat(interpolated_weights))
+        if recurse:
+            for child in gltf_node.get("children", []):
+                self.get_morph_channels(child, anim_samplers, gltf_data, morph_channels)
 
+    def get_morph_layouts(self, nodeid, gltf_data, recurse=True, layouts=None):
+        """Return the (group name, node id, target names) of the morphed meshes under a node"""
+        if layouts is None:
+            layouts = []
         gltf_node = gltf_data["nodes"][nodeid]
 
         if "mesh" in gltf_node:
@@ -2313,7 +3308,7 @@ class Converter:
             gltf_mesh = gltf_data["meshes"][meshid]
             weights = gltf_mesh.get("weights")
             if weights:
-                target_names = get_extras(gltf_mesh).get("targetNames", [])
+                target_names = list(get_extras(gltf_mesh).get("targetNames", []))
                 if len(target_names) < len(weights):
                     target_names += [
                         str(i) for i in range(len(target_names), len(weights))
@@ -2324,18 +3319,13 @@ class Converter:
                 # If we do this recursively, group the sliders for each mesh
                 # under a group for their respective mesh, so that the names will
                 # not conflict.
-                if recurse:
-                    group = AnimGroup(parent, "mesh" + str(meshid))
-                else:
-                    group = parent
-
-                create_channels(group, nodeid, target_names, weights)
+                group_name = "mesh" + str(meshid) if recurse else None
+                layouts.append((group_name, nodeid, target_names))
 
         if recurse:
             for child in gltf_node.get("children", []):
-                self.build_animation_morph(
-                    parent, child, num_frames, gltf_anim, gltf_data
-                )
+                self.get_morph_layouts(child, gltf_data, layouts=layouts)
+        return layouts
 
     def load_camera(self, camid, gltf_camera):
         camname = gltf_camera.get("name", "cam" + str(camid))
@@ -3,13 +3,28 @@ import dataclasses
 import panda3d.core as p3d
 
 from ._converter import GltfSettings, Converter
+from .animlibrary import AnimationCache
 from .parseutils import parse_gltf_file
 from .exceptions import UnsupportedExtensionExeption
 
 
-def load_model(file_path, gltf_settings=None):
-    """Load a glTF file from file_path and return a ModelRoot"""
-    converter = Converter(file_path, settings=gltf_settings)
+_animation_cache = AnimationCache()
+
+
+def get_animation_cache():
+    """Return the AnimationCache shared by the files loaded with share_animations"""
+    return _animation_cache
+
+
+def load_model(file_path, gltf_settings=None, animation_cache=None):
+    """Load a glTF file from file_path and return a ModelRoot
+
+    With share_animations, bundles are shared through animation_cache, or
+    the cache of get_animation_cache() if it is None.
+    """
+    if animation_cache is None:
+        animation_cache = _animation_cache
+    converter = Converter(file_path, settings=gltf_settings, animation_cache=animation_cache)
     gltf_data = parse_gltf_file(file_path)
 
     check_extension_support(gltf_data)
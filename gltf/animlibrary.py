@@ -0,0 +1,154 @@
+import collections
+import json
+import os
+import threading
+
+import panda3d.core as p3d
+
+
+TAG = "gltf-animation-library"
+
+
+class AnimationCache:
+    """A thread-safe LRU cache of baked AnimBundles by content key
+
+    Converters with share_animations reuse bundles from their cache instead
+    of baking identical clips again.  Pass the same cache to several
+    Converters to share bundles between the files they convert.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._bundles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bundles)
+
+    def get(self, key):
+        """Return the bundle stored for key, or None"""
+        with self._lock:
+            bundle = self._bundles.get(key)
+            if bundle is not None:
+                self._bundles.move_to_end(key)
+            return bundle
+
+    def put(self, key, bundle):
+        """Store a bundle, dropping the least recently used ones beyond max_size"""
+        with self._lock:
+            self._bundles[key] = bundle
+            self._bundles.move_to_end(key)
+            while len(self._bundles) > self.max_size:
+                self._bundles.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._bundles.clear()
+
+
+class AnimationLibrary:
+    """The animation clips of a character, baked or loaded only when first used
+
+    clips maps clip names to either a function returning an AnimBundle or
+    the Filename of a BAM file holding an AnimBundleNode.
+    """
+
+    def __init__(self, clips):
+        self._clips = dict(clips)
+        self._bundles = {}
+
+    def __len__(self):
+        return len(self._clips)
+
+    def __iter__(self):
+        return iter(self._clips)
+
+    def __contains__(self, name):
+        return name in self._clips
+
+    def is_loaded(self, name):
+        return name in self._bundles
+
+    def get_bundle(self, name):
+        """Return the AnimBundle of a clip, baking or loading it on first use"""
+        if name not in self._bundles:
+            self._bundles[name] = self._load_bundle(name)
+        return self._bundles[name]
+
+    def bind(self, character, name, subset=None):
+        """Bind a clip to a Character (node or NodePath) and return its AnimControl"""
+        if isinstance(character, p3d.NodePath):
+            character = character.node()
+        return character.get_bundle(0).bind_anim(
+            self.get_bundle(name),
+            p3d.PartGroup.HMF_ok_wrong_root_name,
+            subset if subset is not None else p3d.PartSubset(),
+        )
+
+    def write(self, dirname):
+        """Write each clip to a BAM file in dirname along with an index.json manifest
+
+        Clips that have not been used are baked one at a time and not kept.
+        Returns the Filename of the manifest.
+        """
+        dirname = p3d.Filename(dirname)
+        os.makedirs(dirname.to_os_specific(), exist_ok=True)
+        filenames = {}
+        for index, name in enumerate(self._clips):
+            bundle = self._bundles.get(name) or self._load_bundle(name)
+            filenames[name] = f"{index}.bam"
+            p3d.NodePath(p3d.AnimBundleNode(name, bundle)).write_bam_file(
+                p3d.Filename(dirname, filenames[name])
+            )
+
+        manifest = p3d.Filename(dirname, "index.json")
+        with open(manifest.to_os_specific(), "w", encoding="utf8") as manifest_file:
+            json.dump({"clips": filenames}, manifest_file, indent=4)
+        return manifest
+
+    @classmethod
+    def read(cls, manifest):
+        """Create a library from a manifest written by write(), clips are loaded when first used"""
+        manifest = p3d.Filename(manifest)
+        with open(manifest.to_os_specific(), encoding="utf8") as manifest_file:
+            filenames = json.load(manifest_file)["clips"]
+        return cls({
+            name: p3d.Filename(manifest.get_dirname(), filename)
+            for name, filename in filenames.items()
+        })
+
+    def _load_bundle(self, name):
+        clip = self._clips[name]
+        if not isinstance(clip, p3d.Filename):
+            return clip()
+
+        node = p3d.Loader.get_global_ptr().load_sync(clip)
+        if node is None:
+            raise RuntimeError(f"Failed to load animation {name} from {clip}")
+        nodepath = p3d.NodePath(node)
+        if not node.is_of_type(p3d.AnimBundleNode):
+            nodepath = nodepath.find("**/+AnimBundleNode")
+        return nodepath.node().get_bundle()
+
+
+def load_animation_library(character):
+    """Return the AnimationLibrary of a Character (node or NodePath)
+
+    This is the library created when converting with lazy_animations, or the
+    one written next to a BAM file by the CLI, in which case its manifest is
+    looked up relative to the model file and the model path.  Returns None
+    if the character has no library.
+    """
+    nodepath = character if isinstance(character, p3d.NodePath) else p3d.NodePath(character)
+    library = nodepath.get_python_tag(TAG)
+    if library is None and nodepath.has_tag(TAG):
+        manifest = p3d.Filename(nodepath.get_tag(TAG))
+        search_path = p3d.DSearchPath(p3d.get_model_path().get_value())
+        for ancestor in nodepath.get_ancestors():
+            if ancestor.node().is_of_type(p3d.ModelRoot) and ancestor.node().fullpath:
+                search_path.prepend_directory(ancestor.node().fullpath.get_dirname())
+                break
+        p3d.VirtualFileSystem.get_global_ptr().resolve_filename(manifest, search_path)
+        library = AnimationLibrary.read(manifest)
+        nodepath.set_python_tag(TAG, library)
+    return library
@@ -0,0 +1,111 @@
+import numpy
+
+
+def keyframe_rate(time_data, max_rate):
+    """Estimate the frame rate keyframes were sampled at from their median spacing
+
+    time_data holds one array of keyframe times per sampler.  The result is
+    rounded to a whole number of frames per second between 1 and max_rate.
+    """
+    intervals = numpy.concatenate([numpy.diff(times) for times in time_data])
+    intervals = intervals[intervals > 0]
+    if len(intervals) == 0:
+        return 1
+    return int(min(max(round(1.0 / float(numpy.median(intervals))), 1), max_rate))
+
+
+def frame_segments(times, frame_times):
+    """Find the keyframes surrounding each frame time
+
+    Returns the index of the keyframe at or before each frame time, clamped
+    so that the next keyframe exists, and the factor to blend towards that
+    next keyframe.  Frame times outside of the keyframes hold the first or
+    last value.
+    """
+    last_indices = numpy.searchsorted(times, frame_times, side="right") - 1
+    last_indices = numpy.clip(last_indices, 0, len(times) - 2)
+    last_times = times[last_indices]
+    durations = times[last_indices + 1] - last_times
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        factors = numpy.where(durations > 0, (frame_times - last_times) / durations, 1.0)
+    return last_indices, numpy.clip(factors, 0.0, 1.0)
+
+
+def sample_step(times, values, frame_times):
+    """Sample (keyframes, components) values without interpolation"""
+    indices = numpy.searchsorted(times, frame_times, side="right") - 1
+    return values[numpy.clip(indices, 0, len(times) - 1)]
+
+
+def sample_linear(times, values, frame_times):
+    """Sample (keyframes, components) values with linear interpolation"""
+    if len(times) == 1:
+        return numpy.repeat(values[:1], len(frame_times), axis=0)
+
+    indices, factors = frame_segments(times, frame_times)
+    factors = factors[:, None]
+    return values[indices] * (1.0 - factors) + values[indices + 1] * factors
+
+
+def sample_slerp(times, quats, frame_times):
+    """Sample (keyframes, 4) quaternions with spherical linear interpolation"""
+    if len(times) == 1:
+        return numpy.repeat(quats[:1], len(frame_times), axis=0)
+
+    indices, factors = frame_segments(times, frame_times)
+    quata = quats[indices]
+    quatb = quats[indices + 1]
+
+    # Take the shortest path
+    dots = numpy.sum(quata * quatb, axis=1)
+    quata = numpy.where((dots < 0.0)[:, None], -quata, quata)
+    dots = numpy.abs(dots)
+
+    theta0 = numpy.arccos(numpy.minimum(dots, 1.0))
+    theta = factors * theta0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        scale_quatb = numpy.sin(theta) / numpy.sin(theta0)
+    scale_quata = numpy.cos(theta) - dots * scale_quatb
+
+    # Close quaternions are just lerped
+    close = dots > 0.9995
+    scale_quata = numpy.where(close, 1.0 - factors, scale_quata)
+    scale_quatb = numpy.where(close, factors, scale_quatb)
+    return quata * scale_quata[:, None] + quatb * scale_quatb[:, None]
+
+
+def sample_cubic_spline(times, splines, frame_times):
+    """Sample (keyframes, 3, components) in-tangents, values and out-tangents as cubic Hermite splines"""
+    if len(times) == 1:
+        return numpy.repeat(splines[:1, 1], len(frame_times), axis=0)
+
+    indices, factors = frame_segments(times, frame_times)
+    durations = (times[indices + 1] - times[indices])[:, None]
+    factors = factors[:, None]
+    factors2 = factors * factors
+    factors3 = factors2 * factors
+    return (
+        (2 * factors3 - 3 * factors2 + 1) * splines[indices, 1]
+        + (factors3 - 2 * factors2 + factors) * durations * splines[indices, 2]
+        + (-2 * factors3 + 3 * factors2) * splines[indices + 1, 1]
+        + (factors3 - factors2) * durations * splines[indices + 1, 0]
+    )
+
+
+def quat_to_matrices(quats):
+    """Convert (n, 4) x, y, z, w quaternions to (n, 3, 3) row-vector rotation matrices"""
+    quats = quats / numpy.linalg.norm(quats, axis=1, keepdims=True)
+    x, y, z, w = quats.T
+    return numpy.stack([
+        numpy.stack([1 - 2 * (y * y + z * z), 2 * (x * y + w * z), 2 * (x * z - w * y)], axis=1),
+        numpy.stack([2 * (x * y - w * z), 1 - 2 * (x * x + z * z), 2 * (y * z + w * x)], axis=1),
+        numpy.stack([2 * (x * z + w * y), 2 * (y * z - w * x), 1 - 2 * (x * x + y * y)], axis=1),
+    ], axis=1)
+
+
+def matrices_to_hpr(mats):
+    """Extract Z-up heading, pitch and roll in degrees from (n, 3, 3) rotation matrices"""
+    heading = numpy.arctan2(-mats[:, 1, 0], mats[:, 1, 1])
+    pitch = numpy.arctan2(mats[:, 1, 2], numpy.hypot(mats[:, 1, 0], mats[:, 1, 1]))
+    roll = numpy.arctan2(-mats[:, 0, 2], mats[:, 2, 2])
+    return numpy.degrees(numpy.stack([heading, pitch, roll], axis=1))
@@ -1,15 +1,43 @@
 import argparse
 import os
+import re
 import shutil
 
 import panda3d.core as p3d
 
 from . import GltfSettings
+from . import animlibrary
 from ._converter import Converter
 from .version import __version__
 from .parseutils import parse_gltf_file
 
 
+def animation_fps(value):
+    if value.lower() == 'auto':
+        return 'auto'
+    try:
+        fps = float(value)
+    except ValueError:
+        fps = 0
+    if not 0 < fps < float('inf'):
+        raise argparse.ArgumentTypeError(
+            'expected a positive frame rate or "auto", got {!r}'.format(value)
+        )
+    return int(fps) if fps.is_integer() else fps
+
+
+def library_dirname(name, taken):
+    """Return a file name made from a character name that is not in taken, and add it there"""
+    base = re.sub(r'[^\w.-]', '_', name).lstrip('.') or 'character'
+    dirname = base
+    suffix = 1
+    while dirname.lower() in taken:
+        suffix += 1
+        dirname = f'{base}_{suffix}'
+    taken.add(dirname.lower())
+    return dirname
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='CLI tool to convert glTF files to Panda3D BAM files',
@@ -83,6 +111,7 @@ def main():
         '--animations',
         choices=[
             'embed',
+            'library',
             'separate',
             'skip',
         ],
@@ -90,12 +119,88 @@ def main():
         help='control what to do with animation data'
     )
 
+    parser.add_argument(
+        '--animation-fps',
+        type=animation_fps,
+        default=30,
+        help='frame rate to resample animations at, or "auto" to pick one per animation from its keyframe times'
+    )
+
+    parser.add_argument(
+        '--animation-workers',
+        type=int,
+        default=0,
+        help='number of worker processes to resample animations in (0 or 1 resamples them in the converting process)'
+    )
+
+    parser.add_argument(
+        '--share-animations',
+        action='store_true',
+        help='bake identical animations on identical skeletons once and share them between characters'
+    )
+
     parser.add_argument(
         '--flatten-nodes',
         action='store_true',
         help='attempt to flatten resulting node structure'
     )
 
+    parser.add_argument(
+        '--collapse-empty-nodes',
+        action='store_true',
+        help='fold the transforms of empty single-child nodes into their child'
+    )
+
+    parser.add_argument(
+        '--dedupe-geometry',
+        action='store_true',
+        help='share identical geometry between meshes'
+    )
+
+    parser.add_argument(
+        '--compact-indices',
+        action='store_true',
+        help='use the smallest index type and remove unused vertices'
+    )
+
+    parser.add_argument(
+        '--optimize-meshes',
+        action='store_true',
+        help='reorder triangles and vertices for GPU vertex cache reuse'
+    )
+
+    parser.add_argument(
+        '--lod-levels',
+        type=int,
+        default=0,
+        help='number of simplified levels of detail to generate per mesh'
+    )
+
+    parser.add_argument(
+        '--max-geom-triangles',
+        type=int,
+        default=0,
+        help='split static primitives with more triangles than this into spatial chunks (0 disables splitting)'
+    )
+
+    parser.add_argument(
+        '--weld-vertices',
+        action='store_true',
+        help='merge identical vertices and index non-indexed primitives'
+    )
+
+    parser.add_argument(
+        '--keep-quantized',
+        action='store_true',
+        help='keep quantized texture coordinates and pack vertex colors to 8-bit'
+    )
+
+    parser.add_argument(
+        '--sparse-morph-targets',
+        action='store_true',
+        help='take the vertices affected by sparse morph targets from their sparse indices'
+    )
+
     args = parser.parse_args()
 
     settings = GltfSettings(
@@ -104,7 +209,21 @@ def main():
         no_srgb=args.no_srgb,
         legacy_materials=args.legacy_materials,
         skip_animations=args.animations == 'skip',
+        lazy_animations=args.animations == 'library',
+        animation_fps=30 if args.animation_fps == 'auto' else args.animation_fps,
+        auto_animation_fps=args.animation_fps == 'auto',
+        animation_workers=args.animation_workers,
         flatten_nodes=args.flatten_nodes,
+        collapse_empty_nodes=args.collapse_empty_nodes,
+        dedupe_geometry=args.dedupe_geometry,
+        compact_indices=args.compact_indices,
+        optimize_meshes=args.optimize_meshes,
+        lod_levels=args.lod_levels,
+        max_geom_triangles=args.max_geom_triangles,
+        weld_vertices=args.weld_vertices,
+        keep_quantized=args.keep_quantized,
+        sparse_morph_targets=args.sparse_morph_targets,
+        share_animations=args.share_animations,
     )
 
     src = p3d.Filename.from_os_specific(args.src)
@@ -152,6 +271,21 @@ def main():
                 + dst.get_extension()
             bundlenode.write_bam_file(anim_dst)
 
+    if args.animations == 'library':
+        # Each character gets a directory of clips with a manifest, which
+        # is found through a tag on the character when loading it
+        libdir = dst.get_fullpath_wo_extension() + '_anims'
+        libnames = set()
+        for charnp in converter.active_scene.find_all_matches('**/+Character'):
+            library = animlibrary.load_animation_library(charnp)
+            if library is None:
+                continue
+            libname = library_dirname(charnp.name, libnames)
+            manifest = library.write(p3d.Filename(libdir, libname))
+            manifest.make_relative_to(outdir)
+            charnp.clear_python_tag(animlibrary.TAG)
+            charnp.set_tag(animlibrary.TAG, manifest.get_fullpath())
+
     converter.active_scene.write_bam_file(dst)
 
 
@@ -0,0 +1,572 @@
+import collections
+import hashlib
+import heapq
+
+import numpy
+
+from panda3d.core import (
+    GeomEnums,
+    GeomVertexData,
+    SparseArray,
+)
+
+
+NUMPY_TYPE_MAP = {
+    GeomEnums.NT_int8: numpy.int8,
+    GeomEnums.NT_uint8: numpy.uint8,
+    GeomEnums.NT_int16: numpy.int16,
+    GeomEnums.NT_uint16: numpy.uint16,
+    GeomEnums.NT_int32: numpy.int32,
+    GeomEnums.NT_uint32: numpy.uint32,
+    GeomEnums.NT_float32: numpy.float32,
+    GeomEnums.NT_float64: numpy.float64,
+}
+
+
+def array_rows(array_data):
+    """Return the raw rows of a vertex array as a read-only (rows, stride) uint8 array"""
+    num_rows = array_data.get_num_rows()
+    stride = array_data.get_array_format().get_stride()
+    if num_rows == 0:
+        return numpy.zeros((0, stride), dtype=numpy.uint8)
+
+    if memoryview(array_data).c_contiguous:
+        raw = numpy.frombuffer(array_data, dtype=numpy.uint8)
+    else:
+        # Arrays with padding after their columns only expose a strided view
+        raw = numpy.frombuffer(array_data.get_handle().get_data(), dtype=numpy.uint8)
+    return raw.reshape(num_rows, stride)
+
+
+def column_array(gvd, column_name):
+    """Return a read-only (rows, components) NumPy view of a vertex column
+
+    Returns None if the column does not exist or uses a packed numeric type.
+    """
+    vformat = gvd.get_format()
+    array_index = vformat.get_array_with(column_name)
+    if array_index < 0:
+        return None
+
+    column = vformat.get_column(column_name)
+    numeric_type = column.get_numeric_type()
+    if numeric_type == GeomEnums.NT_stdfloat:
+        numeric_type = GeomEnums.NT_float32 if column.get_component_bytes() == 4 else GeomEnums.NT_float64
+    if numeric_type not in NUMPY_TYPE_MAP:
+        return None
+
+    dtype = numpy.dtype(NUMPY_TYPE_MAP[numeric_type])
+    num_rows = gvd.get_num_rows()
+    num_components = column.get_num_components()
+    if num_rows == 0:
+        return numpy.zeros((0, num_components), dtype=dtype)
+
+    raw = array_rows(gvd.get_array(array_index))
+    return numpy.ndarray(
+        (num_rows, num_components),
+        dtype=dtype,
+        buffer=raw,
+        offset=column.get_start(),
+        strides=(raw.strides[0], dtype.itemsize),
+    )
+
+
+def set_column_array(gvd, column_name, values):
+    """Overwrite the values of a vertex column with a (rows, components) array"""
+    vformat = gvd.get_format()
+    array_index = vformat.get_array_with(column_name)
+    column = vformat.get_column(column_name)
+    dtype = numpy.dtype(NUMPY_TYPE_MAP[column.get_numeric_type()])
+
+    rows = array_rows(gvd.get_array(array_index)).copy()
+    view = numpy.ndarray(
+        (len(rows), column.get_num_components()),
+        dtype=dtype,
+        buffer=rows,
+        offset=column.get_start(),
+        strides=(rows.strides[0], dtype.itemsize),
+    )
+    view[:] = values
+    gvd.modify_array(array_index).modify_handle().copy_data_from(rows)
+
+
+def index_array(prim):
+    """Return the vertex indices of a primitive as a NumPy array"""
+    if not prim.is_indexed():
+        first = prim.get_first_vertex()
+        return numpy.arange(first, first + prim.get_num_vertices(), dtype=numpy.uint32)
+
+    dtype = NUMPY_TYPE_MAP[prim.get_index_type()]
+    if prim.get_num_vertices() == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.frombuffer(prim.get_vertices(), dtype=dtype)
+
+
+def narrowed_index_type(indices, index_type):
+    """Return the smallest index type that can hold indices, but not wider than index_type"""
+    if index_type == GeomEnums.NT_uint8:
+        return index_type
+
+    # 8-bit indices are emulated by many drivers, so don't go below 16 bits.
+    # The largest value of each index type is reserved as strip-cut index.
+    max_index = int(indices.max()) if len(indices) else 0
+    if max_index < 0xffff:
+        return GeomEnums.NT_uint16
+    return index_type
+
+
+def set_index_array(prim, indices, index_type):
+    """Replace the vertex indices of a primitive"""
+    prim.set_index_type(index_type)
+    handle = prim.modify_vertices(len(indices)).modify_handle()
+    handle.unclean_set_num_rows(len(indices))
+    handle.copy_data_from(numpy.ascontiguousarray(indices, dtype=NUMPY_TYPE_MAP[index_type]))
+
+
+def select_vertex_rows(gvd, rows):
+    """Return a copy of gvd that only holds the given rows, in the given order"""
+    selected = GeomVertexData(gvd)
+    selected.unclean_set_num_rows(len(rows))
+    for array_index, array_data in enumerate(gvd.get_arrays()):
+        selected.modify_array(array_index).modify_handle().copy_data_from(
+            numpy.ascontiguousarray(array_rows(array_data)[rows])
+        )
+    return selected
+
+
+def duplicate_row_map(gvd):
+    """Map every row of gvd to the first row with identical contents in all arrays"""
+    num_rows = gvd.get_num_rows()
+    if num_rows == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    rows = numpy.ascontiguousarray(
+        numpy.concatenate([array_rows(array_data) for array_data in gvd.get_arrays()], axis=1)
+    )
+    rows = rows.view(numpy.dtype((numpy.void, rows.shape[1]))).ravel()
+    _, first, inverse = numpy.unique(rows, return_index=True, return_inverse=True)
+    return first[inverse.ravel()]
+
+
+def weld_vertex_data(gvd):
+    """Merge the rows of gvd that have identical contents in all arrays
+
+    Returns the welded vertex data and an array mapping old row indices to
+    new ones, or (gvd, None) if there are no duplicate rows.
+    """
+    canonical_rows = duplicate_row_map(gvd)
+    unique = canonical_rows == numpy.arange(len(canonical_rows))
+    if unique.all():
+        return gvd, None
+
+    remap = (numpy.cumsum(unique) - 1).astype(numpy.uint32)[canonical_rows]
+    return select_vertex_rows(gvd, numpy.flatnonzero(unique)), remap
+
+
+def compact_vertex_data(gvd, index_arrays):
+    """Remove the rows of gvd not referenced by any of the index arrays
+
+    Returns the compacted vertex data and an array mapping old row indices to
+    new ones, or (gvd, None) if every row is referenced.
+    """
+    num_rows = gvd.get_num_rows()
+    used = numpy.zeros(num_rows, dtype=bool)
+    for indices in index_arrays:
+        used[indices] = True
+    if used.all():
+        return gvd, None
+
+    remap = (numpy.cumsum(used) - 1).astype(numpy.uint32)
+    return select_vertex_rows(gvd, numpy.flatnonzero(used)), remap
+
+
+def reorder_vertex_data(gvd, index_arrays):
+    """Reorder the rows of gvd by their first use in the index arrays
+
+    Rows that are not referenced are kept at the end.  Returns the reordered
+    vertex data and an array mapping old row indices to new ones.
+    """
+    num_rows = gvd.get_num_rows()
+    indices = numpy.concatenate(index_arrays) if index_arrays else numpy.zeros(0, numpy.uint32)
+    used_rows, first_use = numpy.unique(indices, return_index=True)
+    used_rows = used_rows[numpy.argsort(first_use, kind="stable")]
+    unused_rows = numpy.setdiff1d(numpy.arange(num_rows), used_rows, assume_unique=True)
+    rows = numpy.concatenate([used_rows, unused_rows]).astype(numpy.int64)
+
+    remap = numpy.empty(num_rows, dtype=numpy.uint32)
+    remap[rows] = numpy.arange(num_rows, dtype=numpy.uint32)
+    return select_vertex_rows(gvd, rows), remap
+
+
+def average_cache_miss_ratio(indices, cache_size=16):
+    """Return the ACMR of a triangle list for a FIFO post-transform vertex cache"""
+    cache = collections.deque()
+    cached = set()
+    misses = 0
+    for index in numpy.asarray(indices).tolist():
+        if index in cached:
+            continue
+        misses += 1
+        if len(cache) == cache_size:
+            cached.discard(cache.popleft())
+        cache.append(index)
+        cached.add(index)
+    return misses / max(len(indices) // 3, 1)
+
+
+def optimize_vertex_cache(indices, num_vertices, positions=None, cache_size=16):
+    """Reorder a triangle list for post-transform vertex cache reuse
+
+    This implements Tipsify (Sander, Nehab and Barczak, "Fast Triangle
+    Reordering for Vertex Locality and Reduced Overdraw", 2007).  If positions
+    are given, the resulting clusters of triangles are also sorted so that
+    outward facing clusters are drawn first to reduce overdraw.
+
+    The adjacency tables are built with NumPy, but the fan walk visits the
+    triangles one at a time in Python, which takes a few microseconds per
+    triangle.
+    """
+    triangles = numpy.asarray(indices, dtype=numpy.int64).reshape(-1, 3)
+    num_triangles = len(triangles)
+    if num_triangles == 0:
+        return numpy.asarray(indices)
+
+    # Build a vertex to triangle adjacency table
+    corners = triangles.ravel()
+    use_counts = numpy.bincount(corners, minlength=num_vertices)
+    offsets = numpy.concatenate(([0], numpy.cumsum(use_counts))).tolist()
+    adjacency = (numpy.argsort(corners, kind="stable") // 3).tolist()
+
+    triangle_list = triangles.tolist()
+    live_counts = use_counts.tolist()
+    timestamps = [0] * len(live_counts)
+    emitted = [False] * num_triangles
+    dead_ends = []
+    output = []
+    cluster_starts = [0]
+    time = cache_size + 1
+    cursor = 0
+    fan_vertex = int(corners[0])
+
+    while fan_vertex >= 0:
+        candidates = []
+        for triangle in adjacency[offsets[fan_vertex]:offsets[fan_vertex + 1]]:
+            if emitted[triangle]:
+                continue
+            emitted[triangle] = True
+            output.append(triangle)
+            for vertex in triangle_list[triangle]:
+                dead_ends.append(vertex)
+                candidates.append(vertex)
+                live_counts[vertex] -= 1
+                if time - timestamps[vertex] > cache_size:
+                    timestamps[vertex] = time
+                    time += 1
+
+        # Pick the next vertex to fan around, preferring vertices that will
+        # still be in the cache once all of their triangles are emitted
+        fan_vertex = -1
+        best_priority = -1
+        for vertex in candidates:
+            if live_counts[vertex] > 0:
+                priority = 0
+                if time - timestamps[vertex] + 2 * live_counts[vertex] <= cache_size:
+                    priority = time - timestamps[vertex]
+                if priority > best_priority:
+                    best_priority = priority
+                    fan_vertex = vertex
+
+        if fan_vertex == -1:
+            # Dead end, continue with a recently used vertex or the next
+            # vertex that still has triangles left
+            while dead_ends and fan_vertex == -1:
+                vertex = dead_ends.pop()
+                if live_counts[vertex] > 0:
+                    fan_vertex = vertex
+            while fan_vertex == -1 and cursor < len(live_counts):
+                if live_counts[cursor] > 0:
+                    fan_vertex = cursor
+                cursor += 1
+            if len(output) != cluster_starts[-1]:
+                cluster_starts.append(len(output))
+
+    order = numpy.array(output, dtype=numpy.int64)
+    if positions is not None and len(cluster_starts) > 2:
+        order = _sort_clusters_for_overdraw(
+            order, triangles, positions, cluster_starts[:-1]
+        )
+
+    return numpy.asarray(indices).reshape(-1, 3)[order].ravel()
+
+
+def _sort_clusters_for_overdraw(order, triangles, positions, cluster_starts):
+    positions = numpy.asarray(positions, dtype=numpy.float64)[:, :3]
+    corners = positions[triangles[order]]
+    face_normals = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    centroids = corners.mean(axis=1)
+
+    starts = numpy.array(cluster_starts)
+    sizes = numpy.diff(numpy.append(starts, len(order)))
+    cluster_normals = numpy.add.reduceat(face_normals, starts)
+    cluster_centroids = numpy.add.reduceat(centroids, starts) / sizes[:, None]
+    lengths = numpy.linalg.norm(cluster_normals, axis=1)
+    cluster_normals /= numpy.where(lengths > 0, lengths, 1)[:, None]
+
+    # Clusters facing away from the mesh center are likely to occlude others
+    occlusion = numpy.einsum(
+        "ij,ij->i", cluster_centroids - centroids.mean(axis=0), cluster_normals
+    )
+    cluster_order = numpy.argsort(-occlusion, kind="stable")
+    cluster_ids = numpy.repeat(numpy.arange(len(starts)), sizes)
+    ranks = numpy.empty(len(starts), dtype=numpy.int64)
+    ranks[cluster_order] = numpy.arange(len(starts))
+    return order[numpy.argsort(ranks[cluster_ids], kind="stable")]
+
+
+def split_triangles(indices, positions, max_triangles):
+    """Partition a triangle list into spatially coherent parts of at most max_triangles
+
+    Parts are split recursively at the median triangle centroid along the
+    longest axis of their centroid bounds, like a k-d tree.  Triangles keep
+    their relative order within each part.  Returns a list of index arrays.
+    """
+    triangles = numpy.asarray(indices).reshape(-1, 3)
+    positions = numpy.asarray(positions, dtype=numpy.float64)[:, :3]
+    centroids = positions[triangles].mean(axis=1)
+
+    parts = []
+    pending = [numpy.arange(len(triangles))]
+    while pending:
+        part = pending.pop()
+        if len(part) <= max_triangles:
+            parts.append(part)
+            continue
+
+        points = centroids[part]
+        axis = numpy.argmax(points.max(axis=0) - points.min(axis=0))
+        half = len(part) // 2
+        order = numpy.argpartition(points[:, axis], half)
+        pending.append(part[order[half:]])
+        pending.append(part[order[:half]])
+
+    return [triangles[numpy.sort(part)].ravel() for part in parts]
+
+
+def remap_row_mask(mask, remap, num_rows):
+    """Carry a boolean row mask over to vertex data whose rows were remapped
+
+    Rows that were removed may map onto unrelated rows, so the result can be
+    a superset of the remapped rows, but never misses one.
+    """
+    rows = remap[numpy.flatnonzero(mask)]
+    remapped = numpy.zeros(num_rows, dtype=bool)
+    remapped[rows[rows < num_rows]] = True
+    return remapped
+
+
+def mask_to_ranges(mask):
+    """Convert a boolean row mask into a list of (start, size) runs of True values"""
+    padded = numpy.concatenate(([False], numpy.asarray(mask, dtype=bool), [False]))
+    edges = numpy.flatnonzero(padded[1:] != padded[:-1])
+    starts = edges[0::2]
+    ends = edges[1::2]
+    return list(zip(starts.tolist(), (ends - starts).tolist()))
+
+
+def mask_to_sparse_array(mask):
+    """Build a SparseArray from a boolean row mask using contiguous ranges"""
+    rows = SparseArray()
+    for start, size in mask_to_ranges(mask):
+        rows.set_range(start, size)
+    return rows
+
+
+def vertex_data_key(gvd):
+    """Return a hashable fingerprint of the format and contents of vertex data"""
+    digest = hashlib.blake2b(digest_size=16)
+    for array_data in gvd.get_arrays():
+        digest.update(array_rows(array_data))
+    return (gvd.get_format(), gvd.get_num_rows(), digest.digest())
+
+
+def primitive_key(prim):
+    """Return a hashable fingerprint of the type and vertex indices of a primitive"""
+    digest = hashlib.blake2b(digest_size=16)
+    if prim.is_indexed():
+        digest.update(index_array(prim))
+        vertices = (prim.get_index_type(), prim.get_num_vertices())
+    else:
+        vertices = (prim.get_first_vertex(), prim.get_num_vertices())
+    return (prim.get_type().get_name(), vertices, tuple(prim.get_ends()), digest.digest())
+
+
+def _quadric_error(quadric, point):
+    a2, ab, ac, ad, b2, bc, bd, c2, cd, d2 = quadric
+    x, y, z = point
+    return (
+        a2 * x * x + b2 * y * y + c2 * z * z + d2
+        + 2 * (ab * x * y + ac * x * z + bc * y * z + ad * x + bd * y + cd * z)
+    )
+
+
+def _triangle_normal(p0, p1, p2):
+    ux, uy, uz = p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2]
+    vx, vy, vz = p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2]
+    return (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+
+
+def simplify_triangles(indices, positions, target_triangles):
+    """Reduce a triangle list to about target_triangles using quadric error metrics
+
+    This performs greedy edge collapses ordered by their quadric error
+    (Garland and Heckbert, "Surface Simplification Using Quadric Error
+    Metrics", 1997).  Vertices are only ever collapsed onto other existing
+    vertices, so the result indexes the same vertex rows as the input.
+
+    Collapses operate on vertices welded by position.  Where a vertex is
+    split into several rows along a UV or normal seam, it may only collapse
+    if every one of its rows has an adjacent row of the target vertex, so
+    seams are kept intact.  Vertices on open or non-manifold edges are never
+    moved.
+    """
+    triangles = numpy.asarray(indices, dtype=numpy.int64).reshape(-1, 3)
+    positions, welded = numpy.unique(
+        numpy.asarray(positions, dtype=numpy.float64)[:, :3], axis=0, return_inverse=True
+    )
+    welded = welded.ravel()
+    welded_triangles = welded[triangles]
+    keep = (
+        (welded_triangles[:, 0] != welded_triangles[:, 1])
+        & (welded_triangles[:, 1] != welded_triangles[:, 2])
+        & (welded_triangles[:, 0] != welded_triangles[:, 2])
+    )
+    triangles = triangles[keep]
+    welded_triangles = welded_triangles[keep]
+    if len(triangles) <= target_triangles:
+        return numpy.asarray(indices).reshape(-1, 3)[keep].ravel()
+
+    # Accumulate area weighted plane quadrics for every vertex, stored as the
+    # ten unique coefficients of the symmetric 4x4 matrix
+    num_vertices = len(positions)
+    corners = positions[welded_triangles]
+    normals = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = numpy.linalg.norm(normals, axis=1)
+    normals /= numpy.where(areas > 0, areas, 1)[:, None]
+    a, b, c = normals.T
+    d = -numpy.einsum("ij,ij->i", normals, corners[:, 0])
+    face_quadrics = (areas / 2)[:, None] * numpy.stack(
+        (a * a, a * b, a * c, a * d, b * b, b * c, b * d, c * c, c * d, d * d), axis=1
+    )
+    quadrics = numpy.zeros((num_vertices, 10))
+    for corner in range(3):
+        numpy.add.at(quadrics, welded_triangles[:, corner], face_quadrics)
+
+    # Lock vertices on edges that are not shared by exactly two triangles
+    edges = numpy.sort(welded_triangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    edges, edge_counts = numpy.unique(edges, axis=0, return_counts=True)
+    locked = numpy.zeros(num_vertices, dtype=bool)
+    locked[edges[edge_counts != 2].ravel()] = True
+
+    heap = []
+    for sources, targets in ((edges[:, 0], edges[:, 1]), (edges[:, 1], edges[:, 0])):
+        movable = ~locked[sources]
+        sources = sources[movable]
+        targets = targets[movable]
+        costs = _quadric_error((quadrics[sources] + quadrics[targets]).T, positions[targets].T)
+        heap.extend(zip(costs.tolist(), sources.tolist(), targets.tolist()))
+    heapq.heapify(heap)
+
+    points = positions.tolist()
+    quadrics = quadrics.tolist()
+    locked = locked.tolist()
+    welded = welded.tolist()
+    triangle_list = triangles.tolist()
+    vertex_triangles = [set() for _ in range(num_vertices)]
+    for triangle, corners in enumerate(welded_triangles.tolist()):
+        for vertex in corners:
+            vertex_triangles[vertex].add(triangle)
+    removed = [False] * num_vertices
+    num_triangles = len(triangle_list)
+
+    def collapse_cost(source, target):
+        return _quadric_error(quadrics[source], points[target]) + _quadric_error(quadrics[target], points[target])
+
+    def neighbors(vertex):
+        return {
+            welded[row]
+            for triangle in vertex_triangles[vertex]
+            for row in triangle_list[triangle]
+            if welded[row] != vertex
+        }
+
+    def row_mapping(source, target):
+        # Map each row of source to a row of target it shares an edge with
+        mapping = {}
+        for triangle in vertex_triangles[source]:
+            rows = triangle_list[triangle]
+            for row in rows:
+                if welded[row] == source:
+                    mapping.setdefault(row, None)
+                    for other in rows:
+                        if welded[other] == target:
+                            mapping[row] = other
+        if None in mapping.values():
+            return None
+        return mapping
+
+    def flips(source, target):
+        for triangle in vertex_triangles[source]:
+            corners = [welded[row] for row in triangle_list[triangle]]
+            if target in corners:
+                continue
+            before = _triangle_normal(*(points[vertex] for vertex in corners))
+            after = _triangle_normal(*(points[target if vertex == source else vertex] for vertex in corners))
+            if before[0] * after[0] + before[1] * after[1] + before[2] * after[2] <= 0:
+                return True
+        return False
+
+    while heap and num_triangles > target_triangles:
+        cost, source, target = heapq.heappop(heap)
+        if removed[source] or removed[target]:
+            continue
+        source_neighbors = neighbors(source)
+        if target not in source_neighbors:
+            continue
+
+        # Costs only grow as quadrics are merged, so stale entries are requeued
+        current = collapse_cost(source, target)
+        if current > cost * (1 + 1e-6) + 1e-12:
+            heapq.heappush(heap, (current, source, target))
+            continue
+
+        # Only collapse edges whose endpoints share exactly the two neighbors
+        # of the triangles on the edge, otherwise the surface would pinch
+        if len(source_neighbors & neighbors(target)) != 2 or flips(source, target):
+            continue
+        mapping = row_mapping(source, target)
+        if mapping is None:
+            continue
+
+        for triangle in vertex_triangles[source]:
+            rows = triangle_list[triangle]
+            if any(welded[row] == target for row in rows):
+                for row in rows:
+                    if welded[row] != source:
+                        vertex_triangles[welded[row]].discard(triangle)
+                num_triangles -= 1
+            else:
+                triangle_list[triangle] = [mapping.get(row, row) for row in rows]
+                vertex_triangles[target].add(triangle)
+        vertex_triangles[source] = set()
+        removed[source] = True
+        quadrics[target] = [qs + qt for qs, qt in zip(quadrics[source], quadrics[target])]
+
+        for vertex in neighbors(target):
+            if not locked[vertex]:
+                heapq.heappush(heap, (collapse_cost(vertex, target), vertex, target))
+            if not locked[target]:
+                heapq.heappush(heap, (collapse_cost(target, vertex), target, vertex))
+
+    alive = sorted(set().union(*vertex_triangles))
+    result = numpy.array([triangle_list[triangle] for triangle in alive], dtype=numpy.int64)
+    return result.reshape(-1).astype(numpy.asarray(indices).dtype)
@@ -1,8 +1,13 @@
+import argparse
 import os
 import subprocess
 
 
 import panda3d.core as p3d
+import pytest
+
+import gltf
+from gltf import cli
 
 
 def test_cli_basic(modelroot, tmp_path):
@@ -48,3 +53,40 @@ def test_cli_flatten_nodes(modelroot, tmp_path, showbase):
 
     panda_nodes = scene.find_all_matches('**/*/-PandaNode')
     assert not panda_nodes
+
+
+def test_cli_animation_library(modelroot, tmp_path):
+    src = (modelroot / 'Fox.glb').to_os_specific()
+    dst = tmp_path / 'tmp.bam'
+    subprocess.check_call([
+        'gltf2bam',
+        '--animations', 'library',
+        src,
+        dst,
+    ])
+
+    loader = p3d.Loader.get_global_ptr()
+    scene = p3d.NodePath(loader.load_sync(dst, p3d.LoaderOptions.LF_no_cache))
+    assert not scene.find_all_matches('**/+AnimBundleNode')
+
+    character = scene.find('**/+Character')
+    library = gltf.load_animation_library(character)
+    assert sorted(library) == ['Run', 'Survey', 'Walk']
+    assert library.bind(character, 'Survey').get_num_frames() > 1
+
+
+def test_cli_animation_fps():
+    assert cli.animation_fps('24') == 24
+    assert cli.animation_fps('29.97') == 29.97
+    assert cli.animation_fps('Auto') == 'auto'
+    for value in ('0', '-30', 'inf', 'fast'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            cli.animation_fps(value)
+
+
+def test_cli_library_dirname():
+    taken = set()
+    assert cli.library_dirname('Fox', taken) == 'Fox'
+    assert cli.library_dirname('fox', taken) == 'fox_2'
+    assert cli.library_dirname('../rig/arm', taken) == '_rig_arm'
+    assert cli.library_dirname('..', taken) == 'character'
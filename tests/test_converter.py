@@ -1,8 +1,172 @@
+import base64
+import gc
+import json
+import weakref
+
+import numpy
 import panda3d.core as p3d
 from direct.actor.Actor import Actor
 
 import gltf
+from gltf import meshutils
+from gltf._converter import Converter
+
+
+_COMPONENT_TYPES = {
+    numpy.dtype(numpy.int8): 5120,
+    numpy.dtype(numpy.uint8): 5121,
+    numpy.dtype(numpy.int16): 5122,
+    numpy.dtype(numpy.uint16): 5123,
+    numpy.dtype(numpy.uint32): 5125,
+    numpy.dtype(numpy.float32): 5126,
+}
+_ACCESSOR_TYPES = {1: "SCALAR", 2: "VEC2", 3: "VEC3", 4: "VEC4", 16: "MAT4"}
+
+
+def make_gltf(meshes, nodes=None, **kwargs):
+    """Build an in-memory glTF document
+
+    Attribute, index and target values of the primitives in meshes, inverse
+    bind matrices of skins and animation sampler inputs and outputs are NumPy
+    arrays, which get replaced by accessors into a single embedded buffer.
+    """
+    buffdata = bytearray()
+    gltf_data = {
+        "accessors": [],
+        "bufferViews": [],
+        "meshes": [],
+        "nodes": nodes if nodes is not None else [
+            {"mesh": meshid} for meshid in range(len(meshes))
+        ],
+        **kwargs,
+    }
+    gltf_data.setdefault("scenes", [{"nodes": list(range(len(gltf_data["nodes"])))}])
+
+    def add_accessor(array):
+        array = numpy.ascontiguousarray(array)
+        if array.ndim == 1:
+            array = array.reshape(-1, 1)
+        while len(buffdata) % 4:
+            buffdata.append(0)
+        gltf_data["bufferViews"].append({
+            "buffer": 0,
+            "byteOffset": len(buffdata),
+            "byteLength": array.nbytes,
+        })
+        buffdata.extend(array.tobytes())
+        gltf_data["accessors"].append({
+            "bufferView": len(gltf_data["bufferViews"]) - 1,
+            "componentType": _COMPONENT_TYPES[array.dtype],
+            "count": array.shape[0],
+            "type": _ACCESSOR_TYPES[array.shape[1]],
+        })
+        return len(gltf_data["accessors"]) - 1
+
+    accids = {}
+    def get_accessor(array):
+        # Reuse accessors for the same array object, like exporters sharing data
+        if id(array) not in accids:
+            accids[id(array)] = add_accessor(array)
+        return accids[id(array)]
+
+    for gltf_mesh in meshes:
+        gltf_mesh = dict(gltf_mesh)
+        primitives = []
+        for gltf_prim in gltf_mesh["primitives"]:
+            gltf_prim = dict(gltf_prim)
+            gltf_prim["attributes"] = {
+                name: get_accessor(array)
+                for name, array in gltf_prim["attributes"].items()
+            }
+            if "indices" in gltf_prim:
+                gltf_prim["indices"] = get_accessor(gltf_prim["indices"])
+            if "targets" in gltf_prim:
+                gltf_prim["targets"] = [
+                    {name: get_accessor(array) for name, array in target.items()}
+                    for target in gltf_prim["targets"]
+                ]
+            primitives.append(gltf_prim)
+        gltf_mesh["primitives"] = primitives
+        gltf_data["meshes"].append(gltf_mesh)
+
+    for gltf_skin in gltf_data.get("skins", []):
+        if "inverseBindMatrices" in gltf_skin:
+            gltf_skin["inverseBindMatrices"] = get_accessor(gltf_skin["inverseBindMatrices"])
+    for gltf_anim in gltf_data.get("animations", []):
+        for sampler in gltf_anim["samplers"]:
+            sampler["input"] = get_accessor(sampler["input"])
+            sampler["output"] = get_accessor(sampler["output"])
+
+    gltf_data["buffers"] = [{
+        "uri": "data:application/octet-stream;base64," + base64.b64encode(buffdata).decode(),
+        "byteLength": len(buffdata),
+    }]
+    return gltf_data
+
+def make_sparse(gltf_data, accid, base=None):
+    """Turn an accessor of make_gltf into a sparse one
+
+    The rows that differ from the base array, or zeros if it is None, are
+    stored as sparse values.  A base array becomes the new buffer view.
+    """
+    gltf_buffer = gltf_data["buffers"][0]
+    buffdata = bytearray(base64.b64decode(gltf_buffer["uri"].split(",")[1]))
+    acc = gltf_data["accessors"][accid]
+    buffview = gltf_data["bufferViews"][acc.pop("bufferView")]
+    dtype = {v: k for k, v in _COMPONENT_TYPES.items()}[acc["componentType"]]
+    values = numpy.frombuffer(
+        buffdata, dtype=dtype, count=buffview["byteLength"] // dtype.itemsize,
+        offset=buffview["byteOffset"],
+    ).reshape(acc["count"], -1).copy()
+
+    def add_view(array):
+        while len(buffdata) % 4:
+            buffdata.append(0)
+        gltf_data["bufferViews"].append({
+            "buffer": 0,
+            "byteOffset": len(buffdata),
+            "byteLength": array.nbytes,
+        })
+        buffdata.extend(array.tobytes())
+        return len(gltf_data["bufferViews"]) - 1
+
+    if base is None:
+        base = numpy.zeros_like(values)
+    else:
+        acc["bufferView"] = add_view(numpy.ascontiguousarray(base, dtype=dtype))
+    rows = numpy.flatnonzero(numpy.any(values != base, axis=1)).astype(numpy.uint16)
+    acc["sparse"] = {
+        "count": len(rows),
+        "indices": {"bufferView": add_view(rows), "componentType": _COMPONENT_TYPES[rows.dtype]},
+        "values": {"bufferView": add_view(numpy.ascontiguousarray(values[rows]))},
+    }
 
+    gltf_buffer["uri"] = "data:application/octet-stream;base64," + base64.b64encode(buffdata).decode()
+    gltf_buffer["byteLength"] = len(buffdata)
+
+def convert_gltf(gltf_data, **kwargs):
+    converter = Converter("synthetic.gltf", settings=gltf.GltfSettings(**kwargs))
+    converter.update(gltf_data)
+    return converter
+
+def make_grid(size):
+    """Return positions, normals, uvs and triangle indices for a size x size quad grid"""
+    coords = numpy.linspace(0.0, 1.0, size + 1, dtype=numpy.float32)
+    xx, yy = numpy.meshgrid(coords, coords)
+    positions = numpy.stack([xx.ravel(), numpy.zeros(xx.size), yy.ravel()], axis=1)
+    normals = numpy.tile(numpy.array([0, 1, 0]), (xx.size, 1))
+    uvs = numpy.stack([xx.ravel(), yy.ravel()], axis=1)
+
+    cells = numpy.arange(size * (size + 1)).reshape(size, size + 1)[:, :-1].ravel()
+    quads = numpy.stack([cells, cells + 1, cells + size + 2, cells + size + 1], axis=1)
+    indices = quads[:, [0, 1, 2, 0, 2, 3]].ravel()
+
+    return (
+        positions.astype(numpy.float32),
+        normals.astype(numpy.float32),
+        uvs.astype(numpy.float32),
+        indices.astype(numpy.uint32),
+    )
 
 def load_test_asset(modelroot, assetname) -> p3d.NodePath:
     model = p3d.NodePath(gltf.load_model(p3d.Filename(modelroot, assetname)))
@@ -42,3 +206,848 @@ def test_skin_char_root(modelroot):
     model.ls()
     assert model.find_all_matches('**/+Character/+GeomNode')
     assert model.find_all_matches('**/+Character/+AnimBundleNode')
+
+def make_morph_gltf(positions=None, **kwargs):
+    grid_positions, normals, _, indices = make_grid(4)
+    if positions is None:
+        positions = grid_positions
+    smile = numpy.zeros_like(positions)
+    smile[3:7, 1] = 0.5
+    smile[20] = (0.1, 0, 0)
+    blink = numpy.zeros_like(positions)
+    blink[10:12, 2] = 0.25
+    return make_gltf([{
+        "primitives": [{
+            "attributes": {"POSITION": positions, "NORMAL": normals},
+            "indices": indices,
+            "targets": [{"POSITION": smile}, {"POSITION": blink}],
+        }],
+        "weights": [0.0, 0.0],
+        "extras": {"targetNames": ["smile", "blink"]},
+    }], **kwargs)
+
+def get_slider_rows(vdata):
+    stable = vdata.get_slider_table()
+    return {
+        stable.get_slider(i).get_name().get_name(): [
+            stable.get_slider_rows(i).get_bit(row) for row in range(vdata.get_num_rows())
+        ]
+        for i in range(stable.get_num_sliders())
+    }
+
+def test_morph_slider_rows():
+    converter = convert_gltf(make_morph_gltf())
+
+    geomnode = converter.meshes[0]
+    stable = geomnode.get_geom(0).get_vertex_data().get_slider_table()
+    assert stable.get_num_sliders() == 2
+
+    rows = {
+        stable.get_slider(i).get_name().get_name(): stable.get_slider_rows(i)
+        for i in range(stable.get_num_sliders())
+    }
+    smile_rows = rows["smile"]
+    assert smile_rows.get_num_subranges() == 2
+    assert [smile_rows.get_bit(i) for i in range(25)] == [
+        i in (3, 4, 5, 6, 20) for i in range(25)
+    ]
+    assert rows["blink"].get_num_subranges() == 1
+    assert rows["blink"].get_subrange_begin(0) == 10
+    assert rows["blink"].get_subrange_end(0) == 12
+
+def test_vertex_format_cache():
+    positions, normals, uvs, indices = make_grid(2)
+    gltf_data = make_gltf([
+        {"primitives": [{"attributes": {"POSITION": positions, "NORMAL": normals}, "indices": indices}]},
+        {"primitives": [{"attributes": {"POSITION": positions, "NORMAL": normals}, "indices": indices}]},
+        {"primitives": [{
+            "attributes": {"POSITION": positions, "NORMAL": normals, "TEXCOORD_0": uvs},
+            "indices": indices,
+        }]},
+    ])
+    converter = convert_gltf(gltf_data)
+
+    formats = [
+        converter.meshes[meshid].get_geom(0).get_vertex_data().get_format()
+        for meshid in range(3)
+    ]
+    assert formats[0] == formats[1]
+    assert formats[0] != formats[2]
+
+def test_shared_vertex_data():
+    positions, normals, uvs, indices = make_grid(4)
+    attributes = {"POSITION": positions, "NORMAL": normals, "TEXCOORD_0": uvs}
+    first_half = indices[:len(indices) // 2]
+    second_half = indices[len(indices) // 2:]
+    gltf_data = make_gltf([
+        {"primitives": [
+            {"attributes": attributes, "indices": first_half},
+            {"attributes": attributes, "indices": second_half},
+        ]},
+        {"primitives": [{"attributes": attributes, "indices": indices}]},
+    ])
+    converter = convert_gltf(gltf_data)
+
+    geoms = [
+        converter.meshes[0].get_geom(0),
+        converter.meshes[0].get_geom(1),
+        converter.meshes[1].get_geom(0),
+    ]
+    assert geoms[0].get_vertex_data() == geoms[1].get_vertex_data()
+    assert geoms[0].get_vertex_data() == geoms[2].get_vertex_data()
+    assert geoms[0].get_primitive(0).get_num_vertices() == len(first_half)
+    assert geoms[1].get_primitive(0).get_num_vertices() == len(second_half)
+
+    # Tangents are generated for the whole shared vertex data
+    tangents = meshutils.column_array(geoms[0].get_vertex_data(), "tangent")
+    assert numpy.allclose(numpy.linalg.norm(tangents[:, :3], axis=1), 1.0)
+
+def test_packed_buffer_view():
+    positions, normals, _, indices = make_grid(2)
+    gltf_data = make_gltf([{"primitives": [{
+        "attributes": {"POSITION": positions, "NORMAL": normals},
+        "indices": indices,
+    }]}])
+
+    # Store both attributes one after the other in a single view without a stride
+    gltf_prim = gltf_data["meshes"][0]["primitives"][0]
+    posacc = gltf_data["accessors"][gltf_prim["attributes"]["POSITION"]]
+    normacc = gltf_data["accessors"][gltf_prim["attributes"]["NORMAL"]]
+    posview = gltf_data["bufferViews"][posacc["bufferView"]]
+    normview = gltf_data["bufferViews"][normacc["bufferView"]]
+    normacc["byteOffset"] = normview["byteOffset"] - posview["byteOffset"]
+    normacc["bufferView"] = posacc["bufferView"]
+    posview["byteLength"] = normacc["byteOffset"] + normview["byteLength"]
+
+    vdata = convert_gltf(gltf_data).meshes[0].get_geom(0).get_vertex_data()
+    assert numpy.array_equal(
+        meshutils.column_array(vdata, "vertex"), positions[:, [0, 2, 1]] * [1, -1, 1]
+    )
+    assert numpy.array_equal(
+        meshutils.column_array(vdata, "normal"), normals[:, [0, 2, 1]] * [1, -1, 1]
+    )
+
+def test_dedupe_geometry():
+    positions, normals, _, indices = make_grid(3)
+
+    def make_meshes():
+        # Copies get their own accessors, like CAD exports of repeated parts
+        return [
+            {"primitives": [{
+                "attributes": {"POSITION": positions.copy(), "NORMAL": normals.copy()},
+                "indices": indices.copy(),
+            }]},
+            {"primitives": [{
+                "attributes": {"POSITION": positions.copy(), "NORMAL": normals.copy()},
+                "indices": indices.copy(),
+            }]},
+            {"primitives": [{
+                "attributes": {"POSITION": positions.copy(), "NORMAL": normals.copy()},
+                "indices": indices[:6].copy(),
+            }]},
+        ]
+
+    converter = convert_gltf(make_gltf(make_meshes()))
+    geoms = [converter.meshes[meshid].get_geom(0) for meshid in range(3)]
+    assert geoms[0] != geoms[1]
+    assert geoms[0].get_vertex_data() != geoms[1].get_vertex_data()
+
+    converter = convert_gltf(make_gltf(make_meshes()), dedupe_geometry=True)
+    geoms = [converter.meshes[meshid].get_geom(0) for meshid in range(3)]
+    assert geoms[0] == geoms[1]
+    assert geoms[0] != geoms[2]
+    assert geoms[0].get_vertex_data() == geoms[2].get_vertex_data()
+    assert geoms[2].get_primitive(0).get_num_vertices() == 6
+
+def get_triangle_positions(geom):
+    positions = meshutils.column_array(geom.get_vertex_data(), "vertex")
+    indices = meshutils.index_array(geom.get_primitive(0).decompose())
+    return positions[indices]
+
+def get_sorted_triangles(geoms):
+    corners = numpy.concatenate([get_triangle_positions(geom) for geom in geoms]).reshape(-1, 9)
+    return corners[numpy.lexsort(corners.T[::-1])]
+
+def test_compact_indices():
+    positions, normals, _, indices = make_grid(10)
+    attributes = {"POSITION": positions, "NORMAL": normals}
+    gltf_data = make_gltf([
+        {"primitives": [
+            {"attributes": attributes, "indices": indices[:12]},
+            {"attributes": attributes, "indices": indices[-6:]},
+        ]},
+    ])
+
+    converter = convert_gltf(gltf_data)
+    original = [converter.meshes[0].get_geom(i) for i in range(2)]
+    assert original[0].get_primitive(0).get_index_type() == p3d.GeomEnums.NT_uint32
+
+    converter = convert_gltf(gltf_data, compact_indices=True)
+    compacted = [converter.meshes[0].get_geom(i) for i in range(2)]
+    assert compacted[0].get_vertex_data() == compacted[1].get_vertex_data()
+    assert compacted[0].get_vertex_data().get_num_rows() == 10
+    for geom, original_geom in zip(compacted, original):
+        assert geom.get_primitive(0).get_index_type() == p3d.GeomEnums.NT_uint16
+        assert numpy.array_equal(
+            get_triangle_positions(geom),
+            get_triangle_positions(original_geom),
+        )
+
+def test_compact_dedupe_skinned(modelroot):
+    # Skinned vertex data contains padded arrays
+    model = p3d.NodePath(gltf.load_model(
+        p3d.Filename(modelroot, 'Fox.glb'),
+        gltf.GltfSettings(compact_indices=True, dedupe_geometry=True),
+    ))
+    assert model.find_all_matches('**/+Character/+GeomNode')
+
+def test_optimize_meshes():
+    positions, normals, uvs, indices = make_grid(30)
+    rng = numpy.random.default_rng(1)
+    triangles = indices.reshape(-1, 3)[rng.permutation(len(indices) // 3)]
+    gltf_data = make_gltf([{"primitives": [{
+        "attributes": {"POSITION": positions, "NORMAL": normals, "TEXCOORD_0": uvs},
+        "indices": triangles.ravel(),
+    }]}])
+
+    original = convert_gltf(gltf_data).meshes[0].get_geom(0)
+    optimized = convert_gltf(gltf_data, optimize_meshes=True).meshes[0].get_geom(0)
+
+    original_acmr = meshutils.average_cache_miss_ratio(
+        meshutils.index_array(original.get_primitive(0))
+    )
+    optimized_indices = meshutils.index_array(optimized.get_primitive(0))
+    optimized_acmr = meshutils.average_cache_miss_ratio(optimized_indices)
+    assert optimized_acmr < 0.8 < original_acmr
+
+    # Vertices are stored in order of first use
+    _, first_use = numpy.unique(optimized_indices, return_index=True)
+    assert numpy.all(numpy.diff(first_use) > 0)
+    assert numpy.array_equal(get_sorted_triangles([original]), get_sorted_triangles([optimized]))
+
+def test_lod_levels():
+    # Two curved patches meeting at a UV seam, with split vertices along x = 1
+    positions, normals, uvs, indices = make_grid(12)
+    num_rows = len(positions)
+    positions = numpy.concatenate([positions, positions + numpy.float32([1, 0, 0])])
+    positions[:, 1] = 0.1 * numpy.sin(3 * positions[:, 0]) * numpy.cos(3 * positions[:, 2])
+    gltf_data = make_gltf([{"primitives": [{
+        "attributes": {
+            "POSITION": positions,
+            "NORMAL": numpy.concatenate([normals, normals]),
+            "TEXCOORD_0": numpy.concatenate([uvs, uvs + numpy.float32([0.5, 0])]),
+        },
+        "indices": numpy.concatenate([indices, indices + num_rows]),
+    }]}])
+
+    scene = convert_gltf(gltf_data).active_scene
+    assert scene.find('**/+LODNode').is_empty()
+
+    converter = convert_gltf(gltf_data, lod_levels=2)
+    lod = converter.active_scene.find('**/+LODNode').node()
+    mesh = converter.meshes[0]
+    assert lod.get_num_children() == lod.get_num_switches() == 3
+    assert lod.get_child(0) == mesh
+    assert lod.get_out(0) == 0
+    assert lod.get_in(0) == lod.get_out(1) < lod.get_in(1) == lod.get_out(2)
+    assert lod.get_in(2) == float('inf')
+
+    border = numpy.flatnonzero(
+        numpy.isin(positions[:, 0], [0, 2]) | numpy.isin(positions[:, 2], [0, 1])
+    )
+    num_triangles = len(indices) * 2 // 3
+    for level in lod.get_children()[1:]:
+        geom = level.get_geom(0)
+        assert geom.get_vertex_data() == mesh.get_geom(0).get_vertex_data()
+        triangles = meshutils.index_array(geom.get_primitive(0)).reshape(-1, 3)
+        assert len(triangles) <= num_triangles * 3 // 4
+        num_triangles = len(triangles)
+
+        # Triangles never mix rows from both sides of the seam and the outer
+        # border is left untouched
+        sides = triangles >= num_rows
+        assert numpy.all(sides.all(axis=1) | ~sides.any(axis=1))
+        assert numpy.isin(border, triangles).all()
+
+def test_lod_levels_update():
+    def make_data(size):
+        positions, normals, _, indices = make_grid(size)
+        positions[:, 1] = 0.1 * numpy.sin(3 * positions[:, 0]) * numpy.cos(3 * positions[:, 2])
+        return make_gltf([{"primitives": [{
+            "attributes": {"POSITION": positions, "NORMAL": normals},
+            "indices": indices,
+        }]}])
+
+    converter = convert_gltf(make_data(8), lod_levels=1)
+    converter.update(make_data(12))
+
+    # The LOD levels of the second update are simplified from its own mesh
+    lod = converter.scenes[0].find('**/+LODNode').node()
+    vertex_data = converter.meshes[0].get_geom(0).get_vertex_data()
+    assert vertex_data.get_num_rows() == 13 * 13
+    assert lod.get_child(1).get_geom(0).get_vertex_data() == vertex_data
+
+def test_max_geom_triangles():
+    positions, normals, _, indices = make_grid(40)
+    gltf_data = make_gltf([{"primitives": [{
+        "attributes": {"POSITION": positions, "NORMAL": normals},
+        "indices": indices,
+    }]}])
+
+    original = convert_gltf(gltf_data).meshes[0]
+    assert original.get_num_geoms() == 1
+
+    mesh = convert_gltf(gltf_data, max_geom_triangles=500).meshes[0]
+    assert mesh.get_num_geoms() == 8
+    vdata = mesh.get_geom(0).get_vertex_data()
+    radius = original.get_geom(0).get_bounds().get_radius()
+    for geom in mesh.get_geoms():
+        assert geom.get_vertex_data() == vdata
+        assert geom.get_primitive(0).get_num_primitives() <= 500
+        assert geom.get_bounds().get_radius() < radius / 2
+    assert numpy.array_equal(get_sorted_triangles(original.get_geoms()), get_sorted_triangles(mesh.get_geoms()))
+
+def test_weld_vertices():
+    positions, normals, uvs, indices = make_grid(10)
+    gltf_data = make_gltf([
+        {"primitives": [{"attributes": {
+            "POSITION": positions[indices],
+            "NORMAL": normals[indices],
+            "TEXCOORD_0": uvs[indices],
+        }}]},
+        # Flat normals are generated for primitives without normals
+        {"primitives": [{"attributes": {"POSITION": positions[indices]}}]},
+    ])
+
+    converter = convert_gltf(gltf_data)
+    original = [converter.meshes[meshid].get_geom(0) for meshid in range(2)]
+    converter = convert_gltf(gltf_data, weld_vertices=True)
+    welded = [converter.meshes[meshid].get_geom(0) for meshid in range(2)]
+    for geom, original_geom in zip(welded, original):
+        assert original_geom.get_vertex_data().get_num_rows() == len(indices)
+        assert geom.get_vertex_data().get_num_rows() == len(positions)
+        prim = geom.get_primitive(0)
+        assert prim.is_indexed()
+        assert prim.get_index_type() == p3d.GeomEnums.NT_uint16
+        assert numpy.array_equal(
+            get_triangle_positions(geom),
+            get_triangle_positions(original_geom),
+        )
+
+def test_keep_quantized(modelroot):
+    def load_duck(**kwargs):
+        settings = gltf.GltfSettings(**kwargs)
+        model = p3d.NodePath(gltf.load_model(p3d.Filename(modelroot, 'QuantizedDuck.gltf'), settings))
+        geomnode = model.find('**/+GeomNode').node()
+        return geomnode.get_geom(0).get_vertex_data(), geomnode.get_geom_state(0)
+
+    def final_texcoords(vdata, state):
+        texstage = state.get_attrib(p3d.TextureAttrib).get_on_stage(0)
+        mat = state.get_attrib(p3d.TexMatrixAttrib).get_mat(texstage)
+        texcoords = meshutils.column_array(vdata, 'texcoord.0').astype(numpy.float64)
+        return texcoords @ [[mat[0][0], mat[0][1]], [mat[1][0], mat[1][1]]] + [mat[3][0], mat[3][1]]
+
+    vdata, state = load_duck()
+    packed_vdata, packed_state = load_duck(keep_quantized=True)
+    vformat = packed_vdata.get_format()
+    assert vformat.get_column('normal').get_numeric_type() == p3d.GeomEnums.NT_float32
+    assert vformat.get_column('texcoord.0').get_numeric_type() == p3d.GeomEnums.NT_uint16
+    def data_size(vdata):
+        return sum(array.get_data_size_bytes() for array in vdata.get_arrays())
+    assert data_size(packed_vdata) < data_size(vdata)
+
+    assert numpy.array_equal(
+        meshutils.column_array(packed_vdata, 'normal'),
+        meshutils.column_array(vdata, 'normal'),
+    )
+    assert numpy.allclose(
+        final_texcoords(packed_vdata, packed_state),
+        final_texcoords(vdata, state),
+        atol=1e-4,
+    )
+
+def test_keep_quantized_colors():
+    positions, normals, _, indices = make_grid(2)
+    colors = numpy.linspace(0, 1, len(positions) * 4, dtype=numpy.float32).reshape(-1, 4)
+    gltf_data = make_gltf([{"primitives": [{
+        "attributes": {"POSITION": positions, "NORMAL": normals, "COLOR_0": colors},
+        "indices": indices,
+    }]}])
+
+    vdata = convert_gltf(gltf_data, keep_quantized=True).meshes[0].get_geom(0).get_vertex_data()
+    assert vdata.get_format().get_column('color').get_numeric_type() == p3d.GeomEnums.NT_uint8
+    assert numpy.array_equal(meshutils.column_array(vdata, 'color'), numpy.round(colors * 255))
+
+def test_sparse_accessors():
+    flat, _, _, _ = make_grid(4)
+    positions = flat.copy()
+    positions[7:9, 1] = (0.25, -0.5)
+    dense_vdata = convert_gltf(make_morph_gltf(positions)).meshes[0].get_geom(0).get_vertex_data()
+
+    # Store the positions as edits of a flat grid and the targets without a base
+    gltf_data = make_morph_gltf(positions)
+    gltf_prim = gltf_data["meshes"][0]["primitives"][0]
+    for target in gltf_prim["targets"]:
+        make_sparse(gltf_data, target["POSITION"])
+    make_sparse(gltf_data, gltf_prim["attributes"]["POSITION"], base=flat)
+    assert gltf_data["accessors"][gltf_prim["attributes"]["POSITION"]]["sparse"]["count"] == 2
+
+    vdata = convert_gltf(gltf_data).meshes[0].get_geom(0).get_vertex_data()
+    vformat = vdata.get_format()
+    for morph_i in range(vformat.get_num_morphs()):
+        column_name = vformat.get_morph_delta(morph_i)
+        assert numpy.array_equal(
+            meshutils.column_array(vdata, column_name),
+            meshutils.column_array(dense_vdata, column_name),
+        )
+    assert get_slider_rows(vdata) == get_slider_rows(dense_vdata)
+    assert numpy.array_equal(
+        meshutils.column_array(vdata, 'vertex'), meshutils.column_array(dense_vdata, 'vertex')
+    )
+
+    heights = meshutils.column_array(vdata, 'vertex')[:, 2]
+    assert numpy.array_equal(heights[7:9], [0.25, -0.5])
+    assert not heights[:7].any() and not heights[9:].any()
+
+def test_sparse_morph_targets():
+    gltf_data = make_morph_gltf()
+    for target in gltf_data["meshes"][0]["primitives"][0]["targets"]:
+        make_sparse(gltf_data, target["POSITION"])
+
+    for settings in ({}, {"compact_indices": True, "optimize_meshes": True}):
+        dense_vdata = convert_gltf(
+            make_morph_gltf(), **settings
+        ).meshes[0].get_geom(0).get_vertex_data()
+        converter = convert_gltf(gltf_data, sparse_morph_targets=True, **settings)
+        vdata = converter.meshes[0].get_geom(0).get_vertex_data()
+        assert get_slider_rows(vdata) == get_slider_rows(dense_vdata)
+
+def make_skinned_gltf(animations):
+    """Build a triangle skinned to a root joint with a child "arm" joint"""
+    positions = numpy.array([(0, 0, 0), (1, 0, 0), (0, 1, 0)], dtype=numpy.float32)
+    normals = numpy.array([(0, 0, 1)] * 3, dtype=numpy.float32)
+    return make_gltf(
+        [{"primitives": [{"attributes": {
+            "POSITION": positions,
+            "NORMAL": normals,
+            "JOINTS_0": numpy.zeros((3, 4), dtype=numpy.uint8),
+            "WEIGHTS_0": numpy.array([(1, 0, 0, 0)] * 3, dtype=numpy.float32),
+        }}]}],
+        nodes=[
+            {"mesh": 0, "skin": 0},
+            {"name": "root", "children": [2]},
+            {"name": "arm", "translation": [0, 1, 0]},
+        ],
+        scenes=[{"nodes": [0, 1]}],
+        skins=[{"joints": [1, 2]}],
+        animations=animations,
+    )
+
+def get_anim_tables(converter):
+    tables = {}
+    def collect(group):
+        if isinstance(group, p3d.AnimChannelMatrixXfmTable):
+            tables[group.name] = {c: list(group.get_table(c)) for c in 'xyzhprijk'}
+        for child in group.children:
+            collect(child)
+
+    for np in converter.active_scene.find_all_matches('**/+AnimBundleNode'):
+        collect(np.node().get_bundle())
+    return tables
+
+def test_animation_resampling():
+    half_turn = numpy.array([(0, 0, 0, 1), (0, 0, 1, 0)], dtype=numpy.float32)
+    gltf_data = make_skinned_gltf([{
+        "channels": [
+            {"sampler": 0, "target": {"node": 2, "path": "rotation"}},
+            {"sampler": 1, "target": {"node": 1, "path": "translation"}},
+        ],
+        "samplers": [
+            {"input": numpy.array([0, 1], dtype=numpy.float32), "output": half_turn},
+            {
+                "input": numpy.array([0, 0.5], dtype=numpy.float32),
+                "output": numpy.array([(0, 0, 0), (2, 0, 0)], dtype=numpy.float32),
+                "interpolation": "STEP",
+            },
+        ],
+    }])
+    tables = get_anim_tables(convert_gltf(gltf_data, animation_fps=10))
+
+    # Slerp from no rotation to half a turn around the glTF Z axis, which is
+    # the negative Y axis in Panda3D
+    rolls = numpy.array(tables["arm"]["r"])
+    assert len(rolls) == 10
+    assert numpy.allclose(rolls, numpy.arange(10) * -18.0, atol=1e-3)
+    assert numpy.allclose(tables["arm"]["i"], [1.0])
+
+    assert tables["root"]["x"] == [0.0] * 5 + [2.0] * 5
+
+def test_character_joint_map():
+    converter = convert_gltf(make_skinned_gltf([]))
+    joints = converter.characters[0].joints
+    assert {nodeid: joint.name for nodeid, joint in joints.items()} == {1: "root", 2: "arm"}
+    assert list(joints[1].children) == [joints[2]]
+
+def test_skin_common_root():
+    gltf_data = make_skinned_gltf([])
+    gltf_data["nodes"].append({"name": "group", "children": [0, 1]})
+    gltf_data["scenes"] = [{"nodes": [3]}]
+    converter = convert_gltf(gltf_data)
+
+    # The character sits on the closest node above both the mesh and joints
+    assert converter.skeletons == {3: 0}
+    group = converter.active_scene.find("**/group")
+    assert group.node().is_of_type(p3d.Character)
+    assert group.find("**/+GeomNode")
+    assert {joint.name for joint in converter.characters[0].joints.values()} == {"root", "arm"}
+
+def test_accessor_cache():
+    times = numpy.array([0, 1], dtype=numpy.float32)
+    gltf_data = make_skinned_gltf([{
+        "channels": [
+            {"sampler": 0, "target": {"node": 1, "path": "scale"}},
+            {"sampler": 1, "target": {"node": 2, "path": "scale"}},
+        ],
+        "samplers": [
+            {"input": times, "output": numpy.array([(1, 1, 1), (2, 2, 2)], dtype=numpy.float32)},
+            {"input": times, "output": numpy.array([(1, 1, 1), (3, 3, 3)], dtype=numpy.float32)},
+        ],
+    }])
+    converter = convert_gltf(gltf_data)
+
+    # Both samplers share the decoded time accessor
+    timeid = gltf_data["animations"][0]["samplers"][0]["input"]
+    array = converter.get_accessor_array(gltf_data, timeid)
+    assert array is converter.get_accessor_array(gltf_data, timeid)
+    assert not array.flags.writeable
+    assert numpy.array_equal(array.ravel(), times)
+
+def test_animation_fps_auto():
+    gltf_data = make_skinned_gltf([
+        {
+            "name": "mocap",
+            "channels": [{"sampler": 0, "target": {"node": 2, "path": "translation"}}],
+            "samplers": [{
+                "input": numpy.arange(13, dtype=numpy.float32) / 60,
+                "output": numpy.linspace((0, 0, 0), (1, 0, 0), 13, dtype=numpy.float32),
+            }],
+        },
+        {
+            "name": "hold",
+            "channels": [{"sampler": 0, "target": {"node": 2, "path": "translation"}}],
+            "samplers": [{
+                "input": numpy.array([0, 2], dtype=numpy.float32),
+                "output": numpy.array([(0, 1, 0), (0, 1, 0)], dtype=numpy.float32),
+            }],
+        },
+    ])
+    converter = convert_gltf(gltf_data, auto_animation_fps=True)
+
+    bundles = {
+        np.node().get_bundle().name: np.node().get_bundle()
+        for np in converter.active_scene.find_all_matches('**/+AnimBundleNode')
+    }
+    assert bundles["mocap"].get_base_frame_rate() == 60
+    assert bundles["mocap"].get_num_frames() == 12
+    assert bundles["hold"].get_base_frame_rate() == 1
+    assert bundles["hold"].get_num_frames() == 2
+
+    assert convert_gltf(gltf_data).active_scene.find(
+        '**/+AnimBundleNode'
+    ).node().get_bundle().get_base_frame_rate() == 30
+
+def test_cubic_spline_animation():
+    # Zero tangents turn the segment between the keyframes into a smoothstep
+    splines = numpy.array([
+        [(0, 0, 0), (0, 0, 0), (0, 0, 0)],
+        [(0, 0, 0), (1, 0, 0), (0, 0, 0)],
+    ], dtype=numpy.float32).reshape(-1, 3)
+    quarter_turn = numpy.array([
+        [(0, 0, 0, 0), (0, 0, 0, 1), (0, 0, 0, 0)],
+        [(0, 0, 0, 0), (0, 0, 0.5 ** 0.5, 0.5 ** 0.5), (0, 0, 0, 0)],
+    ], dtype=numpy.float32).reshape(-1, 4)
+    times = numpy.array([0, 1], dtype=numpy.float32)
+    gltf_data = make_skinned_gltf([{
+        "channels": [
+            {"sampler": 0, "target": {"node": 1, "path": "translation"}},
+            {"sampler": 1, "target": {"node": 2, "path": "rotation"}},
+        ],
+        "samplers": [
+            {"input": times, "output": splines, "interpolation": "CUBICSPLINE"},
+            {"input": times, "output": quarter_turn, "interpolation": "CUBICSPLINE"},
+        ],
+    }])
+    tables = get_anim_tables(convert_gltf(gltf_data, animation_fps=10))
+
+    factors = numpy.arange(10) / 10
+    assert numpy.allclose(tables["root"]["x"], 3 * factors ** 2 - 2 * factors ** 3, atol=1e-6)
+    # Halfway the spline is the normalized sum of both quaternions
+    assert numpy.isclose(tables["arm"]["r"][5], -45.0, atol=1e-3)
+
+def test_cubic_spline_morph_weights():
+    # Both targets start at 0 and end at 1; the second overshoots with a
+    # steep out-tangent on its first keyframe
+    splines = numpy.array([
+        [(0, 0), (0, 0), (0, 4)],
+        [(0, 0), (1, 1), (0, 0)],
+    ], dtype=numpy.float32).reshape(-1)
+    times = numpy.array([0, 1], dtype=numpy.float32)
+    gltf_data = make_morph_gltf(animations=[{
+        "channels": [{"sampler": 0, "target": {"node": 0, "path": "weights"}}],
+        "samplers": [{"input": times, "output": splines, "interpolation": "CUBICSPLINE"}],
+    }])
+    converter = convert_gltf(gltf_data, animation_fps=10)
+
+    bundle = converter.active_scene.find('**/+AnimBundleNode').node().get_bundle()
+    weights = {
+        channel.name: numpy.array(channel.get_table())
+        for channel in bundle.find_child("morph").children
+    }
+    factors = numpy.arange(10) / 10
+    smoothstep = 3 * factors ** 2 - 2 * factors ** 3
+    assert numpy.allclose(weights["smile"], smoothstep, atol=1e-6)
+    assert numpy.allclose(
+        weights["blink"], smoothstep + 4 * (factors ** 3 - 2 * factors ** 2 + factors), atol=1e-6
+    )
+
+def test_morph_weight_resampling():
+    # One target ramps up and back down, the other stays at 0.5
+    weights = numpy.array([(0, 0.5), (1, 0.5), (0, 0.5)], dtype=numpy.float32).reshape(-1)
+    times = numpy.array([0, 0.5, 1], dtype=numpy.float32)
+    gltf_data = make_morph_gltf(animations=[{
+        "channels": [{"sampler": 0, "target": {"node": 0, "path": "weights"}}],
+        "samplers": [{"input": times, "output": weights}],
+    }])
+    converter = convert_gltf(gltf_data, animation_fps=10)
+
+    bundle = converter.active_scene.find('**/+AnimBundleNode').node().get_bundle()
+    tables = {
+        channel.name: numpy.array(channel.get_table())
+        for channel in bundle.find_child("morph").children
+    }
+    factors = numpy.arange(10) / 10
+    assert numpy.allclose(tables["smile"], 1 - numpy.abs(2 * factors - 1), atol=1e-6)
+    assert numpy.allclose(tables["blink"], [0.5])
+
+def test_animation_workers():
+    def make_clip(name, offset):
+        return {
+            "name": name,
+            "channels": [{"sampler": 0, "target": {"node": 2, "path": "translation"}}],
+            "samplers": [{
+                "input": numpy.array([0, 1], dtype=numpy.float32),
+                "output": numpy.array([(0, 0, 0), (offset, 0, 0)], dtype=numpy.float32),
+            }],
+        }
+
+    def get_bundle_tables(converter):
+        return {
+            np.node().get_bundle().name: [
+                list(channel.get_table(c)) for c in 'xyz'
+            ]
+            for np in converter.active_scene.find_all_matches('**/+AnimBundleNode')
+            for channel in [np.node().get_bundle().find_child("<skeleton>").children[0].children[0]]
+        }
+
+    gltf_data = make_skinned_gltf([make_clip("walk", 1), make_clip("run", 2)])
+    expected = get_bundle_tables(convert_gltf(gltf_data, animation_fps=4))
+    assert get_bundle_tables(convert_gltf(gltf_data, animation_fps=4, animation_workers=2)) == expected
+    assert numpy.allclose(expected["run"][0], [0, 0.5, 1, 1.5])
+
+def test_lazy_animations(modelroot):
+    filename = p3d.Filename(modelroot, 'Fox.glb')
+    bundles = {
+        np.node().get_bundle().name: np.node().get_bundle()
+        for np in p3d.NodePath(gltf.load_model(filename)).find_all_matches('**/+AnimBundleNode')
+    }
+    model = p3d.NodePath(gltf.load_model(filename, gltf.GltfSettings(lazy_animations=True)))
+    assert not model.find_all_matches('**/+AnimBundleNode')
+
+    character = model.find('**/+Character')
+    library = gltf.load_animation_library(character)
+    assert sorted(library) == sorted(bundles)
+    assert not any(library.is_loaded(name) for name in library)
+
+    control = library.bind(character, 'Run')
+    assert control.get_num_frames() == bundles['Run'].get_num_frames()
+    assert library.is_loaded('Run')
+    assert not library.is_loaded('Walk')
+    assert library.get_bundle('Run') == control.get_anim()
+
+def test_lazy_animations_release_converter():
+    gltf_data = make_skinned_gltf([{
+        "name": "wave",
+        "channels": [{"sampler": 0, "target": {"node": 2, "path": "translation"}}],
+        "samplers": [{
+            "input": numpy.array([0, 1], dtype=numpy.float32),
+            "output": numpy.array([(0, 0, 0), (1, 0, 0)], dtype=numpy.float32),
+        }],
+    }])
+    expected = get_anim_tables(convert_gltf(gltf_data))
+
+    converter = convert_gltf(gltf_data, lazy_animations=True)
+    character = converter.active_scene.find('**/+Character')
+    converter_ref = weakref.ref(converter)
+    del converter
+    gc.collect()
+    assert converter_ref() is None
+
+    # The library still bakes the clip from its own copy of the keyframes
+    group = gltf.load_animation_library(character).get_bundle('wave').find_child('arm')
+    assert {c: list(group.get_table(c)) for c in 'xyzhprijk'} == expected['arm']
+
+def test_share_animations():
+    def make_data(offset):
+        return make_skinned_gltf([{
+            "name": "wave",
+            "channels": [{"sampler": 0, "target": {"node": 2, "path": "translation"}}],
+            "samplers": [{
+                "input": numpy.array([0, 1], dtype=numpy.float32),
+                "output": numpy.array([(0, 0, 0), (offset, 0, 0)], dtype=numpy.float32),
+            }],
+        }])
+
+    def get_bundle(cache=None, **kwargs):
+        converter = Converter("synthetic.gltf", gltf.GltfSettings(**kwargs), cache)
+        converter.update(gltf_data)
+        return converter.active_scene.find('**/+AnimBundleNode').node().get_bundle()
+
+    cache = gltf.AnimationCache()
+    gltf_data = make_data(1)
+    bundle = get_bundle(cache, share_animations=True)
+    assert get_bundle(cache, share_animations=True) == bundle
+    assert get_bundle(cache) != bundle
+    assert get_bundle(share_animations=True) != bundle
+
+    gltf_data = make_data(2)
+    assert get_bundle(cache, share_animations=True) != bundle
+    assert len(cache) == 2
+
+def test_share_animations_load_model(tmp_path):
+    gltf_data = make_skinned_gltf([{
+        "name": "wave",
+        "channels": [{"sampler": 0, "target": {"node": 2, "path": "translation"}}],
+        "samplers": [{
+            "input": numpy.array([0, 1], dtype=numpy.float32),
+            "output": numpy.array([(0, 0, 0), (1, 0, 0)], dtype=numpy.float32),
+        }],
+    }])
+    for name in ('first.gltf', 'second.gltf'):
+        with open(tmp_path / name, 'w') as gltf_file:
+            json.dump(gltf_data, gltf_file)
+
+    def load_bundle(name, **kwargs):
+        filename = p3d.Filename.from_os_specific(str(tmp_path / name))
+        model = p3d.NodePath(gltf.load_model(filename, gltf.GltfSettings(**kwargs)))
+        return model.find('**/+AnimBundleNode').node().get_bundle()
+
+    gltf.get_animation_cache().clear()
+    bundle = load_bundle('first.gltf', share_animations=True)
+    assert len(gltf.get_animation_cache()) == 1
+    assert load_bundle('second.gltf', share_animations=True) == bundle
+    assert load_bundle('second.gltf') != bundle
+    gltf.get_animation_cache().clear()
+
+def test_deep_hierarchy():
+    positions, normals, _, indices = make_grid(1)
+    depth = 5000
+    nodes = [{"children": [i + 1]} for i in range(depth)]
+    mirror = [-1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+    nodes.append({"mesh": 0})
+    nodes[10]["matrix"] = mirror
+    nodes.append({"mesh": 1, "matrix": mirror})
+    gltf_mesh = {"primitives": [{"attributes": {"POSITION": positions, "NORMAL": normals}, "indices": indices}]}
+    gltf_data = make_gltf(
+        [gltf_mesh, gltf_mesh],
+        nodes=nodes,
+        scenes=[{"nodes": [0], "extras": {"hidden_nodes": [depth + 1]}}],
+    )
+    scene = convert_gltf(gltf_data).active_scene
+
+    geomnodes = list(scene.find_all_matches("**/+GeomNode"))
+    assert len(geomnodes) == 2
+    hidden, deep = sorted(geomnodes, key=lambda np: np.get_num_nodes())
+    assert hidden.get_parent().name == "ReverseCulling"
+    assert hidden.is_hidden()
+    assert deep.get_parent().name == "ReverseCulling"
+    assert not deep.is_hidden()
+
+def test_material_usage_index():
+    positions, normals, uvs, indices = make_grid(1)
+    gltf_data = make_gltf(
+        [{"primitives": [
+            {"attributes": {"POSITION": positions, "NORMAL": normals}, "indices": indices, "material": 1},
+            {
+                "attributes": {"POSITION": positions, "NORMAL": normals, "TEXCOORD_0": uvs},
+                "indices": indices,
+                "material": 1,
+            },
+        ]}],
+        materials=[{"name": "unused"}, {"name": "used"}],
+    )
+    converter = convert_gltf(gltf_data)
+
+    # Unused materials are skipped, and primitives with and without texture
+    # coordinates share the used one
+    assert list(converter.mat_states) == [1]
+    mesh = converter.meshes[0]
+    for i in range(2):
+        assert mesh.get_geom_state(i).get_attrib(p3d.MaterialAttrib).get_material().name == "used"
+
+def test_node_transforms():
+    positions, normals, _, indices = make_grid(1)
+    gltf_data = make_gltf(
+        [{"primitives": [{"attributes": {"POSITION": positions, "NORMAL": normals}, "indices": indices}]}],
+        nodes=[
+            {"translation": [1, 2, 3], "rotation": [0, 0, 0.7071068, 0.7071068], "scale": [2, 2, 2]},
+            {"matrix": [2, 0, 0, 0, 0, 2, 0, 0, 0, 0, 2, 0, 1, 2, 3, 1], "rotation": [0, 0, 0.7071068, 0.7071068]},
+            {"translation": [1, 2, 3]},
+            {"translation": [1, 2, 3]},
+            {"mesh": 0, "scale": [0.00001, 0.00001, 0.00001]},
+        ],
+    )
+    converter = convert_gltf(gltf_data)
+    states = converter.get_node_transforms(gltf_data)
+
+    # glTF Y-up is converted to Panda3D Z-up, and a quarter turn around
+    # the glTF Z axis is a quarter roll around the Panda3D Y axis
+    assert states[0].get_pos().almost_equal(p3d.LPoint3(1, -3, 2))
+    assert states[0].get_hpr().almost_equal(p3d.LVecBase3(0, 0, -90), 0.001)
+    assert states[0].get_scale().almost_equal(p3d.LVecBase3(2, 2, 2))
+    assert states[1].get_mat().almost_equal(
+        p3d.TransformState.make_pos_hpr_scale((1, -3, 2), (0, 0, 0), (2, 2, 2)).get_mat()
+    )
+    assert states[2] is states[3]
+
+    # Tiny scales are baked into the mesh instead of the transform
+    assert states[4].is_identity()
+    bounds = converter.active_scene.find("**/+GeomNode").get_tight_bounds()
+    assert 0 < bounds[1].x - bounds[0].x < 0.0001
+
+def test_collapse_empty_nodes():
+    positions, normals, _, indices = make_grid(1)
+    gltf_data = make_gltf(
+        [{"primitives": [{"attributes": {"POSITION": positions, "NORMAL": normals}, "indices": indices}]}],
+        nodes=[
+            {"translation": [1, 0, 0], "children": [1]},
+            {"translation": [0, 1, 0], "children": [2]},
+            {"name": "kept", "translation": [0, 0, 1], "children": [3]},
+            {"extras": {"part": 42}, "children": [4]},
+            {"scale": [2, 2, 2], "children": [5]},
+            {"name": "part", "mesh": 0},
+        ],
+        scenes=[{"nodes": [0]}],
+    )
+
+    def get_path(scene):
+        part = scene.find("**/part")
+        return part, [np.name for np in reversed(part.get_ancestors()[1:-1])]
+
+    part, path = get_path(convert_gltf(gltf_data).active_scene)
+    full_mat = part.get_net_transform().get_mat()
+    assert path == ["node0", "node1", "kept", "node3", "node4"]
+
+    part, path = get_path(convert_gltf(gltf_data, collapse_empty_nodes=True).active_scene)
+    assert path == ["kept", "node3"]
+    assert part.get_net_transform().get_mat().almost_equal(full_mat)
+    assert part.get_parent().get_tag("part") == "42"